@@ -0,0 +1,193 @@
+import argparse
+import copy
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import jsonlines
+
+from mock_server import add_behavior_arguments
+from inference_adaptor.openai_adaptor import OpenaiAdaptor
+
+
+def find_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock_server(args):
+    port = find_free_port()
+    command = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_server.py"),
+        "--port",
+        str(port),
+        "--latency_dist",
+        args.latency_dist,
+        "--latency_mean",
+        str(args.latency_mean),
+        "--latency_sigma",
+        str(args.latency_sigma),
+        "--tokens_per_sec",
+        str(args.tokens_per_sec),
+        "--output_tokens",
+        str(args.output_tokens),
+        "--rate_429",
+        str(args.rate_429),
+        "--rate_5xx",
+        str(args.rate_5xx),
+    ]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    print(server.stdout.readline().strip())
+    return server, f"http://127.0.0.1:{port}/v1"
+
+
+def load_items(dataset_path, num_items):
+    items = []
+    with jsonlines.open(dataset_path) as in_f:
+        for input_obj in in_f:
+            input_obj["role"] = ["user" for _ in input_obj["input"]]
+            items.append(input_obj)
+            if len(items) == num_items:
+                break
+    return items
+
+
+def mock_model_configs(base_url, concurrency):
+    return {
+        "serving_type": "openai",
+        "model_name": "mock",
+        "base_url": base_url,
+        "api_key": "mock",
+        "semaphore_max_count": concurrency,
+    }
+
+
+def measure(adaptor, batch):
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    outputs = adaptor.inference(batch)
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() - cpu_start
+
+    summary = adaptor.metrics.summary()
+    requests = max(summary["latency"]["count"], 1)
+    return outputs, {
+        "items": len(batch),
+        "requests": summary["latency"]["count"],
+        "errors": summary["errors"],
+        "retries": summary["retries"],
+        "wall_time": round(wall_time, 3),
+        "requests_per_sec": round(requests / wall_time, 2),
+        "latency_p50": summary["latency"]["p50"],
+        "latency_p95": summary["latency"]["p95"],
+        "latency_p99": summary["latency"]["p99"],
+        "cpu_ms_per_request": round(cpu_time * 1000 / requests, 3),
+    }
+
+
+def benchmark_inference(base_url, concurrency, items):
+    adaptor = OpenaiAdaptor(mock_model_configs(base_url, concurrency))
+    _, report = measure(adaptor, copy.deepcopy(items))
+    adaptor.terminate()
+    return report
+
+
+def benchmark_judge(base_url, concurrency, items):
+    from judge import build_judge_batch, build_eval_result
+
+    lines = []
+    for item in items:
+        line = copy.deepcopy(item)
+        line["response"] = ["mock response" for _ in item["input"]]
+        line["think"] = ["" for _ in item["input"]]
+        line["elapsed_time"] = [0 for _ in item["input"]]
+        lines.append(line)
+
+    adaptor = OpenaiAdaptor(mock_model_configs(base_url, concurrency))
+    batch = build_judge_batch(lines)
+    api_responses, report = measure(adaptor, batch)
+    adaptor.terminate()
+
+    api_responses = iter(api_responses)
+    parsing_errors = 0
+    for line in lines:
+        result = build_eval_result(line, api_responses)
+        parsing_errors += sum(
+            1 for parsed in result["judge_parsed"] if parsed["type"] == "Parsing Error"
+        )
+    report["parsing_errors"] = parsing_errors
+    return report
+
+
+def compare_with_baseline(reports, baseline_path, tolerance):
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {
+            (report["mode"], report["concurrency"]): report for report in json.load(f)
+        }
+
+    regressed = False
+    for report in reports:
+        previous = baseline.get((report["mode"], report["concurrency"]))
+        if previous is None:
+            continue
+        change = report["requests_per_sec"] / previous["requests_per_sec"] - 1
+        status = "ok"
+        if change < -tolerance:
+            status = "REGRESSION"
+            regressed = True
+        print(
+            f"{report['mode']} x{report['concurrency']}: "
+            f"{previous['requests_per_sec']} -> {report['requests_per_sec']} req/s "
+            f"({change:+.1%}) {status}"
+        )
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dataset_path", type=str, default="dataset/TRUEBench-v0.6.1.jsonl"
+    )
+    parser.add_argument("--num_items", type=int, default=256)
+    parser.add_argument("--concurrency", type=str, default="8,32,128")
+    parser.add_argument(
+        "--mode", type=str, default="all", choices=["inference", "judge", "all"]
+    )
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    add_behavior_arguments(parser)
+    args = parser.parse_args()
+
+    modes = ["inference", "judge"] if args.mode == "all" else [args.mode]
+    items = load_items(args.dataset_path, args.num_items)
+    server, base_url = start_mock_server(args)
+
+    reports = []
+    try:
+        for mode in modes:
+            for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                if mode == "inference":
+                    report = benchmark_inference(base_url, concurrency, items)
+                else:
+                    report = benchmark_judge(base_url, concurrency, items)
+                report = {"mode": mode, "concurrency": concurrency} | report
+                reports.append(report)
+                print(json.dumps(report))
+    finally:
+        server.terminate()
+        server.wait()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=4)
+
+    if args.baseline and compare_with_baseline(reports, args.baseline, args.tolerance):
+        sys.exit(1)
@@ -0,0 +1,3 @@
+#!/bin/bash
+
+python benchmark.py --num_items 256 --concurrency 8,32,128 --latency_dist lognormal --latency_mean 0.5 --output bench_results.json
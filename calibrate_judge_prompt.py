@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+
+from pathlib import Path
+
+from fast_eval import stratified_sample
+from judge import (
+    PARSING_ERROR,
+    build_judge_batch,
+    create_judge_adaptor,
+    iter_inference_result,
+    parse_judgement,
+)
+from inference_adaptor.metrics import percentile
+from utils import get_model_configs, create_directory_if_not_exists
+
+VARIANTS = ["full", "compact"]
+
+
+def variant_stats(api_responses):
+    """Parse errors, pass rate, mean tokens and latency of one prompt variant."""
+    count = max(len(api_responses), 1)
+    parsed = [parse_judgement(api_response) for api_response in api_responses]
+    latencies = [
+        api_response["elapsed_time"][-1]
+        for api_response in api_responses
+        if api_response["elapsed_time"][-1] >= 0
+    ]
+    stats = {
+        "judgements": len(api_responses),
+        "parse_errors": sum(1 for p in parsed if p["type"] == PARSING_ERROR),
+        "pass_rate": round(sum(1 for p in parsed if p["result"]) / count, 4),
+    }
+    for field in ("input_tokens", "think_tokens", "response_tokens"):
+        stats[field] = round(
+            sum(api_response[field][-1] for api_response in api_responses) / count, 1
+        )
+    stats["output_tokens"] = round(stats["think_tokens"] + stats["response_tokens"], 1)
+    stats["latency_p50"] = round(percentile(latencies, 50), 3)
+    stats["latency_p95"] = round(percentile(latencies, 95), 3)
+    return stats
+
+
+def compare_variants(full_responses, compact_responses):
+    """
+    Verdict and criterion label agreement of the two variants, overall and
+    per category. Judgements that either variant failed to parse are left out.
+    """
+    categories = {}
+    for full, compact in zip(full_responses, compact_responses):
+        full_parsed = parse_judgement(full)
+        compact_parsed = parse_judgement(compact)
+        if PARSING_ERROR in (full_parsed["type"], compact_parsed["type"]):
+            continue
+        for key in ("Overall", full.get("category", "")):
+            counts = categories.setdefault(
+                key,
+                {"compared": 0, "verdicts_agreed": 0, "labels": 0, "labels_agreed": 0},
+            )
+            counts["compared"] += 1
+            counts["verdicts_agreed"] += int(
+                full_parsed["result"] == compact_parsed["result"]
+            )
+            if len(full_parsed["labels"]) == len(compact_parsed["labels"]):
+                counts["labels"] += len(full_parsed["labels"])
+                counts["labels_agreed"] += sum(
+                    int(full_label == compact_label)
+                    for full_label, compact_label in zip(
+                        full_parsed["labels"], compact_parsed["labels"]
+                    )
+                )
+    for counts in categories.values():
+        counts["verdict_agreement"] = round(
+            counts["verdicts_agreed"] / max(counts["compared"], 1), 4
+        )
+        counts["label_agreement"] = round(
+            counts["labels_agreed"] / max(counts["labels"], 1), 4
+        )
+    return categories
+
+
+def savings(full_stats, compact_stats):
+    """Relative reduction of the compact variant against the full one."""
+    return {
+        field: round(1 - compact_stats[field] / full_stats[field], 4)
+        if full_stats[field]
+        else 0.0
+        for field in ("input_tokens", "output_tokens", "latency_p50", "latency_p95")
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--eval_file", type=str, required=True)
+    parser.add_argument("--output_path", type=str, default="eval_results/")
+    parser.add_argument("--sample_ratio", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--structured_output", action="store_true")
+    args = parser.parse_args()
+
+    eval_file = Path(args.eval_file)
+    eval_filename = eval_file.name.removesuffix(".jsonl")
+    create_directory_if_not_exists(args.output_path)
+
+    lines = stratified_sample(
+        list(iter_inference_result(eval_file)), args.sample_ratio, args.seed
+    )
+    print(f"{len(lines)} items sampled")
+
+    adaptor = create_judge_adaptor(get_model_configs(args.config))
+    api_responses = {}
+    for variant in VARIANTS:
+        batch = build_judge_batch(
+            lines,
+            structured_output=args.structured_output,
+            compact=variant == "compact",
+        )
+        api_responses[variant] = adaptor.inference(batch)
+    adaptor.terminate()
+
+    stats = {variant: variant_stats(api_responses[variant]) for variant in VARIANTS}
+    report = {
+        "items": len(lines),
+        "variants": stats,
+        "savings": savings(stats["full"], stats["compact"]),
+        "agreement": compare_variants(api_responses["full"], api_responses["compact"]),
+    }
+    print(json.dumps(report, indent=4))
+    with open(
+        os.path.join(args.output_path, eval_filename + "_judge_calibration.json"),
+        "w",
+        encoding="utf-8",
+    ) as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
@@ -0,0 +1,190 @@
+import glob
+import heapq
+import json
+
+from collections import defaultdict
+
+DEFAULT_RESPONSE_TOKENS = 1024
+DEFAULT_LATENCY = 30.0
+# prompt processing speed assumed on top of the historical turn latency
+PREFILL_TOKENS_PER_SEC = 10000
+
+
+class RunHistory:
+    """
+    Per-category averages of previous runs, used to predict output tokens and
+    latency of turns that have not been sent yet.
+
+    ``prefix`` selects the fields to read: ``""`` for inference result files
+    (``response_tokens``, ``elapsed_time``, ...) and ``"judge_"`` for
+    eval_result files (``judge_response_tokens``, ``judge_elapsed_time``, ...).
+    """
+
+    def __init__(self, paths=None, prefix=""):
+        self.stats = defaultdict(
+            lambda: {"turns": 0, "response_tokens": 0, "think_tokens": 0}
+        )
+        self.latency = defaultdict(list)
+        for pattern in paths or []:
+            for path in sorted(glob.glob(pattern)):
+                self.load(path, prefix)
+
+    def load(self, path, prefix):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                data = json.loads(line)
+                category = data.get("category", "")
+                response_tokens = data.get(f"{prefix}response_tokens", [])
+                think_tokens = data.get(f"{prefix}think_tokens", [])
+                elapsed_time = data.get(f"{prefix}elapsed_time", [])
+                for response, think, elapsed in zip(
+                    response_tokens, think_tokens, elapsed_time
+                ):
+                    # skip system turns and failed requests
+                    if response == 0 and think == 0:
+                        continue
+                    for key in [category, ""]:
+                        self.stats[key]["turns"] += 1
+                        self.stats[key]["response_tokens"] += response
+                        self.stats[key]["think_tokens"] += think
+                        if elapsed > 0:
+                            self.latency[key].append(elapsed)
+
+    def _stats(self, category):
+        if self.stats[category]["turns"] > 0:
+            return self.stats[category]
+        return self.stats[""]
+
+    def response_tokens(self, category):
+        stats = self._stats(category)
+        if stats["turns"] == 0:
+            return DEFAULT_RESPONSE_TOKENS
+        return stats["response_tokens"] / stats["turns"]
+
+    def think_tokens(self, category):
+        stats = self._stats(category)
+        if stats["turns"] == 0:
+            return 0
+        return stats["think_tokens"] / stats["turns"]
+
+    def turn_latency(self, category):
+        latency = self.latency[category] or self.latency[""]
+        if not latency:
+            return DEFAULT_LATENCY
+        return sum(latency) / len(latency)
+
+
+def concurrency_of(model_configs):
+    if model_configs.get("serving_type") == "vllm":
+        return model_configs.get("serving_params", {}).get("max_num_seqs", 256)
+    return model_configs.get("semaphore_max_count", 16)
+
+
+def estimate_item(item, history, counter):
+    """
+    Estimate requests, tokens and seconds of one batch entry. Turns of an item
+    are sent one after another, so its time is the sum of its turns.
+    """
+    category = item.get("category", "")
+    estimate = {
+        "requests": 0,
+        "input_tokens": 0,
+        "think_tokens": 0,
+        "response_tokens": 0,
+        "time": 0.0,
+    }
+    context_tokens = 0
+    for role, message in zip(item["role"], item["input"]):
+        context_tokens += counter.count(message)
+        if role == "system":
+            continue
+        estimate["requests"] += 1
+        estimate["input_tokens"] += context_tokens
+        estimate["think_tokens"] += history.think_tokens(category)
+        estimate["response_tokens"] += history.response_tokens(category)
+        estimate["time"] += (
+            history.turn_latency(category) + context_tokens / PREFILL_TOKENS_PER_SEC
+        )
+        context_tokens += history.response_tokens(category)
+    return estimate
+
+
+def estimate_run(items, model_configs, history, counter):
+    """
+    Estimate requests, tokens and wall time of sending ``items`` without
+    sending anything.
+
+    ``items`` is any iterable of batch entries as passed to
+    ``BaseAdaptor.inference`` (e.g. the lazily rendered judge prompts), with an
+    optional ``"category"`` key to look up ``history``. Previous responses of a
+    multi-turn item are predicted from ``history`` since they are part of the
+    input of later turns.
+    """
+    item_cnt = 0
+    requests = 0
+    input_tokens = 0
+    think_tokens = 0
+    response_tokens = 0
+    busy_time = 0.0
+    longest_item = 0.0
+    for item in items:
+        estimate = estimate_item(item, history, counter)
+        item_cnt += 1
+        requests += estimate["requests"]
+        input_tokens += estimate["input_tokens"]
+        think_tokens += estimate["think_tokens"]
+        response_tokens += estimate["response_tokens"]
+        busy_time += estimate["time"]
+        longest_item = max(longest_item, estimate["time"])
+
+    # every sample is a conversation of its own
+    samples = model_configs.get("num_samples", 1)
+    requests *= samples
+    input_tokens *= samples
+    think_tokens *= samples
+    response_tokens *= samples
+    busy_time *= samples
+
+    concurrency = concurrency_of(model_configs)
+    output_tokens = think_tokens + response_tokens
+    wall_time = max(busy_time / concurrency, longest_item)
+    bounds = {"concurrency": wall_time}
+    if model_configs.get("rpm_limit"):
+        bounds["rpm_limit"] = requests / model_configs["rpm_limit"] * 60
+    if model_configs.get("tpm_limit"):
+        bounds["tpm_limit"] = (
+            (input_tokens + output_tokens) / model_configs["tpm_limit"] * 60
+        )
+    bottleneck = max(bounds, key=bounds.get)
+
+    return {
+        "items": item_cnt,
+        "requests": requests,
+        "input_tokens": int(input_tokens),
+        "think_tokens": int(think_tokens),
+        "response_tokens": int(response_tokens),
+        "output_tokens": int(output_tokens),
+        "concurrency": concurrency,
+        "estimated_hours": round(bounds[bottleneck] / 3600, 2),
+        "bottleneck": bottleneck,
+    }
+
+
+def simulate_makespan(item_times, concurrency):
+    """Wall time of running items in the given order with ``concurrency`` slots."""
+    slots = [0.0] * min(concurrency, max(len(item_times), 1))
+    for item_time in item_times:
+        start = heapq.heappop(slots)
+        heapq.heappush(slots, start + item_time)
+    return max(slots)
+
+
+def report_estimate(estimate, output_file=None):
+    print("*" * 50)
+    print("dry run : nothing is sent")
+    for key, value in estimate.items():
+        print(f"{key}: {value}")
+    print("*" * 50)
+    if output_file:
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(estimate, f, ensure_ascii=False, indent=4)
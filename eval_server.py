@@ -0,0 +1,295 @@
+import argparse
+import gc
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+import traceback
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse
+
+from fast_eval import stratified_sample
+from inference import create_inference_adaptor, load_dataset, write_results
+from judge import (
+    EvalResultWriter,
+    count_judge_turns,
+    create_judge_adaptor,
+    create_prompt_budget,
+    iter_inference_result,
+    judge_stream,
+)
+from utils import get_model_configs, create_directory_if_not_exists
+
+JOB_TYPES = ["inference", "judge"]
+
+
+class EvalService:
+    """
+    Run inference and judge jobs back to back on one worker thread while
+    keeping their adaptors initialized, so only the first job of a config
+    pays for loading vLLM weights and tokenizers. SDK clients are bound to
+    the event loop of a run and are still created by every job.
+
+    A job is a dict with a ``type`` and the arguments of the matching script:
+
+    - ``inference``: ``config``, ``inference_adaptor``, ``dataset_path``,
+      ``output_path`` (default ``results/``), ``sample_cnt``, ``fast_eval``,
+      ``seed`` and ``model_name``, the output name (defaults to ``config``).
+    - ``judge``: ``config``, ``eval_file``, ``output_path`` (default
+      ``eval_results/``), ``prompt_cache``, ``structured_output``,
+      ``parse_retries``, ``compact_prompt`` and ``max_prompt_tokens``.
+
+    Jobs run in submission order, a judge job can therefore be submitted
+    right after the inference job writing its ``eval_file``. Only one vLLM
+    adaptor is kept, since it holds the GPUs.
+    """
+
+    def __init__(self):
+        self.adaptors = {}
+        self.jobs = {}
+        self.done_events = {}
+        self.lock = threading.Lock()
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target=self.run_jobs, daemon=True)
+        self.worker.start()
+
+    def submit(self, job):
+        """Queue ``job`` and return its id."""
+        if job.get("type") not in JOB_TYPES:
+            raise ValueError(f"Unsupported job type: {job.get('type')}")
+        required = ["config", "eval_file"]
+        if job["type"] == "inference":
+            required = ["config", "inference_adaptor", "dataset_path"]
+        missing = [key for key in required if key not in job]
+        if missing:
+            raise ValueError(f"Missing job fields: {', '.join(missing)}")
+
+        job_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.jobs[job_id] = {
+                "job_id": job_id,
+                "status": "queued",
+                "job": job,
+                "submitted_at": time.time(),
+            }
+            self.done_events[job_id] = threading.Event()
+        self.pending.put(job_id)
+        return job_id
+
+    def status(self, job_id=None):
+        """State of ``job_id``, or of every job when None. Unknown ids give None."""
+        with self.lock:
+            if job_id is None:
+                return [dict(state) for state in self.jobs.values()]
+            state = self.jobs.get(job_id)
+            return dict(state) if state is not None else None
+
+    def wait(self, job_id, timeout=None):
+        """
+        Block until ``job_id`` is done or failed and return its state. Unknown
+        ids give None, like ``status``.
+        """
+        done_event = self.done_events.get(job_id)
+        if done_event is None:
+            return None
+        done_event.wait(timeout)
+        return self.status(job_id)
+
+    def shutdown(self):
+        """Finish the queued jobs and release the adaptors."""
+        self.pending.put(None)
+        self.worker.join()
+        for adaptor in self.adaptors.values():
+            adaptor.terminate()
+            adaptor.metrics.close()
+        self.adaptors = {}
+
+    def update(self, job_id, **fields):
+        with self.lock:
+            self.jobs[job_id].update(fields)
+
+    def run_jobs(self):
+        while True:
+            job_id = self.pending.get()
+            if job_id is None:
+                break
+            job = self.jobs[job_id]["job"]
+            self.update(job_id, status="running", started_at=time.time())
+            try:
+                if job["type"] == "inference":
+                    result = self.run_inference(job)
+                else:
+                    result = self.run_judge(job)
+                self.update(job_id, status="done", result=result)
+            except Exception as e:
+                traceback.print_exc()
+                self.update(job_id, status="failed", error=f"{e}")
+            self.update(job_id, finished_at=time.time())
+            self.done_events[job_id].set()
+
+    def adaptor(self, adaptor_name, model_configs):
+        """Adaptor of ``model_configs``, created on first use and kept afterwards."""
+        key = (adaptor_name, json.dumps(model_configs, sort_keys=True))
+        if key not in self.adaptors:
+            if adaptor_name == "vllm":
+                # vLLM holds the GPUs, the previous model has to go first
+                for other in [other for other in self.adaptors if other[0] == "vllm"]:
+                    self.adaptors.pop(other).terminate()
+                gc.collect()
+            if adaptor_name == "judge":
+                self.adaptors[key] = create_judge_adaptor(model_configs)
+            else:
+                self.adaptors[key] = create_inference_adaptor(
+                    adaptor_name, model_configs
+                )
+        return self.adaptors[key]
+
+    def run_inference(self, job):
+        model_configs = get_model_configs(job["config"])
+        adaptor = self.adaptor(job["inference_adaptor"], model_configs)
+
+        output_path = job.get("output_path", "results/")
+        dataset_path = Path(job["dataset_path"])
+        if dataset_path.suffix == ".jsonl":
+            dataset_path = dataset_path.with_suffix("")
+        create_directory_if_not_exists(output_path)
+        model_name = job.get("model_name", job["config"])
+        if job.get("fast_eval"):
+            model_name += "-fast"
+        output_file = output_path + "/" + model_name + "_" + dataset_path.name
+
+        items = load_dataset(dataset_path, job.get("sample_cnt", -1))
+        if job.get("fast_eval"):
+            items = stratified_sample(items, job["fast_eval"], job.get("seed", 0))
+        outputs = adaptor.inference(items)
+        write_results(outputs, output_file)
+        adaptor.metrics.write_summary(output_file + "_metrics.json")
+        return {
+            "output_file": output_file + ".jsonl",
+            "metrics": adaptor.metrics.summary(),
+        }
+
+    def run_judge(self, job):
+        model_configs = get_model_configs(job["config"])
+        adaptor = self.adaptor("judge", model_configs)
+        parse_retries = job.get("parse_retries", 2)
+
+        eval_file = Path(job["eval_file"]).resolve()
+        output_path = Path(job.get("output_path", "eval_results/")).resolve()
+        create_directory_if_not_exists(output_path)
+        eval_filename = eval_file.name.removesuffix(".jsonl")
+        output_file = os.path.join(output_path, eval_filename + "_eval_result.jsonl")
+
+        total = sum(
+            count_judge_turns(line) for line in iter_inference_result(eval_file)
+        )
+        budget = create_prompt_budget(model_configs, job.get("max_prompt_tokens", -1))
+        with open(output_file, "a", encoding="utf-8") as fo:
+            writer = EvalResultWriter(fo, hold_malformed=parse_retries > 0)
+            adaptor.run_async(
+                judge_stream(
+                    adaptor,
+                    iter_inference_result(eval_file),
+                    writer,
+                    job.get("prompt_cache", False),
+                    job.get("structured_output", False),
+                    total,
+                    job.get("compact_prompt", False),
+                    budget,
+                )
+            )
+            summary = adaptor.metrics.summary()
+            if budget is not None:
+                summary["prompt_budget"] = budget.report()
+            parse_report = writer.retry(adaptor, parse_retries)
+        with open(
+            os.path.join(output_path, eval_filename + "_judge_metrics.json"),
+            "w",
+            encoding="utf-8",
+        ) as f:
+            json.dump(summary | parse_report, f, ensure_ascii=False, indent=4)
+        return {"output_file": output_file, "metrics": summary | parse_report}
+
+
+class EvalHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip("/") != "/jobs":
+            self.send_json(404, {"error": "not found"})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            job_id = self.server.service.submit(json.loads(self.rfile.read(length)))
+        except ValueError as e:
+            self.send_json(400, {"error": f"{e}"})
+            return
+        self.send_json(200, self.server.service.status(job_id))
+
+    def do_GET(self):
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if parts == ["jobs"]:
+            self.send_json(200, self.server.service.status())
+            return
+        if len(parts) == 2 and parts[0] == "jobs":
+            state = self.server.service.status(parts[1])
+            if state is not None:
+                self.send_json(200, state)
+                return
+        self.send_json(404, {"error": "not found"})
+
+    def send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class EvalHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host, port, service):
+        super().__init__((host, port), EvalHandler)
+        self.service = service
+
+
+class EvalUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, service):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, EvalHandler)
+        self.service = service
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--unix_socket", type=str, default=None)
+    args = parser.parse_args()
+
+    service = EvalService()
+    if args.unix_socket:
+        server = EvalUnixServer(args.unix_socket, service)
+        print(f"Eval server listening on {args.unix_socket}", flush=True)
+    else:
+        server = EvalHTTPServer(args.host, args.port, service)
+        print(f"Eval server listening on http://{args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    service.shutdown()
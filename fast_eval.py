@@ -0,0 +1,76 @@
+import math
+import random
+
+from collections import defaultdict
+
+Z_95 = 1.96
+
+
+def stratum_of(item):
+    return (item["category"], item["language"], item["turns"])
+
+
+def stratified_sample(items, ratio, seed=0):
+    """
+    Sample ``ratio`` of ``items`` within every category x language x turns
+    stratum, with a fixed ``seed``, keeping the dataset order.
+
+    Every stratum keeps at least 2 items (or all of them when smaller) so its
+    variance can be estimated. Sampled items get a ``sample_weight``, the
+    number of dataset items each one stands for.
+    """
+    strata = defaultdict(list)
+    for idx, item in enumerate(items):
+        strata[stratum_of(item)].append(idx)
+
+    rng = random.Random(seed)
+    sampled = []
+    for stratum in sorted(strata):
+        indices = strata[stratum]
+        size = min(len(indices), max(2, round(ratio * len(indices))))
+        for idx in rng.sample(indices, size):
+            items[idx]["sample_weight"] = len(indices) / size
+            sampled.append(idx)
+    return [items[idx] for idx in sorted(sampled)]
+
+
+def stratified_estimate(results):
+    """
+    Estimate the pass rate (in %) of the population behind the sampled eval
+    ``results`` and its 95% confidence interval.
+
+    The estimate weights each stratum by its dataset size. Its variance sums
+    the per-stratum sampling variances with the finite population
+    correction. A stratum with a single sampled item borrows the pooled pass
+    rate variance. Returns ``(estimate, lower, upper, sample_size)``.
+    """
+    strata = defaultdict(list)
+    for result in results:
+        strata[stratum_of(result)].append(result)
+    if not strata:
+        return 0, 0, 0, 0
+
+    population = sum(result.get("sample_weight", 1) for result in results)
+    pooled = sum(result["pass"] for result in results) / len(results)
+    estimate = 0.0
+    variance = 0.0
+    for stratum_results in strata.values():
+        sampled = len(stratum_results)
+        size = sum(result.get("sample_weight", 1) for result in stratum_results)
+        share = size / population
+        passed = sum(result["pass"] for result in stratum_results) / sampled
+        estimate += share * passed
+        if sampled > 1:
+            unit_variance = passed * (1 - passed) * sampled / (sampled - 1)
+        else:
+            unit_variance = pooled * (1 - pooled)
+        correction = max(1 - sampled / size, 0.0)
+        variance += share**2 * unit_variance / sampled * correction
+
+    margin = Z_95 * math.sqrt(variance)
+    return (
+        round(estimate * 100, 2),
+        round(max(estimate - margin, 0.0) * 100, 2),
+        round(min(estimate + margin, 1.0) * 100, 2),
+        len(results),
+    )
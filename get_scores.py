@@ -2,27 +2,53 @@ import argparse
 import glob
 import json
 import csv
+import math
 import os
+import statistics
 from collections import defaultdict
 from itertools import product
 
+from fast_eval import stratified_estimate
+from inference_adaptor.metrics import percentile
+from inference_adaptor.profiler import Profiler, profile_stage
+
+CATEGORIES = [
+    "Content Generation",
+    "Editing",
+    "Data Analysis",
+    "Reasoning",
+    "Hallucination",
+    "Safety",
+    "Repetition",
+    "Summarization",
+    "Translation",
+]
+LANGUAGES = ["KO", "EN", "JA", "ZH", "PL", "DE", "PT", "ES", "FR", "IT", "RU", "VI"]
+
+
+def score_scopes():
+    """Overall, Single-Turn, category and language filters of the result lines."""
+    scopes = {
+        "Overall": lambda data: True,
+        "Single-Turn": lambda data: data["category"] != "Multi-Turn",
+    }
+    for category in [*CATEGORIES, "Multi-Turn"]:
+        scopes[category] = lambda data, category=category: data["category"] == category
+    for language in LANGUAGES:
+        scopes[language] = lambda data, language=language: data["language"] == language
+    return scopes
+
+
+def pass_at_k(n, c, k):
+    """Unbiased pass@k of an item with ``c`` passing samples out of ``n``."""
+    k = min(k, n)
+    if n - c < k:
+        return 1.0
+    return 1.0 - math.comb(n - c, k) / math.comb(n, k)
+
 
 def create_stats(target_dir):
-    headers = [
-        "Model Name",
-        "Overall",
-        "Content Generation",
-        "Editing",
-        "Data Analysis",
-        "Reasoning",
-        "Hallucination",
-        "Safety",
-        "Repetition",
-        "Summarization",
-        "Translation",
-        "Single-Turn",
-        "Multi-Turn",
-    ]
+    headers = ["Model Name", "Overall", *CATEGORIES, "Single-Turn", "Multi-Turn"]
 
     rows = []
 
@@ -54,17 +80,19 @@ def create_stats(target_dir):
             with open(file, "r", encoding="utf-8") as f:
                 for line in f:
                     data = json.loads(line)
-                    cnt["Overall total"] += 1
-                    cnt[data["category"] + " total"] += 1
+                    # fast-eval items stand for sample_weight dataset items
+                    weight = data.get("sample_weight", 1)
+                    cnt["Overall total"] += weight
+                    cnt[data["category"] + " total"] += weight
 
                     if data["category"] != "Multi-Turn":
-                        cnt["Single-Turn total"] += 1
+                        cnt["Single-Turn total"] += weight
 
                     if data["pass"] == True:
-                        cnt["Overall passed"] += 1
-                        cnt[data["category"] + " passed"] += 1
+                        cnt["Overall passed"] += weight
+                        cnt[data["category"] + " passed"] += weight
                         if data["category"] != "Multi-Turn":
-                            cnt["Single-Turn passed"] += 1
+                            cnt["Single-Turn passed"] += weight
 
             for header in headers:
                 if header != "Model Name":
@@ -86,22 +114,7 @@ def create_stats(target_dir):
 
 
 def create_stats_lang(target_dir):
-    headers = [
-        "Model Name",
-        "Overall",
-        "KO",
-        "EN",
-        "JA",
-        "ZH",
-        "PL",
-        "DE",
-        "PT",
-        "ES",
-        "FR",
-        "IT",
-        "RU",
-        "VI",
-    ]
+    headers = ["Model Name", "Overall", *LANGUAGES]
     rows = []
 
     os.makedirs(target_dir, exist_ok=True)
@@ -135,15 +148,16 @@ def create_stats_lang(target_dir):
                     data = json.loads(line)
 
                     lang_key = data["language"]
+                    weight = data.get("sample_weight", 1)
 
-                    cnt["Overall total"] += 1
+                    cnt["Overall total"] += weight
                     if lang_key in headers:
-                        cnt[lang_key + " total"] += 1
+                        cnt[lang_key + " total"] += weight
 
                     if data["pass"] == True:
-                        cnt["Overall passed"] += 1
+                        cnt["Overall passed"] += weight
                         if lang_key in headers:
-                            cnt[lang_key + " passed"] += 1
+                            cnt[lang_key + " passed"] += weight
 
             for header in headers:
                 if header != "Model Name":
@@ -164,6 +178,216 @@ def create_stats_lang(target_dir):
     return headers, rows
 
 
+def create_stats_ci(target_dir):
+    """
+    Estimated scores with 95% confidence intervals of the fast-eval results
+    (files whose items carry a ``sample_weight``), one row per scope.
+    """
+    headers = ["Model Name", "Scope", "Estimate", "Lower", "Upper", "Sample Size"]
+    scopes = score_scopes()
+    rows = []
+
+    output_file = os.path.join(target_dir, "stats_ci.csv")
+
+    with open(output_file, "w", newline="") as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(headers)
+
+        json_files = glob.glob(os.path.join(target_dir, "*.jsonl"))
+        json_files = sorted(json_files)
+
+        for file in json_files:
+            with open(file, "r", encoding="utf-8") as f:
+                results = [json.loads(line) for line in f]
+            if not any("sample_weight" in data for data in results):
+                continue
+
+            if "_TRUEBench-v" in os.path.basename(file):
+                model_name = os.path.basename(file).split("_TRUEBench-v")[0]
+            elif "_eval_result.jsonl" in os.path.basename(file):
+                model_name = os.path.basename(file).split("_eval_result.jsonl")[0]
+            else:
+                model_name = os.path.basename(file).split(".jsonl")[0]
+
+            for scope, in_scope in scopes.items():
+                scope_results = [data for data in results if in_scope(data)]
+                if not scope_results:
+                    continue
+                row = [model_name, scope, *stratified_estimate(scope_results)]
+                writer.writerow(row)
+                rows.append(row)
+
+    return headers, rows
+
+
+def create_stats_samples(target_dir):
+    """
+    Scores of the runs with several samples per item (items carrying a
+    ``sample_idx``), one row per scope: the mean and standard deviation of
+    the per-sample pass rates, and pass@k over all k samples of each item.
+    """
+    headers = ["Model Name", "Scope", "Samples", "Mean", "Std", "pass@k"]
+    scopes = score_scopes()
+    rows = []
+
+    output_file = os.path.join(target_dir, "stats_samples.csv")
+
+    with open(output_file, "w", newline="") as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(headers)
+
+        json_files = glob.glob(os.path.join(target_dir, "*.jsonl"))
+        json_files = sorted(json_files)
+
+        for file in json_files:
+            with open(file, "r", encoding="utf-8") as f:
+                results = [json.loads(line) for line in f]
+            if not any("sample_idx" in data for data in results):
+                continue
+
+            if "_TRUEBench-v" in os.path.basename(file):
+                model_name = os.path.basename(file).split("_TRUEBench-v")[0]
+            elif "_eval_result.jsonl" in os.path.basename(file):
+                model_name = os.path.basename(file).split("_eval_result.jsonl")[0]
+            else:
+                model_name = os.path.basename(file).split(".jsonl")[0]
+
+            for scope, in_scope in scopes.items():
+                by_sample = defaultdict(list)
+                by_item = defaultdict(list)
+                for data in results:
+                    if in_scope(data):
+                        by_sample[data.get("sample_idx", 0)].append(data["pass"])
+                        by_item[data["index"]].append(data["pass"])
+                if not by_item:
+                    continue
+                samples = len(by_sample)
+                rates = [
+                    sum(passes) / len(passes) * 100 for passes in by_sample.values()
+                ]
+                std = statistics.stdev(rates) if samples > 1 else 0.0
+                pass_k = sum(
+                    pass_at_k(len(passes), sum(passes), samples)
+                    for passes in by_item.values()
+                ) / len(by_item)
+                row = [
+                    model_name,
+                    scope,
+                    samples,
+                    round(statistics.mean(rates), 2),
+                    round(std, 2),
+                    round(pass_k * 100, 2),
+                ]
+                writer.writerow(row)
+                rows.append(row)
+
+    return headers, rows
+
+
+def turn_performance(results, stage):
+    """
+    Latency percentiles, throughput, think share and token totals of the
+    ``stage`` (``inference`` or ``judge``) turns of ``results``. Turns with an
+    ``elapsed_time`` of -1 are errors and left out of the latency and
+    throughput, turns that sent no request (elapsed_time 0) are skipped.
+    """
+    turns = 0
+    errors = 0
+    latencies = []
+    first_token_times = []
+    busy_time = 0.0
+    totals = {"input": 0, "think": 0, "response": 0}
+    for data in results:
+        elapsed_times = data.get(f"{stage}_elapsed_time", [])
+        first_tokens = data.get(f"{stage}_first_token_time", [])
+        for turn_idx, elapsed_time in enumerate(elapsed_times):
+            if elapsed_time == 0:
+                continue
+            turns += 1
+            for token_type in totals:
+                tokens = data.get(f"{stage}_{token_type}_tokens", [])
+                if turn_idx < len(tokens):
+                    totals[token_type] += tokens[turn_idx]
+            if elapsed_time == -1:
+                errors += 1
+                continue
+            latencies.append(elapsed_time)
+            busy_time += elapsed_time
+            if turn_idx < len(first_tokens) and first_tokens[turn_idx] >= 0:
+                first_token_times.append(first_tokens[turn_idx])
+
+    output_tokens = totals["think"] + totals["response"]
+    return {
+        "turns": turns,
+        "errors": errors,
+        "error_rate": round(errors / max(turns, 1), 4),
+        "latency_p50": round(percentile(latencies, 50), 3),
+        "latency_p95": round(percentile(latencies, 95), 3),
+        "latency_p99": round(percentile(latencies, 99), 3),
+        # -1 when the turns were not streamed
+        "first_token_time_p50": (
+            round(percentile(first_token_times, 50), 3) if first_token_times else -1
+        ),
+        "output_tokens_per_sec": round(output_tokens / max(busy_time, 1e-9), 2),
+        "think_ratio": round(totals["think"] / max(output_tokens, 1), 4),
+        "input_tokens": totals["input"],
+        "think_tokens": totals["think"],
+        "response_tokens": totals["response"],
+    }
+
+
+def create_performance(target_dir):
+    """
+    Serving performance of every model per stage and scope, written to
+    performance.csv and performance.json.
+    """
+    fields = list(turn_performance([], "inference"))
+    headers = ["Model Name", "Stage", "Scope", *fields]
+    scopes = score_scopes()
+    rows = []
+    report = {}
+
+    output_file = os.path.join(target_dir, "performance.csv")
+
+    with open(output_file, "w", newline="") as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(headers)
+
+        json_files = glob.glob(os.path.join(target_dir, "*.jsonl"))
+        json_files = sorted(json_files)
+
+        for file in json_files:
+            with open(file, "r", encoding="utf-8") as f:
+                results = [json.loads(line) for line in f]
+
+            if "_TRUEBench-v" in os.path.basename(file):
+                model_name = os.path.basename(file).split("_TRUEBench-v")[0]
+            elif "_eval_result.jsonl" in os.path.basename(file):
+                model_name = os.path.basename(file).split("_eval_result.jsonl")[0]
+            else:
+                model_name = os.path.basename(file).split(".jsonl")[0]
+
+            report[model_name] = {}
+            for stage in ("inference", "judge"):
+                report[model_name][stage] = {}
+                for scope, in_scope in scopes.items():
+                    scope_results = [data for data in results if in_scope(data)]
+                    if not scope_results:
+                        continue
+                    performance = turn_performance(scope_results, stage)
+                    report[model_name][stage][scope] = performance
+                    row = [model_name, stage, scope, *performance.values()]
+                    writer.writerow(row)
+                    rows.append(row)
+
+    with open(
+        os.path.join(target_dir, "performance.json"), "w", encoding="utf-8"
+    ) as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+
+    return headers, rows
+
+
 def create_usage(target_dir):
     headers = [
         "Model Name",
@@ -232,11 +456,27 @@ if __name__ == "__main__":
         type=str,
         required=True,
     )
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--profile_sample_path", type=str, default=None)
     args = parser.parse_args()
 
-    cat_headers, cat_data = create_stats(args.target_dir)
-    lang_headers, lang_data = create_stats_lang(args.target_dir)
-    usage_headers, usage_data = create_usage(args.target_dir)
+    profiler = None
+    if args.profile:
+        profiler = Profiler(sample_path=args.profile_sample_path)
+        profiler.start()
+
+    with profile_stage("stats_cat"):
+        cat_headers, cat_data = create_stats(args.target_dir)
+    with profile_stage("stats_lang"):
+        lang_headers, lang_data = create_stats_lang(args.target_dir)
+    with profile_stage("usage"):
+        usage_headers, usage_data = create_usage(args.target_dir)
+    with profile_stage("stats_ci"):
+        create_stats_ci(args.target_dir)
+    with profile_stage("stats_samples"):
+        create_stats_samples(args.target_dir)
+    with profile_stage("performance"):
+        create_performance(args.target_dir)
 
     for cat_scores, lang_scores, token_counts in zip(cat_data, lang_data, usage_data):
         score_cat = dict(zip(cat_headers, cat_scores))
@@ -262,3 +502,7 @@ if __name__ == "__main__":
             args.target_dir + "/" + model_name + ".json", encoding="utf-8", mode="w"
         ) as out_f:
             json.dump(stats, out_f, ensure_ascii=False, indent=4)
+
+    if profiler is not None:
+        profiler.stop()
+        profiler.write(os.path.join(args.target_dir, "profile.json"))
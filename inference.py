@@ -1,45 +1,41 @@
 import argparse
 import jsonlines
 import json
+import os
+import sys
+from collections import defaultdict
 from pathlib import Path
 from utils import get_model_configs, create_directory_if_not_exists
+from estimator import RunHistory, estimate_run, report_estimate
+from fast_eval import stratified_sample
+from scheduler import SCHEDULES, run_scheduled, report_schedule
+from inference_adaptor.profiler import Profiler, profile_stage
+from inference_adaptor.token_counter import TokenCounter
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--config", type=str, required=True)
-    parser.add_argument("--inference_adaptor", type=str, required=True)
-    parser.add_argument("--dataset_path", type=str, required=True)
-    parser.add_argument("--sample_cnt", type=int, default=-1)
-    parser.add_argument("--output_path", type=str, default="results/")
-    args = parser.parse_args()
 
-    output_path = args.output_path
-    dataset_path = Path(args.dataset_path)
-    if dataset_path.suffix == ".jsonl":
-        dataset_path = dataset_path.with_suffix("")
-    sample_cnt = args.sample_cnt
-    model_configs = get_model_configs(args.config)
-    create_directory_if_not_exists(output_path)
-
-    if args.inference_adaptor == "vllm":
+def create_inference_adaptor(inference_adaptor, model_configs):
+    if inference_adaptor == "vllm":
         from inference_adaptor.vllm_adaptor import VllmAdaptor
 
-        inference_adaptor = VllmAdaptor(model_configs)
-    elif args.inference_adaptor == "openai":
+        return VllmAdaptor(model_configs)
+    elif inference_adaptor == "openai":
         from inference_adaptor.openai_adaptor import OpenaiAdaptor
 
-        inference_adaptor = OpenaiAdaptor(model_configs)
-    elif args.inference_adaptor == "vertexai":
+        return OpenaiAdaptor(model_configs)
+    elif inference_adaptor == "vertexai":
         from inference_adaptor.vertexai_adaptor import VertexaiAdaptor
 
-        inference_adaptor = VertexaiAdaptor(model_configs)
-    elif args.inference_adaptor == "anthropic_vertexai":
+        return VertexaiAdaptor(model_configs)
+    elif inference_adaptor == "anthropic_vertexai":
         from inference_adaptor.anthropic_vertexai_adaptor import (
             AnthropicVertexaiAdaptor,
         )
 
-        inference_adaptor = AnthropicVertexaiAdaptor(model_configs)
+        return AnthropicVertexaiAdaptor(model_configs)
+    raise ValueError(f"Unsupported inference adaptor: {inference_adaptor}")
 
+
+def load_dataset(dataset_path, sample_cnt=-1):
     queue = []
     with jsonlines.open(f"{str(dataset_path)}.jsonl") as in_f:
         for input_obj in in_f:
@@ -48,22 +44,155 @@ if __name__ == "__main__":
             queue.append(input_obj)
             if len(queue) == sample_cnt:
                 break
+    return queue
 
-    print(len(queue))
-
-    outputs = inference_adaptor.inference(queue)
 
+def write_results(outputs, output_file):
     for output in outputs:
         output.pop("role", None)
 
-    inference_adaptor.terminate()
-    sorted_outputs = sorted(outputs, key=lambda x: x["index"])
-
-    output_file = output_path + "/" + args.config + "_" + dataset_path.name
+    sorted_outputs = sorted(
+        outputs, key=lambda x: (x["index"], x.get("sample_idx", 0))
+    )
     with open(output_file + ".jsonl", encoding="utf-8", mode="w") as out_f:
         for item in sorted_outputs:
             out_f.write(json.dumps(item, ensure_ascii=False) + "\n")
 
+
+def load_checkpoint(checkpoint_path, num_samples):
+    """
+    Results of the items an interrupted run completed, by index. Items missing
+    some of their samples are left out, they are run again.
+    """
+    outputs = defaultdict(list)
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, encoding="utf-8") as in_f:
+            for line in in_f:
+                try:
+                    output = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line of a killed run may be cut short
+                    continue
+                outputs[output["index"]].append(output)
+    return {
+        index: samples
+        for index, samples in outputs.items()
+        if len(samples) >= num_samples
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--inference_adaptor", type=str, required=True)
+    parser.add_argument("--dataset_path", type=str, required=True)
+    parser.add_argument("--sample_cnt", type=int, default=-1)
+    parser.add_argument("--output_path", type=str, default="results/")
+    parser.add_argument("--metrics_port", type=int, default=-1)
+    parser.add_argument("--metrics_host", type=str, default="127.0.0.1")
+    parser.add_argument("--metrics_textfile", type=str, default=None)
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--profile_sample_path", type=str, default=None)
+    parser.add_argument("--dry_run", action="store_true")
+    parser.add_argument("--history", type=str, nargs="*", default=[])
+    parser.add_argument("--batch", action="store_true")
+    parser.add_argument("--schedule", type=str, default=None, choices=SCHEDULES)
+    parser.add_argument("--fast_eval", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--num_samples", type=int, default=None)
+    args = parser.parse_args()
+
+    profiler = None
+    if args.profile:
+        profiler = Profiler(sample_path=args.profile_sample_path)
+        profiler.start()
+
+    output_path = args.output_path
+    dataset_path = Path(args.dataset_path)
+    if dataset_path.suffix == ".jsonl":
+        dataset_path = dataset_path.with_suffix("")
+    sample_cnt = args.sample_cnt
+    model_configs = get_model_configs(args.config)
+    if args.num_samples:
+        model_configs["num_samples"] = args.num_samples
+    create_directory_if_not_exists(output_path)
+    model_name = args.config
+    if args.fast_eval:
+        model_name += "-fast"
+    output_file = output_path + "/" + model_name + "_" + dataset_path.name
+
+    with profile_stage("load_dataset"):
+        queue = load_dataset(dataset_path, sample_cnt)
+        if args.fast_eval:
+            queue = stratified_sample(queue, args.fast_eval, args.seed)
+
+    print(len(queue))
+
+    if args.dry_run:
+        estimate = estimate_run(
+            queue,
+            model_configs,
+            RunHistory(args.history),
+            TokenCounter(model_configs),
+        )
+        report_estimate(estimate, output_file + "_dry_run.json")
+        sys.exit(0)
+
+    inference_adaptor = create_inference_adaptor(args.inference_adaptor, model_configs)
+    inference_adaptor.metrics.configure(
+        textfile_path=args.metrics_textfile,
+        port=args.metrics_port,
+        host=args.metrics_host,
+    )
+    batch_state_path = output_file + "_batch_state.json"
+    checkpoint_path = output_file + "_partial.jsonl"
+    resumed = []
+    if args.batch:
+        inference_adaptor.enable_batch(batch_state_path)
+    else:
+        completed = load_checkpoint(checkpoint_path, inference_adaptor.num_samples)
+        if completed:
+            print(f"Resuming {checkpoint_path}, {len(completed)} items are done")
+            queue = [item for item in queue if item["index"] not in completed]
+            resumed = [output for outputs in completed.values() for output in outputs]
+        # the incomplete items are dropped from the checkpoint and run again
+        with open(checkpoint_path, encoding="utf-8", mode="w") as out_f:
+            for output in resumed:
+                out_f.write(json.dumps(output, ensure_ascii=False) + "\n")
+        inference_adaptor.enable_checkpoint(checkpoint_path)
+
+    with profile_stage("inference"):
+        if args.schedule:
+            outputs, schedule_report = run_scheduled(
+                inference_adaptor,
+                queue,
+                model_configs,
+                RunHistory(args.history),
+                TokenCounter(model_configs),
+                args.schedule,
+            )
+            report_schedule(schedule_report, output_file + "_schedule.json")
+        else:
+            outputs = inference_adaptor.inference(queue)
+
+    inference_adaptor.terminate()
+
+    with profile_stage("write_results"):
+        write_results(resumed + outputs, output_file)
+    if args.batch:
+        os.remove(batch_state_path)
+    else:
+        inference_adaptor.close_checkpoint()
+        os.remove(checkpoint_path)
+
+    inference_adaptor.metrics.write_summary(output_file + "_metrics.json")
+    inference_adaptor.metrics.close()
+    print(json.dumps(inference_adaptor.metrics.summary(), indent=4))
+
+    if profiler is not None:
+        profiler.stop()
+        profiler.write(output_file + "_profile.json")
+
     print("*" * 50)
     print("done")
     print("*" * 50)
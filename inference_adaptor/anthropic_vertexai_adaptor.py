@@ -1,21 +1,36 @@
-import asyncio
 import re
 import time
 import os
 
 from anthropic import AsyncAnthropicVertex
 from inference_adaptor.base_adaptor import BaseAdaptor
+from inference_adaptor.budget import create_spend_budget
+from inference_adaptor.context_guard import create_context_guard
+from inference_adaptor.endpoint_pool import create_endpoint_pool
+from inference_adaptor.hedging import create_hedger
+from inference_adaptor.metrics import RequestMetrics
+from inference_adaptor.repetition import create_repetition_detector
+
+STRUCTURED_OUTPUT_TOOL = "respond"
 
 
 class AnthropicVertexaiAdaptor(BaseAdaptor):
     def __init__(self, model_configs):
-        self.count = 0
-        self.lock = asyncio.Lock()
+        self.model_configs = model_configs
         self.model_name = model_configs["model_name"]
+        self.metrics = RequestMetrics(self.model_name)
         self.project_id = model_configs["project_id"]
         self.location = model_configs.get("location", "global")
         self.semaphore_cnt = model_configs.get("semaphore_max_count", 16)
+        self.num_samples = model_configs.get("num_samples", 1)
         self.sampling_params = model_configs.get("sampling_params", {})
+        self.repetition_abort = model_configs.get("repetition_abort", None)
+        self.hedger = create_hedger(model_configs.get("hedge", None), self.metrics)
+        self.context_guard = create_context_guard(model_configs)
+        self.budget = create_spend_budget(
+            model_configs.get("budget", None), self.metrics
+        )
+        self.metrics.budget = self.budget
 
         if self.project_id == "your-project-id":
             raise ValueError("please set proper project id")
@@ -35,12 +50,163 @@ class AnthropicVertexaiAdaptor(BaseAdaptor):
     def terminate(self):
         print("terminate Anthropic Vertexai Adaptor")
 
-    async def print_count(self):
-        async with self.lock:
-            self.count += 1
-            print(f"{self.count} tasks are done")
+    def create_client(self, configs):
+        return AsyncAnthropicVertex(
+            project_id=configs["project_id"],
+            region=configs.get("location", "global"),
+        )
+
+    def cache_blocks(self, text, breakpoints):
+        # cache hits are looked up at block boundaries, so every breakpoint
+        # starts a new block and the last one carries the cache_control
+        offsets = [0] + [offset for offset in breakpoints if 0 < offset < len(text)]
+        blocks = [
+            {"type": "text", "text": text[start:end]}
+            for start, end in zip(offsets, offsets[1:] + [len(text)])
+        ]
+        cached_idx = len(blocks) - 1
+        if breakpoints[-1] < len(text):
+            cached_idx -= 1
+        blocks[cached_idx]["cache_control"] = {"type": "ephemeral"}
+        return blocks
+
+    def build_messages(self, request, conversations=None):
+        """
+        Build the ``system`` and ``messages`` parameters of a request, placing
+        ``cache_control`` breakpoints from the ``cache_breakpoints`` hint.
+        Anthropic allows at most 4 breakpoints, so only the latest ones of the
+        conversation are kept. ``conversations`` replaces the accumulated
+        conversation when it was truncated, its messages get no breakpoints.
+        """
+        cache_breakpoints = request.get("cache_breakpoints") or [
+            [] for _ in request["input"]
+        ]
+        system_prompts = []
+        system_breakpoints = []
+        system_cacheable = True
+        for role, message, breakpoints in zip(
+            request["role"], request["input"], cache_breakpoints
+        ):
+            if role != "system":
+                continue
+            offset = len("\n\n".join(system_prompts + [""]))
+            if system_cacheable and breakpoints:
+                system_breakpoints.append(offset + breakpoints[-1])
+            system_cacheable &= bool(breakpoints) and breakpoints[-1] >= len(message)
+            system_prompts.append(message)
+
+        messages = []
+        message_breakpoints = []
+        input_idx = 0
+        truncated = conversations is not None
+        for conv in conversations or request["accumulated_conversations"]:
+            if conv["role"] == "assistant":
+                messages.append(conv)
+                message_breakpoints.append([])
+                continue
+            breakpoints = [] if truncated else cache_breakpoints[input_idx]
+            input_idx += 1
+            if conv["role"] != "system":
+                messages.append(conv)
+                message_breakpoints.append(breakpoints)
+
+        system = "\n\n".join(system_prompts)
+        max_cached = 4
+        if system_breakpoints:
+            system = self.cache_blocks(system, system_breakpoints[-1:])
+            max_cached -= 1
+        cached = [idx for idx, breaks in enumerate(message_breakpoints) if breaks]
+        for idx in cached[-max_cached:]:
+            messages[idx] = {
+                "role": messages[idx]["role"],
+                "content": self.cache_blocks(
+                    messages[idx]["content"], message_breakpoints[idx]
+                ),
+            }
+        return system, messages
+
+    def structured_output_params(self, response_schema):
+        """
+        Request a structured output as a call of a tool taking
+        ``response_schema`` as input. Extended thinking does not allow forcing
+        a tool, the model is then only offered the tool.
+        """
+        tool_choice = {"type": "tool", "name": STRUCTURED_OUTPUT_TOOL}
+        if self.sampling_params.get("thinking", {}).get("type") == "enabled":
+            tool_choice = {"type": "auto"}
+        return {
+            "tools": [
+                {
+                    "name": STRUCTURED_OUTPUT_TOOL,
+                    "description": "Respond with the requested fields.",
+                    "input_schema": response_schema,
+                }
+            ],
+            "tool_choice": tool_choice,
+        }
+
+    async def stream_message(self, client, request, start_time):
+        response_detector = create_repetition_detector(self.repetition_abort)
+        think_detector = create_repetition_detector(self.repetition_abort)
+        response_chunks = []
+        think_chunks = []
+        tool_chunks = []
+        first_token_time = -1
+        repetition_aborted = False
+        async with client.messages.stream(**request) as stream:
+            async for event in stream:
+                if event.type != "content_block_delta":
+                    continue
+                if event.delta.type == "text_delta":
+                    text = event.delta.text
+                    chunks = response_chunks
+                    detector = response_detector
+                elif event.delta.type == "thinking_delta":
+                    text = event.delta.thinking
+                    chunks = think_chunks
+                    detector = think_detector
+                elif event.delta.type == "input_json_delta":
+                    text = event.delta.partial_json
+                    chunks = tool_chunks
+                    detector = response_detector
+                else:
+                    continue
+                if first_token_time < 0:
+                    first_token_time = time.time() - start_time
+                chunks.append(text)
+                if detector is not None and detector.feed(text):
+                    repetition_aborted = True
+                    break
+            # the snapshot holds the usage received so far when aborted
+            api_response = stream.current_message_snapshot
+            if not repetition_aborted:
+                api_response = await stream.get_final_message()
+        return {
+            # a structured output is the input of the tool call
+            "response": "".join(tool_chunks) or "".join(response_chunks),
+            "think": "".join(think_chunks),
+            "usage": api_response.usage,
+            "first_token_time": first_token_time,
+            "repetition_aborted": repetition_aborted,
+        }
 
-    async def send_request(self, client, request):
+    async def stream_hedged(self, request, start_time):
+        async def send(attempt):
+            with self.pool.lease() as endpoint:
+                sent_at = time.time()
+                completion = await self.stream_message(
+                    endpoint.client, request, start_time
+                )
+                endpoint.observe_turn(
+                    time.time() - sent_at, completion["usage"].output_tokens
+                )
+                return completion
+
+        if self.hedger is None:
+            return await send(0)
+        return await self.hedger.run(send)
+
+    async def send_request(self, request):
         MAX_RETRY = 5
         response = ""
         think = ""
@@ -48,21 +214,27 @@ class AnthropicVertexaiAdaptor(BaseAdaptor):
         think_tokens = 0
         response_tokens = 0
         elapsed_time = 99999999
+        first_token_time = -1
+        repetition_aborted = False
+        cached_tokens = 0
         for retry_cnt in range(MAX_RETRY):
             try:
                 start_time = time.time()
-                response = ""
-                think = ""
-                async with client.messages.stream(**request) as stream:
-                    async for text in stream.text_stream:
-                        response += text
-                    api_response = await stream.get_final_message()
+                completion = await self.stream_hedged(request, start_time)
                 elapsed_time = time.time() - start_time
-                if api_response.content[0].type == "thinking":
-                    think = api_response.content[0].thinking
+                response = completion["response"]
+                think = completion["think"]
+                first_token_time = completion["first_token_time"]
+                repetition_aborted = completion["repetition_aborted"]
 
-                usage = api_response.usage
-                input_tokens = usage.input_tokens
+                usage = completion["usage"]
+                # input_tokens only counts the tokens after the last cache breakpoint
+                cached_tokens = getattr(usage, "cache_read_input_tokens", 0) or 0
+                input_tokens = (
+                    usage.input_tokens
+                    + cached_tokens
+                    + (getattr(usage, "cache_creation_input_tokens", 0) or 0)
+                )
                 response_tokens = usage.output_tokens
                 # anthropic vertexai don't give us think token count
                 think_tokens = 0
@@ -72,6 +244,9 @@ class AnthropicVertexaiAdaptor(BaseAdaptor):
                     print("Error is occurred: ", response[:80])
                     print("retry...", retry_cnt + 1)
                 else:
+                    self.metrics.observe_turn(
+                        elapsed_time, input_tokens, response_tokens, cached_tokens
+                    )
                     break
 
             except Exception as e:
@@ -84,6 +259,11 @@ class AnthropicVertexaiAdaptor(BaseAdaptor):
                         f"Anthropic Vertex AI request failed (attempt {retry_cnt + 1}/{MAX_RETRY}): {type(e)}: {e}"
                     )
 
+            if retry_cnt < MAX_RETRY - 1:
+                self.metrics.observe_retry()
+        else:
+            self.metrics.observe_error()
+
         return {
             "response": response,
             "think": think,
@@ -91,70 +271,73 @@ class AnthropicVertexaiAdaptor(BaseAdaptor):
             "input_tokens": input_tokens,
             "think_tokens": think_tokens,
             "response_tokens": response_tokens,
+            "first_token_time": first_token_time,
+            "repetition_aborted": repetition_aborted,
+            "cached_tokens": cached_tokens,
+            "retries": retry_cnt,
         }
 
-    async def process_request(self, semaphore, client, request):
+    async def process_request(self, semaphore, request):
+        queued_at = time.time()
         async with semaphore:
+            started_at = self.metrics.begin_item(queued_at)
             if len(request["role"]) != len(request["input"]):
                 print("Malformed input : length of role and input mismatch")
-            system_prompts = [
-                msg
-                for role, msg in zip(request["role"], request["input"])
-                if role == "system"
-            ]
             for role, message in zip(request["role"], request["input"]):
                 request["accumulated_conversations"].append(
                     {"role": role, "content": message}
                 )
                 if role == "system":
-                    request["response"].append("")
-                    request["think"].append("")
-                    request["input_tokens"].append(0)
-                    request["think_tokens"].append(0)
-                    request["response_tokens"].append(0)
-                    request["elapsed_time"].append(0)
+                    self.append_turn(request)
+                    continue
+
+                fitted = self.fit_context(request)
+                if fitted is None:
+                    response = self.context_exceeded_turn()
                 else:
+                    conversations, truncated_tokens = fitted
+                    system, messages = self.build_messages(
+                        request, conversations if truncated_tokens else None
+                    )
                     completion_request = {
                         "model": self.model_name,
-                        "messages": [
-                            conv
-                            for conv in request["accumulated_conversations"]
-                            if conv["role"] != "system"
-                        ],
+                        "messages": messages,
                     }
-                    if len(system_prompts) > 0:
-                        completion_request["system"] = "\n\n".join(system_prompts)
+                    if len(system) > 0:
+                        completion_request["system"] = system
                     completion_request |= self.sampling_params
-                    response = await self.send_request(client, completion_request)
+                    if request.get("response_schema"):
+                        completion_request |= self.structured_output_params(
+                            request["response_schema"]
+                        )
+                    response = await self.send_request(completion_request)
+                    response["truncated_tokens"] = truncated_tokens
+                    self.observe_context(conversations, response)
 
-                    response_text = response["response"]
-                    if response_text == None:
-                        response_text = "error"
+                response_text = response["response"]
+                if response_text == None:
+                    response_text = "error"
 
-                    request["accumulated_conversations"].append(
-                        {"role": "assistant", "content": response_text}
-                    )
-                    request["response"].append(response_text)
-                    request["think"].append(response["think"])
-                    request["input_tokens"].append(response["input_tokens"])
-                    request["think_tokens"].append(response["think_tokens"])
-                    request["response_tokens"].append(response["response_tokens"])
-                    request["elapsed_time"].append(response["elapsed_time"])
-
-            await self.print_count()
+                request["accumulated_conversations"].append(
+                    {"role": "assistant", "content": response_text}
+                )
+                response["response"] = response_text
+                self.append_turn(request, response)
+
+            self.metrics.end_item(started_at)
         return request
 
-    async def generate(self, request_list):
-        client = AsyncAnthropicVertex(project_id=self.project_id, region=self.location)
-        semaphore = asyncio.Semaphore(self.semaphore_cnt)
-        tasks = [
-            self.process_request(semaphore, client, request) for request in request_list
-        ]
-        responses = await asyncio.gather(*tasks)
-        await client.close()
-        return responses
+    async def start_run(self, total):
+        self.pool = create_endpoint_pool(
+            self.model_configs, self.create_client, "location"
+        )
+        self.metrics.endpoint_pool = self.pool
+        self.metrics.start(total)
+
+    async def finish_run(self):
+        for endpoint in self.pool.endpoints:
+            await endpoint.client.close()
 
     def inference(self, batch):
-        initialized_batch = self.initialize_batch(batch)
-        output = asyncio.run(self.generate(initialized_batch))
+        output = self.run_async(self.inference_async(batch))
         return output
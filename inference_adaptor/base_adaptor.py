@@ -1,4 +1,37 @@
+import asyncio
+import copy
+import json
+import time
+
+from inference_adaptor.budget import BUDGET_EXHAUSTED, BudgetExhausted, BudgetGate
+from inference_adaptor.profiler import get_profiler
+
+# per-turn result fields and the value recorded when a turn sends no request
+TURN_FIELDS = {
+    "response": "",
+    "think": "",
+    "input_tokens": 0,
+    "think_tokens": 0,
+    "response_tokens": 0,
+    "elapsed_time": 0,
+    "first_token_time": -1,
+    "repetition_aborted": False,
+    "cached_tokens": 0,
+    "retries": 0,
+    "truncated_tokens": 0,
+}
+
+
 class BaseAdaptor:
+    batch_runner = None
+    context_guard = None
+    budget = None
+    checkpoint = None
+    num_samples = 1
+    # the adaptor sends the first turn once for all samples and branches the
+    # conversation itself, otherwise every sample is a duplicate request
+    native_samples = False
+
     def __init__(self, model_configs):
         raise NotImplementedError("This method should be implemented.")
 
@@ -24,6 +57,20 @@ class BaseAdaptor:
             Both lists are interpreted position-wise; i.e. ``batch["input"][i]``
             is issued with role ``batch["role"][i]``.
 
+            - ``"cache_breakpoints"`` (List[List[int]], optional)
+                Cache hint parallel to ``batch["input"]``: character offsets
+                in each prompt up to which the text is shared with other
+                requests, in increasing order (e.g. ``[len(prompt)]`` for a
+                common system prompt, ``[]`` for none). The last offset ends
+                the cacheable prefix. Adaptors map it to provider-side prompt
+                caching where supported.
+
+            - ``"response_schema"`` (dict, optional)
+                JSON schema of an object the responses must follow. Adaptors
+                map it to the provider's structured output (OpenAI
+                ``response_format``, Gemini ``response_schema``, an Anthropic
+                tool call) and the response is the JSON text of the object.
+
         Returns
         -------
         result : list
@@ -40,6 +87,16 @@ class BaseAdaptor:
             - ``"think_tokens"``   (List[int])   : Token count of the ``think`` string.
             - ``"response_tokens"``(List[int])   : Token count of the ``response`` string.
             - ``"elapsed_time"``   (List[float]) : Seconds spent processing.
+            - ``"first_token_time"`` (List[float]) : Seconds until the first streamed token, -1 when not streamed.
+            - ``"repetition_aborted"`` (List[bool]) : Whether generation was aborted on degenerate repetition.
+            - ``"cached_tokens"``  (List[int])   : Input tokens served from the provider's prompt cache.
+            - ``"retries"``        (List[int])   : Number of times the turn was resent after a failure.
+            - ``"truncated_tokens"`` (List[int]) : Tokens cut from the conversation to fit ``context_window``.
+
+            With ``num_samples`` > 1 in the model config, every entry yields
+            ``num_samples`` results, each a whole conversation of its own
+            with a ``"sample_idx"`` field, so the result list is
+            ``num_samples`` times longer.
 
         """
         raise NotImplementedError("This method should be implemented.")
@@ -50,13 +107,202 @@ class BaseAdaptor:
             # conserve other data (index, criterias, etc)
             output = input
             output["accumulated_conversations"] = []
-            output["response"] = []
-            output["think"] = []
-            output["input_tokens"] = []
-            output["think_tokens"] = []
-            output["response_tokens"] = []
-            output["elapsed_time"] = []
+            for field in TURN_FIELDS:
+                output[field] = []
             output["role"] = input["role"]
             output["input"] = input["input"]
             output_list.append(output)
+        if self.num_samples > 1 and (
+            not self.native_samples or self.batch_runner is not None
+        ):
+            output_list = [
+                self.sample_copy(output, sample_idx)
+                for output in output_list
+                for sample_idx in range(self.num_samples)
+            ]
         return output_list
+
+    def sample_copy(self, request, sample_idx):
+        """Copy of ``request`` continued as sample ``sample_idx``."""
+        sample = copy.deepcopy(request)
+        sample["sample_idx"] = sample_idx
+        return sample
+
+    def sample_outputs(self, output):
+        """Results of one processed entry, a list when the adaptor branched it."""
+        return output if isinstance(output, list) else [output]
+
+    def append_turn(self, request, turn=None):
+        """Append one turn to the per-turn fields, a system turn when ``turn`` is None."""
+        turn = turn or {}
+        for field, default in TURN_FIELDS.items():
+            request[field].append(turn.get(field, default))
+        return request
+
+    def fit_context(self, request):
+        """
+        Conversation of ``request`` to send, truncated by ``context_guard``.
+        Returns the messages and the number of tokens cut, or None when the
+        conversation cannot fit the context window.
+        """
+        messages = request["accumulated_conversations"]
+        if self.context_guard is None:
+            return messages, 0
+        fitted = self.context_guard.fit(messages)
+        if fitted is None or fitted[1]:
+            self.metrics.observe_truncation(skipped=fitted is None)
+        return fitted
+
+    def context_exceeded_turn(self):
+        # recorded instead of sending a request the provider would reject
+        return {
+            "response": "Context window exceeded : the conversation does not fit "
+            f"{self.context_guard.budget} input tokens",
+            "elapsed_time": -1,
+        }
+
+    def observe_context(self, messages, turn):
+        """Calibrate ``context_guard`` with the input tokens reported for a turn."""
+        if self.context_guard is not None and turn["elapsed_time"] >= 0:
+            self.context_guard.observe(messages, turn["input_tokens"])
+
+    async def start_run(self, total):
+        """Set up clients and metrics for ``total`` requests sent in one event loop."""
+        self.metrics.start(total)
+
+    async def finish_run(self):
+        """Release what ``start_run`` set up."""
+
+    def create_semaphore(self):
+        semaphore = asyncio.Semaphore(self.semaphore_cnt)
+        if self.budget is None:
+            return semaphore
+        return BudgetGate(semaphore, self.budget)
+
+    async def process_item(self, semaphore, request):
+        try:
+            output = await self.process_request(semaphore, request)
+        except BudgetExhausted:
+            return self.budget_skipped(request)
+        self.write_checkpoint(output)
+        return output
+
+    def write_checkpoint(self, output):
+        """Append the results of a completed entry to the checkpoint file."""
+        if self.checkpoint is None:
+            return
+        for item in self.sample_outputs(output):
+            item = {key: value for key, value in item.items() if key != "role"}
+            self.checkpoint.write(json.dumps(item, ensure_ascii=False) + "\n")
+        # a killed run keeps every line written so far
+        self.checkpoint.flush()
+
+    def budget_skipped(self, request):
+        """Record the turns of ``request`` as not sent, the budget being spent."""
+        queued_at = time.time()
+        started_at = self.metrics.begin_item(queued_at)
+        for role in request["role"]:
+            if role == "system":
+                self.append_turn(request)
+            else:
+                self.append_turn(
+                    request, {"response": BUDGET_EXHAUSTED, "elapsed_time": -1}
+                )
+        self.budget.skipped += 1
+        self.metrics.end_item(started_at)
+        if self.native_samples and "sample_idx" not in request:
+            return [
+                self.sample_copy(request, sample_idx)
+                for sample_idx in range(self.num_samples)
+            ]
+        return request
+
+    async def generate(self, request_list):
+        await self.start_run(len(request_list))
+        semaphore = self.create_semaphore()
+        tasks = [self.process_item(semaphore, request) for request in request_list]
+        responses = await asyncio.gather(*tasks)
+        await self.finish_run()
+        return [
+            output for response in responses for output in self.sample_outputs(response)
+        ]
+
+    async def inference_stream(self, requests, total=0):
+        """
+        Async iterator version of ``inference``.
+
+        ``requests`` is any iterable of batch entries (e.g. a generator). At
+        most ``semaphore_max_count`` entries are pulled from it ahead of the
+        finished ones, and each completed result is yielded as soon as it is
+        done, in completion order. Memory is therefore bounded by the
+        concurrency rather than by the number of requests. ``total`` is only
+        used to report progress.
+        """
+        if self.batch_runner is not None:
+            raise ValueError("batch mode needs the whole batch, use inference")
+        await self.start_run(total)
+        semaphore = self.create_semaphore()
+        requests = iter(requests)
+        pending = set()
+        try:
+            while True:
+                while len(pending) < self.semaphore_cnt:
+                    request = next(requests, None)
+                    if request is None:
+                        break
+                    for sample in self.initialize_batch([request]):
+                        pending.add(
+                            asyncio.ensure_future(
+                                self.process_item(semaphore, sample)
+                            )
+                        )
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    for output in self.sample_outputs(task.result()):
+                        yield output
+        finally:
+            for task in pending:
+                task.cancel()
+            await self.finish_run()
+
+    async def inference_async(self, batch):
+        """
+        Coroutine version of ``inference`` for the asynchronous adaptors, so
+        several adaptors can share one event loop.
+        """
+        initialized_batch = self.initialize_batch(batch)
+        if self.batch_runner is not None:
+            return await self.batch_runner.run(initialized_batch)
+        return await self.generate(initialized_batch)
+
+    def enable_checkpoint(self, path):
+        """Append every completed entry to ``path`` as soon as it is done."""
+        self.checkpoint = open(path, encoding="utf-8", mode="a")
+
+    def close_checkpoint(self):
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+            self.checkpoint = None
+
+    def enable_batch(self, state_path):
+        """Send requests through the provider's batch API, resuming from ``state_path``."""
+        if not hasattr(self, "submit_batch"):
+            raise ValueError(f"{type(self).__name__} does not support batch mode")
+        from inference_adaptor.batch_runner import BatchRunner
+
+        self.batch_runner = BatchRunner(self, state_path)
+
+    def run_async(self, coro):
+        """Run ``coro`` to completion, monitoring the event loop when profiling."""
+        return asyncio.run(self._run_monitored(coro))
+
+    async def _run_monitored(self, coro):
+        profiler = get_profiler()
+        if profiler is None:
+            return await coro
+        async with profiler.monitor_loop():
+            return await coro
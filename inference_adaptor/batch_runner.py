@@ -0,0 +1,210 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+from inference_adaptor.base_adaptor import TURN_FIELDS
+
+MAX_RETRY = 5
+# request fields that make up the prompts of a batch run
+REQUEST_KEYS = ["index", "sample_idx", "role", "input", "response_schema"]
+
+
+class BatchRunner:
+    """
+    Send the requests of an adaptor through the provider's batch API.
+
+    Every round submits the next pending turn of each item, a multi-turn item
+    therefore takes one round per turn since later turns need the previous
+    responses. Submitted jobs and collected turns are saved to ``state_path``
+    after every step, so an interrupted run resumes polling its jobs instead
+    of submitting them again.
+
+    The adaptor provides the batch hooks:
+
+    - ``batch_body(request)`` : request body of the next turn of ``request``.
+    - ``submit_batch(entries)`` (async) : submit ``{custom_id: body}`` and
+      return the job id.
+    - ``batch_status(job_id)`` (async) : ``"running"``, ``"completed"`` or
+      ``"failed"``.
+    - ``batch_results(job_id)`` (async) : ``{custom_id: turn}``, where a turn
+      holds the ``TURN_FIELDS`` or an ``"error"`` message.
+    """
+
+    def __init__(self, adaptor, state_path):
+        self.adaptor = adaptor
+        self.state_path = state_path
+        self.poll_interval = getattr(adaptor, "batch_poll_interval", 60)
+        self.max_requests = getattr(adaptor, "batch_max_requests", 50000)
+        self.state = None
+
+    def run_identity(self, request_list):
+        """
+        Identity of a batch run. Results are keyed by the position of the
+        requests, so a state is only resumed for the same prompts and sampling
+        params.
+        """
+        content = json.dumps(
+            {
+                "requests": [
+                    {key: request.get(key) for key in REQUEST_KEYS}
+                    for request in request_list
+                ],
+                "sampling_params": getattr(self.adaptor, "sampling_params", {}),
+            },
+            ensure_ascii=False,
+            sort_keys=True,
+            default=str,
+        )
+        return {
+            "model_name": self.adaptor.model_name,
+            "items": len(request_list),
+            "content_hash": hashlib.sha256(content.encode("utf-8")).hexdigest(),
+        }
+
+    def load_state(self, request_list):
+        run = self.run_identity(request_list)
+        state = {"run": run, "jobs": {}, "results": {}, "failures": {}}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state["run"] != run:
+                raise ValueError(
+                    f"batch state {self.state_path} belongs to another run : "
+                    f"{state['run']}"
+                )
+            print(f"Resuming batch run from {self.state_path}")
+        self.state = state
+
+    def save_state(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False)
+        os.replace(tmp_path, self.state_path)
+
+    def replay(self, idx, request):
+        """
+        Rebuild ``request`` from the collected turns and return the custom id
+        of its next pending turn, or None when every turn is done.
+        """
+        request["accumulated_conversations"] = []
+        for field in TURN_FIELDS:
+            request[field] = []
+        for turn_idx, (role, message) in enumerate(
+            zip(request["role"], request["input"])
+        ):
+            request["accumulated_conversations"].append(
+                {"role": role, "content": message}
+            )
+            if role == "system":
+                self.adaptor.append_turn(request)
+                continue
+            custom_id = f"{idx}-{turn_idx}"
+            turn = self.state["results"].get(custom_id)
+            if turn is None:
+                return custom_id
+            request["accumulated_conversations"].append(
+                {"role": "assistant", "content": turn["response"]}
+            )
+            self.adaptor.append_turn(request, turn)
+        return None
+
+    async def wait_job(self, job_id):
+        while True:
+            status = await self.adaptor.batch_status(job_id)
+            if status != "running":
+                return status
+            await asyncio.sleep(self.poll_interval)
+
+    async def collect(self, job_id):
+        job = self.state["jobs"][job_id]
+        status = await self.wait_job(job_id)
+        results = {}
+        if status == "completed":
+            results = await self.adaptor.batch_results(job_id)
+        elapsed_time = time.time() - job["submitted_at"]
+
+        metrics = self.adaptor.metrics
+        for custom_id in job["custom_ids"]:
+            turn = results.get(custom_id, {"error": f"batch job {status}"})
+            if "error" not in turn:
+                turn["elapsed_time"] = elapsed_time
+                turn["retries"] = self.state["failures"].get(custom_id, 0)
+                self.state["results"][custom_id] = turn
+                metrics.observe_turn(
+                    elapsed_time,
+                    turn["input_tokens"],
+                    turn["think_tokens"] + turn["response_tokens"],
+                    turn.get("cached_tokens", 0),
+                )
+                continue
+
+            failures = self.state["failures"].get(custom_id, 0) + 1
+            self.state["failures"][custom_id] = failures
+            if failures < MAX_RETRY:
+                print(
+                    f"Batch request {custom_id} failed "
+                    f"(attempt {failures}/{MAX_RETRY}): {turn['error']}"
+                )
+                metrics.observe_retry()
+            else:
+                print(f"Max retries reached for batch request {custom_id}")
+                self.state["results"][custom_id] = {
+                    "response": f"Exception occured : {turn['error']}",
+                    "elapsed_time": -1,
+                    "retries": failures - 1,
+                }
+                metrics.observe_error()
+        job["done"] = True
+        self.save_state()
+        print(
+            f"batch job {job_id} {status} : "
+            f"{len(results)}/{len(job['custom_ids'])} requests returned"
+        )
+
+    async def submit(self, entries):
+        custom_ids = list(entries)
+        for start in range(0, len(custom_ids), self.max_requests):
+            chunk = custom_ids[start : start + self.max_requests]
+            job_id = await self.adaptor.submit_batch(
+                {custom_id: entries[custom_id] for custom_id in chunk}
+            )
+            self.state["jobs"][job_id] = {
+                "custom_ids": chunk,
+                "submitted_at": time.time(),
+                "done": False,
+            }
+            self.save_state()
+            print(f"submitted batch job {job_id} with {len(chunk)} requests")
+
+    async def run(self, request_list):
+        self.load_state(request_list)
+        metrics = self.adaptor.metrics
+        metrics.start(len(request_list))
+        run_start = time.time()
+        started_at = [metrics.begin_item(run_start) for _ in request_list]
+        finished = [False] * len(request_list)
+
+        round_cnt = 0
+        while True:
+            pending_jobs = [
+                job_id for job_id, job in self.state["jobs"].items() if not job["done"]
+            ]
+            await asyncio.gather(*[self.collect(job_id) for job_id in pending_jobs])
+
+            entries = {}
+            for idx, request in enumerate(request_list):
+                custom_id = self.replay(idx, request)
+                if custom_id is not None:
+                    entries[custom_id] = self.adaptor.batch_body(request)
+                elif not finished[idx]:
+                    finished[idx] = True
+                    metrics.end_item(started_at[idx])
+            if not entries:
+                break
+
+            round_cnt += 1
+            print(f"batch round {round_cnt} : {len(entries)} requests")
+            await self.submit(entries)
+        return request_list
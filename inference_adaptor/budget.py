@@ -0,0 +1,186 @@
+import asyncio
+
+# list prices in USD per million tokens, looked up by the longest prefix of
+# the model name. Override them with ``price`` when they do not apply.
+# ``cached_input`` prices the input tokens read from the prompt cache and
+# falls back to ``input`` when it is not given.
+PRICES = {
+    "gpt-5": {"input": 1.25, "cached_input": 0.125, "output": 10.0},
+    "gpt-5-mini": {"input": 0.25, "cached_input": 0.025, "output": 2.0},
+    "gpt-5-nano": {"input": 0.05, "cached_input": 0.005, "output": 0.4},
+    "gpt-4.1": {"input": 2.0, "cached_input": 0.5, "output": 8.0},
+    "gpt-4.1-mini": {"input": 0.4, "cached_input": 0.1, "output": 1.6},
+    "gpt-4.1-nano": {"input": 0.1, "cached_input": 0.025, "output": 0.4},
+    "gpt-4o": {"input": 2.5, "cached_input": 1.25, "output": 10.0},
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.6},
+    "o3": {"input": 2.0, "cached_input": 0.5, "output": 8.0},
+    "o4-mini": {"input": 1.1, "cached_input": 0.275, "output": 4.4},
+    "gemini-2.5-pro": {"input": 1.25, "cached_input": 0.125, "output": 10.0},
+    "gemini-2.5-flash": {"input": 0.3, "cached_input": 0.03, "output": 2.5},
+    "gemini-2.5-flash-lite": {"input": 0.1, "cached_input": 0.01, "output": 0.4},
+    "claude-opus-4": {"input": 15.0, "cached_input": 1.5, "output": 75.0},
+    "claude-sonnet-4": {"input": 3.0, "cached_input": 0.3, "output": 15.0},
+    "claude-3-5-haiku": {"input": 0.8, "cached_input": 0.08, "output": 4.0},
+}
+BUDGET_EXHAUSTED = "Budget exhausted : the request was not sent"
+
+
+class BudgetExhausted(Exception):
+    pass
+
+
+def lookup_price(model_name):
+    """Price of the longest ``PRICES`` prefix of ``model_name``, None when unknown."""
+    model_name = model_name.lower().split("/")[-1]
+    prefixes = [prefix for prefix in PRICES if model_name.startswith(prefix)]
+    if not prefixes:
+        return None
+    return PRICES[max(prefixes, key=len)]
+
+
+class SpendBudget:
+    """
+    Token and cost limits of one run, checked against the input and output
+    tokens reported to ``metrics``. Output tokens include the think tokens.
+
+    Once ``throttle_ratio`` of a limit is used, new items start one at a time,
+    so that the items in flight overshoot the limit as little as possible.
+    When a limit is reached, new items are not started any more.
+    """
+
+    def __init__(
+        self,
+        metrics,
+        max_input_tokens=None,
+        max_output_tokens=None,
+        max_cost=None,
+        price=None,
+        throttle_ratio=0.9,
+    ):
+        self.metrics = metrics
+        self.max_input_tokens = max_input_tokens
+        self.max_output_tokens = max_output_tokens
+        self.max_cost = max_cost
+        self.price = price
+        if self.price is None:
+            self.price = lookup_price(metrics.model_name)
+        if max_cost is not None and self.price is None:
+            raise ValueError(
+                f"No price for {metrics.model_name}, set price in the budget config"
+            )
+        self.throttle_ratio = throttle_ratio
+        self.reset()
+
+    def reset(self):
+        self.skipped = 0
+        self.announced = False
+
+    def cost(self):
+        if self.price is None:
+            return 0.0
+        cached_tokens = self.metrics.cached_tokens
+        return (
+            (self.metrics.input_tokens - cached_tokens) * self.price["input"]
+            + cached_tokens * self.price.get("cached_input", self.price["input"])
+            + self.metrics.output_tokens * self.price["output"]
+        ) / 1e6
+
+    def used(self):
+        """Largest share of a limit used so far."""
+        shares = [0.0]
+        for spent, limit in [
+            (self.metrics.input_tokens, self.max_input_tokens),
+            (self.metrics.output_tokens, self.max_output_tokens),
+            (self.cost(), self.max_cost),
+        ]:
+            if limit is not None:
+                shares.append(spent / limit if limit > 0 else 1.0)
+        return max(shares)
+
+    def throttled(self):
+        return self.used() >= self.throttle_ratio
+
+    def exhausted(self):
+        exhausted = self.used() >= 1.0
+        if exhausted and not self.announced:
+            self.announced = True
+            print(
+                f"Budget exhausted ({self.progress()}), new items are not started. "
+                "Rerun them with rerun_failed.py once the budget is raised."
+            )
+        return exhausted
+
+    def projection(self):
+        """Input tokens, output tokens and cost of the run if every item is done."""
+        # skipped items count as remaining, they still have to be run
+        completed = self.metrics.done - self.skipped
+        scale = self.metrics.total / completed if completed > 0 else 1.0
+        return (
+            int(self.metrics.input_tokens * scale),
+            int(self.metrics.output_tokens * scale),
+            self.cost() * scale,
+        )
+
+    def progress(self):
+        _, _, projected_cost = self.projection()
+        return (
+            f"budget used {self.used():.1%}, "
+            f"spent ${self.cost():.2f}, projected ${projected_cost:.2f}"
+        )
+
+    def report(self):
+        projected_input_tokens, projected_output_tokens, projected_cost = (
+            self.projection()
+        )
+        return {
+            "max_input_tokens": self.max_input_tokens,
+            "max_output_tokens": self.max_output_tokens,
+            "max_cost": self.max_cost,
+            "price": self.price,
+            "used": round(self.used(), 4),
+            "cost": round(self.cost(), 4),
+            "skipped_items": self.skipped,
+            "projected_input_tokens": projected_input_tokens,
+            "projected_output_tokens": projected_output_tokens,
+            "projected_cost": round(projected_cost, 4),
+        }
+
+
+class BudgetGate:
+    """
+    Stand-in for the semaphore passed to ``process_request`` that only starts
+    items while ``budget`` lasts, one at a time once it is throttled. Raises
+    ``BudgetExhausted`` instead of starting an item when it is spent.
+    """
+
+    def __init__(self, semaphore, budget):
+        self.semaphore = semaphore
+        self.budget = budget
+        self.throttle = asyncio.Lock()
+        self.throttled_tasks = set()
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        if not self.budget.exhausted() and self.budget.throttled():
+            await self.throttle.acquire()
+            self.throttled_tasks.add(asyncio.current_task())
+        if self.budget.exhausted():
+            self.release()
+            raise BudgetExhausted()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def release(self):
+        task = asyncio.current_task()
+        if task in self.throttled_tasks:
+            self.throttled_tasks.discard(task)
+            self.throttle.release()
+        self.semaphore.release()
+
+
+def create_spend_budget(config, metrics):
+    """Build a budget from the ``budget`` config, None when it is not set."""
+    if not config:
+        return None
+    return SpendBudget(metrics, **config)
@@ -0,0 +1,115 @@
+from inference_adaptor.token_counter import TokenCounter
+
+CONTEXT_POLICIES = ["oldest_turns", "center"]
+# sampling params capping the completion, by provider
+RESERVE_PARAMS = ["max_completion_tokens", "max_tokens", "max_output_tokens"]
+# room left for re-tokenization differences when cutting a message
+CUT_MARGIN = 8
+
+
+class ContextGuard:
+    """
+    Preflight check of a conversation against the context window of a model.
+
+    The prompt has to leave ``reserve_tokens`` of ``context_window`` for the
+    completion. It is counted with ``counter``, scaled by the ratio of the
+    input tokens reported by the provider to the counted ones, so estimated
+    counts get calibrated as turns complete. A conversation that does not fit
+    is truncated according to ``policy``:
+
+    - ``oldest_turns`` : drop the oldest user and assistant turns, then cut
+      the center of the last message when it alone is still too long.
+    - ``center`` : keep every turn and cut the center of the last message,
+      like the ``max_user_input_tokens`` guard of the vllm adaptor. Falls back
+      to ``oldest_turns`` when the other turns leave no room for it.
+
+    System messages and the last message are always kept.
+    """
+
+    def __init__(
+        self, counter, context_window, reserve_tokens=0, policy="oldest_turns"
+    ):
+        if policy not in CONTEXT_POLICIES:
+            raise ValueError(f"Unsupported context policy: {policy}")
+        self.counter = counter
+        self.budget = context_window - reserve_tokens
+        self.policy = policy
+        self.counted_tokens = 0
+        self.reported_tokens = 0
+
+    def scale(self):
+        if not self.counted_tokens or not self.reported_tokens:
+            return 1.0
+        return self.reported_tokens / self.counted_tokens
+
+    def observe(self, messages, input_tokens):
+        """Calibrate the counts with the ``input_tokens`` reported for ``messages``."""
+        if input_tokens > 0:
+            self.counted_tokens += self.counter.count_messages(messages)
+            self.reported_tokens += input_tokens
+
+    def fit(self, messages):
+        """
+        Truncate ``messages`` to the budget. Returns the messages to send and
+        the number of tokens cut, or None when the system messages and the
+        last message cannot fit even with the last message cut.
+        """
+        limit = int(self.budget / self.scale())
+        total = self.counter.count_messages(messages)
+        if total <= limit:
+            return messages, 0
+
+        candidates = [self.drop_oldest(messages, limit)]
+        if self.policy == "center":
+            candidates.insert(0, messages)
+        for candidate in candidates:
+            candidate = self.cut_last(candidate, limit)
+            tokens = self.counter.count_messages(candidate)
+            if tokens <= limit:
+                return candidate, int((total - tokens) * self.scale())
+        return None
+
+    def drop_oldest(self, messages, limit):
+        system = [message for message in messages if message["role"] == "system"]
+        turns = [message for message in messages if message["role"] != "system"]
+        sizes = [self.counter.count_messages([message]) for message in turns]
+        tokens = self.counter.count_messages(system) + sum(sizes)
+        # a conversation has to start with a user turn
+        while len(turns) > 1 and (tokens > limit or turns[0]["role"] != "user"):
+            tokens -= sizes.pop(0)
+            turns = turns[1:]
+        return system + turns
+
+    def cut_last(self, messages, limit):
+        # leaves messages that already fit as they are
+        last = messages[-1]
+        room = (
+            limit
+            - self.counter.count_messages(messages[:-1])
+            - self.counter.count_messages([last | {"content": ""}])
+            - CUT_MARGIN
+        )
+        if room <= 0:
+            return messages
+        content = self.counter.truncate_center(last["content"], room)
+        return messages[:-1] + [last | {"content": content}]
+
+
+def create_context_guard(model_configs):
+    """Build a guard from the ``context_window`` config, None when it is not set."""
+    context_window = model_configs.get("context_window")
+    if not context_window:
+        return None
+    reserve_tokens = model_configs.get("context_reserve_tokens")
+    if reserve_tokens is None:
+        sampling_params = model_configs.get("sampling_params", {})
+        reserve_tokens = next(
+            (sampling_params[key] for key in RESERVE_PARAMS if key in sampling_params),
+            0,
+        )
+    return ContextGuard(
+        TokenCounter(model_configs),
+        context_window,
+        reserve_tokens,
+        model_configs.get("context_policy", "oldest_turns"),
+    )
@@ -0,0 +1,123 @@
+import contextlib
+import time
+
+from inference_adaptor.metrics import percentile
+
+
+class Endpoint:
+    def __init__(self, name, client, weight=1.0):
+        self.name = name
+        self.client = client
+        self.weight = weight
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.latency = []
+        self.output_tokens = 0
+
+    def observe_turn(self, latency, output_tokens):
+        self.consecutive_failures = 0
+        self.latency.append(latency)
+        self.output_tokens += output_tokens or 0
+
+
+class EndpointPool:
+    """
+    Balance requests over several endpoints of the same model.
+
+    Each request goes to the healthy endpoint with the least outstanding
+    requests relative to its weight. An endpoint failing ``eject_failures``
+    times in a row is ejected for ``eject_seconds``. When every endpoint is
+    ejected, the one coming back first is used.
+    """
+
+    def __init__(self, endpoints, eject_failures=3, eject_seconds=30.0):
+        self.endpoints = endpoints
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self.start_time = time.time()
+
+    def acquire(self):
+        now = time.time()
+        healthy = [ep for ep in self.endpoints if ep.ejected_until <= now]
+        if healthy:
+            endpoint = min(healthy, key=lambda ep: (ep.outstanding + 1) / ep.weight)
+        else:
+            endpoint = min(self.endpoints, key=lambda ep: ep.ejected_until)
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        return endpoint
+
+    def release(self, endpoint):
+        endpoint.outstanding -= 1
+
+    def observe_failure(self, endpoint):
+        endpoint.failures += 1
+        if endpoint.ejected_until > time.time():
+            # requests sent before the ejection are still failing
+            return
+        endpoint.consecutive_failures += 1
+        if endpoint.consecutive_failures >= self.eject_failures:
+            endpoint.consecutive_failures = 0
+            endpoint.ejections += 1
+            endpoint.ejected_until = time.time() + self.eject_seconds
+            print(f"Endpoint {endpoint.name} ejected for {self.eject_seconds}s")
+
+    @contextlib.contextmanager
+    def lease(self):
+        """Hold an endpoint for one request, counting a failure when it raises."""
+        endpoint = self.acquire()
+        try:
+            yield endpoint
+        except Exception:
+            self.observe_failure(endpoint)
+            raise
+        finally:
+            self.release(endpoint)
+
+    def report(self):
+        wall_time = max(time.time() - self.start_time, 1e-9)
+        return [
+            {
+                "name": ep.name,
+                "weight": ep.weight,
+                "requests": ep.requests,
+                "failures": ep.failures,
+                "ejections": ep.ejections,
+                "outstanding": ep.outstanding,
+                "latency_p50": round(percentile(ep.latency, 50), 3),
+                "latency_p95": round(percentile(ep.latency, 95), 3),
+                "output_tokens": ep.output_tokens,
+                "output_tokens_per_sec": round(ep.output_tokens / wall_time, 2),
+            }
+            for ep in self.endpoints
+        ]
+
+
+def endpoint_configs(model_configs):
+    """
+    Per-endpoint configs: each entry of ``"endpoints"`` overrides the
+    connection fields (e.g. ``base_url``, ``api_key``, ``location``) of the
+    model config. Without ``"endpoints"``, the model config is the only one.
+    """
+    endpoints = model_configs.get("endpoints") or [{}]
+    return [model_configs | endpoint for endpoint in endpoints]
+
+
+def create_endpoint_pool(model_configs, create_client, name_field):
+    endpoints = [
+        Endpoint(
+            configs.get(name_field, ""),
+            create_client(configs),
+            configs.get("weight", 1.0),
+        )
+        for configs in endpoint_configs(model_configs)
+    ]
+    return EndpointPool(
+        endpoints,
+        eject_failures=model_configs.get("endpoint_eject_failures", 3),
+        eject_seconds=model_configs.get("endpoint_eject_seconds", 30.0),
+    )
@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+from collections import deque
+
+from inference_adaptor.metrics import percentile
+
+
+class Hedger:
+    """
+    Send a duplicate request when a call is slower than the ``percentile`` of
+    recently observed latencies, and keep whichever finishes first.
+
+    Hedging starts after ``min_samples`` latencies are observed, waits at
+    least ``min_delay`` seconds and sends at most ``max_ratio`` duplicates per
+    request.
+    """
+
+    def __init__(
+        self,
+        metrics,
+        percentile=95,
+        min_samples=20,
+        min_delay=1.0,
+        max_ratio=0.05,
+        window=1000,
+    ):
+        self.metrics = metrics
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.latency = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+
+    def delay(self):
+        if len(self.latency) < self.min_samples:
+            return None
+        if self.hedges + 1 > self.max_ratio * self.requests:
+            return None
+        return max(percentile(list(self.latency), self.percentile), self.min_delay)
+
+    async def run(self, send):
+        """
+        Await ``send(attempt)``, hedged with ``send(1)`` when the first
+        attempt ``send(0)`` is too slow. The losing attempt is cancelled.
+        """
+        self.requests += 1
+        start_time = time.time()
+        tasks = [asyncio.ensure_future(send(0))]
+        primary = tasks[0]
+        try:
+            delay = self.delay()
+            if delay is not None:
+                await asyncio.wait([primary], timeout=delay)
+            if primary.done() or delay is None or self.delay() is None:
+                result = await primary
+                self.latency.append(time.time() - start_time)
+                return result
+
+            self.hedges += 1
+            hedge = asyncio.ensure_future(send(1))
+            tasks.append(hedge)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                # prefer a successful attempt, raise only when both failed
+                for task in done:
+                    if task.exception() is None:
+                        self.metrics.observe_hedge(won=task is hedge)
+                        self.latency.append(time.time() - start_time)
+                        return task.result()
+            self.metrics.observe_hedge(won=False)
+            return await primary
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+
+def create_hedger(config, metrics):
+    """Build a hedger from the ``hedge`` config, None when disabled."""
+    if not config:
+        return None
+    if config is True:
+        return Hedger(metrics)
+    return Hedger(metrics, **config)
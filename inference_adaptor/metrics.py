@@ -0,0 +1,269 @@
+import json
+import os
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = [0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800]
+PROGRESS_INTERVAL = 10.0
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+class RequestMetrics:
+    """
+    Request-level metrics shared by all inference adaptors.
+
+    An *item* is one entry of the batch (a whole conversation) and a *turn* is
+    one call to the serving backend. Queue wait is the time an item waits for
+    a concurrency slot, service time is the time it holds one.
+    """
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.lock = threading.Lock()
+        self.textfile_path = None
+        self.server = None
+        self.endpoint_pool = None
+        self.budget = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.total = 0
+            self.done = 0
+            self.in_flight = 0
+            self.retries = 0
+            self.errors = 0
+            self.hedges = 0
+            self.hedge_wins = 0
+            self.truncations = 0
+            self.context_skips = 0
+            self.queue_wait = []
+            self.service_time = []
+            self.latency = []
+            self.input_tokens = 0
+            self.cached_tokens = 0
+            self.output_tokens = 0
+            self.start_time = time.time()
+            self.end_time = None
+            self.last_progress = 0.0
+
+    def configure(self, textfile_path=None, port=None, host="127.0.0.1"):
+        self.textfile_path = textfile_path
+        if port is not None and port >= 0 and self.server is None:
+            self.serve(port, host)
+
+    def start(self, total):
+        self.reset()
+        with self.lock:
+            self.total = total
+        if self.budget is not None:
+            self.budget.reset()
+
+    def begin_item(self, queued_at):
+        started_at = time.time()
+        with self.lock:
+            self.queue_wait.append(started_at - queued_at)
+            self.in_flight += 1
+        return started_at
+
+    def end_item(self, started_at):
+        now = time.time()
+        with self.lock:
+            self.service_time.append(now - started_at)
+            self.in_flight -= 1
+            self.done += 1
+            finished = self.done == self.total
+            if finished:
+                self.end_time = now
+            report = finished or now - self.last_progress >= PROGRESS_INTERVAL
+            if report:
+                self.last_progress = now
+        if report:
+            print(f"{self.done}/{self.total} tasks are done")
+            if self.budget is not None:
+                print(self.budget.progress())
+            self.write_textfile()
+
+    def observe_turn(self, latency, input_tokens, output_tokens, cached_tokens=0):
+        # input_tokens include the cached_tokens read from the prompt cache
+        with self.lock:
+            if latency >= 0:
+                self.latency.append(latency)
+            self.input_tokens += input_tokens or 0
+            self.cached_tokens += cached_tokens or 0
+            self.output_tokens += output_tokens or 0
+
+    def observe_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def observe_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def observe_hedge(self, won):
+        with self.lock:
+            self.hedges += 1
+            self.hedge_wins += int(won)
+
+    def observe_truncation(self, skipped):
+        with self.lock:
+            if skipped:
+                self.context_skips += 1
+            else:
+                self.truncations += 1
+
+    def endpoints(self):
+        # per-endpoint stats, only when requests are balanced over several
+        if self.endpoint_pool is None or len(self.endpoint_pool.endpoints) < 2:
+            return []
+        return self.endpoint_pool.report()
+
+    def summary(self):
+        endpoints = self.endpoints()
+        with self.lock:
+            end_time = self.end_time if self.end_time else time.time()
+            wall_time = max(end_time - self.start_time, 1e-9)
+            summary = {
+                "model_name": self.model_name,
+                "total": self.total,
+                "done": self.done,
+                "in_flight": self.in_flight,
+                "retries": self.retries,
+                "errors": self.errors,
+                "hedges": self.hedges,
+                "hedge_win_rate": round(self.hedge_wins / max(self.hedges, 1), 3),
+                "truncations": self.truncations,
+                "context_skips": self.context_skips,
+                "wall_time": round(wall_time, 3),
+                "input_tokens": self.input_tokens,
+                "cached_tokens": self.cached_tokens,
+                "output_tokens": self.output_tokens,
+                "input_tokens_per_sec": round(self.input_tokens / wall_time, 2),
+                "output_tokens_per_sec": round(self.output_tokens / wall_time, 2),
+                "latency": self._distribution(self.latency),
+                "queue_wait": self._distribution(self.queue_wait),
+                "service_time": self._distribution(self.service_time),
+            }
+        if endpoints:
+            summary["endpoints"] = endpoints
+        if self.budget is not None:
+            summary["budget"] = self.budget.report()
+        return summary
+
+    def _distribution(self, values):
+        return {
+            "count": len(values),
+            "mean": round(sum(values) / len(values), 3) if values else 0.0,
+            "p50": round(percentile(values, 50), 3),
+            "p95": round(percentile(values, 95), 3),
+            "p99": round(percentile(values, 99), 3),
+            "max": round(max(values), 3) if values else 0.0,
+        }
+
+    def to_prometheus(self):
+        label = f'model="{self.model_name}"'
+        with self.lock:
+            lines = [
+                "# TYPE truebench_items_total gauge",
+                f"truebench_items_total{{{label}}} {self.total}",
+                "# TYPE truebench_items_done counter",
+                f"truebench_items_done{{{label}}} {self.done}",
+                "# TYPE truebench_items_in_flight gauge",
+                f"truebench_items_in_flight{{{label}}} {self.in_flight}",
+                "# TYPE truebench_retries_total counter",
+                f"truebench_retries_total{{{label}}} {self.retries}",
+                "# TYPE truebench_errors_total counter",
+                f"truebench_errors_total{{{label}}} {self.errors}",
+                "# TYPE truebench_hedges_total counter",
+                f"truebench_hedges_total{{{label}}} {self.hedges}",
+                "# TYPE truebench_hedge_wins_total counter",
+                f"truebench_hedge_wins_total{{{label}}} {self.hedge_wins}",
+                "# TYPE truebench_truncations_total counter",
+                f"truebench_truncations_total{{{label}}} {self.truncations}",
+                "# TYPE truebench_context_skips_total counter",
+                f"truebench_context_skips_total{{{label}}} {self.context_skips}",
+                "# TYPE truebench_input_tokens_total counter",
+                f"truebench_input_tokens_total{{{label}}} {self.input_tokens}",
+                "# TYPE truebench_cached_tokens_total counter",
+                f"truebench_cached_tokens_total{{{label}}} {self.cached_tokens}",
+                "# TYPE truebench_output_tokens_total counter",
+                f"truebench_output_tokens_total{{{label}}} {self.output_tokens}",
+            ]
+            for name, values in [
+                ("truebench_turn_latency_seconds", self.latency),
+                ("truebench_queue_wait_seconds", self.queue_wait),
+                ("truebench_service_time_seconds", self.service_time),
+            ]:
+                lines.append(f"# TYPE {name} histogram")
+                for bucket in LATENCY_BUCKETS:
+                    count = sum(1 for value in values if value <= bucket)
+                    lines.append(f'{name}_bucket{{{label},le="{bucket}"}} {count}')
+                lines.append(f'{name}_bucket{{{label},le="+Inf"}} {len(values)}')
+                lines.append(f"{name}_sum{{{label}}} {sum(values)}")
+                lines.append(f"{name}_count{{{label}}} {len(values)}")
+        endpoints = self.endpoints()
+        for name, field in [
+            ("truebench_endpoint_outstanding", "outstanding"),
+            ("truebench_endpoint_requests_total", "requests"),
+            ("truebench_endpoint_failures_total", "failures"),
+        ]:
+            if endpoints:
+                kind = "gauge" if field == "outstanding" else "counter"
+                lines.append(f"# TYPE {name} {kind}")
+            for endpoint in endpoints:
+                lines.append(
+                    f'{name}{{{label},endpoint="{endpoint["name"]}"}} {endpoint[field]}'
+                )
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path=None):
+        path = path or self.textfile_path
+        if not path:
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def write_summary(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=4)
+
+    def serve(self, port, host="127.0.0.1"):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        print(f"Serving metrics on http://{host}:{self.server.server_address[1]}")
+
+    def close(self):
+        self.write_textfile()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -1,21 +1,43 @@
 import asyncio
+import json
 import openai
 import re
 import time
 
 from inference_adaptor.base_adaptor import BaseAdaptor
+from inference_adaptor.budget import create_spend_budget
+from inference_adaptor.context_guard import create_context_guard
+from inference_adaptor.endpoint_pool import create_endpoint_pool, endpoint_configs
+from inference_adaptor.hedging import create_hedger
+from inference_adaptor.metrics import RequestMetrics
+from inference_adaptor.repetition import create_repetition_detector
 from transformers import AutoTokenizer
 
 
 class OpenaiAdaptor(BaseAdaptor):
     def __init__(self, model_configs):
-        self.count = 0
-        self.lock = asyncio.Lock()
         self.serving_type = model_configs["serving_type"]
         self.model_name = model_configs["model_name"]
+        self.metrics = RequestMetrics(self.model_name)
         self.response_prefix = model_configs.get("response_prefix", "")
         self.sampling_params = model_configs.get("sampling_params", {})
         self.semaphore_cnt = model_configs.get("semaphore_max_count", 16)
+        self.repetition_abort = model_configs.get("repetition_abort", None)
+        self.stream = model_configs.get("stream", False) or bool(self.repetition_abort)
+        self.num_samples = model_configs.get("num_samples", 1)
+        # streamed choices are not told apart, streamed samples are duplicates
+        self.native_samples = self.num_samples > 1 and not self.stream
+        self.hedger = create_hedger(model_configs.get("hedge", None), self.metrics)
+        self.context_guard = create_context_guard(model_configs)
+        self.budget = create_spend_budget(
+            model_configs.get("budget", None), self.metrics
+        )
+        self.metrics.budget = self.budget
+        self.batch_poll_interval = model_configs.get("batch_poll_interval", 60)
+        self.batch_completion_window = model_configs.get(
+            "batch_completion_window", "24h"
+        )
+        self.batch_max_requests = model_configs.get("batch_max_requests", 50000)
         self.tokenizer_path = model_configs.get("tokenizer_path", "")
         self.tokenizer = None
         if self.tokenizer_path != "":
@@ -28,34 +50,150 @@ class OpenaiAdaptor(BaseAdaptor):
         else:
             self.chat_template_kwargs = None
 
+        if self.serving_type not in ("azure", "openai"):
+            raise ValueError(f"Unsupported serving type: {self.serving_type}")
+        self.model_configs = model_configs
+        # batch jobs and their files live on the first endpoint
+        self.client = self.create_client(endpoint_configs(model_configs)[0])
+
+    def create_client(self, configs):
         if self.serving_type == "azure":
-            if "api_version" in model_configs:
-                api_version = model_configs["api_version"]
+            if "api_version" in configs:
+                api_version = configs["api_version"]
             else:
                 api_version = "2025-03-01-preview"
 
-            self.client = openai.AsyncAzureOpenAI(
-                azure_endpoint=model_configs["base_url"],
-                api_key=model_configs["api_key"],
+            return openai.AsyncAzureOpenAI(
+                azure_endpoint=configs["base_url"],
+                api_key=configs["api_key"],
                 api_version=api_version,
                 timeout=300.0,
                 max_retries=4,
             )
-        elif self.serving_type == "openai":
-            self.client = openai.AsyncOpenAI(
-                base_url=model_configs["base_url"],
-                api_key=model_configs["api_key"],
-            )
-        else:
-            raise ValueError(f"Unsupported serving type: {self.serving_type}")
+        return openai.AsyncOpenAI(
+            base_url=configs["base_url"],
+            api_key=configs["api_key"],
+        )
 
     def terminate(self):
         print("terminate OpenAI Adaptor")
 
-    async def print_count(self):
-        async with self.lock:
-            self.count += 1
-            print(f"{self.count} tasks are done")
+    async def complete(self, client, request):
+        api_response = await client.chat.completions.create(**request)
+        return self.parse_completion(api_response)
+
+    def parse_completion(self, api_response):
+        message = api_response.choices[0].message
+        think = ""
+        if hasattr(message, "reasoning_content"):
+            think = message.reasoning_content
+        choices = [
+            {
+                "response": choice.message.content,
+                "think": getattr(choice.message, "reasoning_content", "") or "",
+            }
+            for choice in api_response.choices
+        ]
+
+        usage = api_response.usage
+        details = getattr(usage, "completion_tokens_details", None)
+        return {
+            "response": message.content,
+            "think": think,
+            "input_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+            "think_tokens": getattr(details, "reasoning_tokens", 0),
+            "cached_tokens": self.cached_tokens(usage),
+            "choices": choices,
+        }
+
+    def cached_tokens(self, usage):
+        # prompts sharing a prefix of 1024+ tokens are cached automatically
+        details = getattr(usage, "prompt_tokens_details", None)
+        return getattr(details, "cached_tokens", 0) or 0
+
+    async def stream_complete(self, client, request, start_time):
+        response_detector = create_repetition_detector(self.repetition_abort)
+        think_detector = create_repetition_detector(self.repetition_abort)
+        response_chunks = []
+        think_chunks = []
+        first_token_time = -1
+        repetition_aborted = False
+        usage = None
+
+        stream = await client.chat.completions.create(
+            **request, stream=True, stream_options={"include_usage": True}
+        )
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            text = delta.content or ""
+            think = getattr(delta, "reasoning_content", None) or ""
+            if (text or think) and first_token_time < 0:
+                first_token_time = time.time() - start_time
+            response_chunks.append(text)
+            think_chunks.append(think)
+            if response_detector is not None and (
+                response_detector.feed(text) or think_detector.feed(think)
+            ):
+                repetition_aborted = True
+                await stream.close()
+                break
+
+        response = "".join(response_chunks)
+        think = "".join(think_chunks)
+        if usage is not None:
+            details = getattr(usage, "completion_tokens_details", None)
+            input_tokens = usage.prompt_tokens
+            completion_tokens = usage.completion_tokens
+            think_tokens = getattr(details, "reasoning_tokens", 0)
+            cached_tokens = self.cached_tokens(usage)
+        else:
+            # aborted streams end before the usage chunk, the prompt is billed
+            # all the same
+            input_tokens = sum(
+                self.count_tokens(message["content"]) for message in request["messages"]
+            )
+            cached_tokens = 0
+            think_tokens = self.count_tokens(think)
+            completion_tokens = think_tokens + self.count_tokens(response)
+        return {
+            "response": response,
+            "think": think,
+            "input_tokens": input_tokens,
+            "completion_tokens": completion_tokens,
+            "think_tokens": think_tokens or 0,
+            "first_token_time": first_token_time,
+            "repetition_aborted": repetition_aborted,
+            "cached_tokens": cached_tokens,
+        }
+
+    async def complete_hedged(self, request, start_time):
+        async def send(attempt):
+            with self.pool.lease() as endpoint:
+                sent_at = time.time()
+                if self.stream:
+                    completion = await self.stream_complete(
+                        endpoint.client, request, start_time
+                    )
+                else:
+                    completion = await self.complete(endpoint.client, request)
+                endpoint.observe_turn(
+                    time.time() - sent_at, completion["completion_tokens"]
+                )
+                return completion
+
+        if self.hedger is None:
+            return await send(0)
+        return await self.hedger.run(send)
+
+    def count_tokens(self, text):
+        if self.tokenizer != None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+        return len(text) // 4
 
     async def send_request(self, request):
         MAX_RETRY = 5
@@ -65,95 +203,246 @@ class OpenaiAdaptor(BaseAdaptor):
         think_tokens = 0
         response_tokens = 0
         elapsed_time = 99999999
+        first_token_time = -1
+        repetition_aborted = False
+        cached_tokens = 0
+        choices = []
         for retry_cnt in range(MAX_RETRY):
             try:
                 start_time = time.time()
-                api_response = await self.client.chat.completions.create(**request)
+                completion = await self.complete_hedged(request, start_time)
+                if self.stream:
+                    first_token_time = completion["first_token_time"]
+                    repetition_aborted = completion["repetition_aborted"]
                 elapsed_time = time.time() - start_time
-                response = api_response.choices[0].message.content
-                think = ""
-                if hasattr(api_response.choices[0].message, "reasoning_content"):
-                    think = api_response.choices[0].message.reasoning_content
-
-                usage = api_response.usage
-                details = getattr(usage, "completion_tokens_details", None)
-                think_tokens = getattr(details, "reasoning_tokens", 0)
-                response_tokens = usage.completion_tokens - think_tokens
-                input_tokens = usage.prompt_tokens
+                response = completion["response"]
+                think = completion["think"]
+                think_tokens = completion["think_tokens"]
+                response_tokens = completion["completion_tokens"] - think_tokens
+                input_tokens = completion["input_tokens"]
+                cached_tokens = completion["cached_tokens"]
+                choices = completion.get("choices", [])
 
                 error_pattern = r"^Error\s+code:\s+\d{3}\s+-.*"
                 if re.match(error_pattern, response):
                     print("Error is occurred: ", response[:80])
                     print("retry...", retry_cnt + 1)
                 else:
+                    self.metrics.observe_turn(
+                        elapsed_time,
+                        input_tokens,
+                        completion["completion_tokens"],
+                        cached_tokens,
+                    )
                     break
 
             except Exception as e:
                 response = f"{e}"
                 elapsed_time = -1
 
+            if retry_cnt < MAX_RETRY - 1:
+                self.metrics.observe_retry()
+        else:
+            self.metrics.observe_error()
+
         if self.tokenizer != None:
             think_tokens = len(self.tokenizer.encode(think, add_special_tokens=False))
             response_tokens = len(
                 self.tokenizer.encode(response, add_special_tokens=False)
             )
 
-        return {
+        result = {
             "response": response,
             "think": think,
             "elapsed_time": elapsed_time,
             "input_tokens": input_tokens,
             "think_tokens": think_tokens,
             "response_tokens": response_tokens,
+            "first_token_time": first_token_time,
+            "repetition_aborted": repetition_aborted,
+            "cached_tokens": cached_tokens,
+            "retries": retry_cnt,
+        }
+        if len(choices) > 1:
+            # usage only counts the tokens of all choices together
+            result["samples"] = [
+                {
+                    "response": choice["response"],
+                    "think": choice["think"],
+                    "think_tokens": self.count_tokens(choice["think"]),
+                    "response_tokens": self.count_tokens(choice["response"] or ""),
+                }
+                for choice in choices
+            ]
+        return result
+
+    def completion_request(self, request, messages=None):
+        if messages is None:
+            messages = request["accumulated_conversations"]
+        completion_request = {
+            "model": self.model_name,
+            "messages": list(messages),
+        }
+        completion_request |= self.sampling_params
+        if request.get("response_schema"):
+            completion_request["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "response",
+                    "strict": True,
+                    "schema": request["response_schema"],
+                },
+            }
+        return completion_request
+
+    def batch_body(self, request):
+        return self.completion_request(request)
+
+    async def submit_batch(self, entries):
+        # azure batch endpoints have no version prefix
+        url = "/v1/chat/completions"
+        if self.serving_type == "azure":
+            url = "/chat/completions"
+        lines = [
+            json.dumps(
+                {"custom_id": custom_id, "method": "POST", "url": url, "body": body},
+                ensure_ascii=False,
+            )
+            for custom_id, body in entries.items()
+        ]
+        batch_file = await self.client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch"
+        )
+        batch_job = await self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=url,
+            completion_window=self.batch_completion_window,
+        )
+        return batch_job.id
+
+    async def batch_status(self, job_id):
+        batch_job = await self.client.batches.retrieve(job_id)
+        if batch_job.status == "failed":
+            print(f"Batch job {job_id} failed : {batch_job.errors}")
+            return "failed"
+        # expired and cancelled jobs keep the results of finished requests
+        if batch_job.status in ("completed", "expired", "cancelled"):
+            return "completed"
+        return "running"
+
+    async def batch_results(self, job_id):
+        batch_job = await self.client.batches.retrieve(job_id)
+        results = {}
+        for file_id in (batch_job.output_file_id, batch_job.error_file_id):
+            if not file_id:
+                continue
+            content = await self.client.files.content(file_id)
+            for line in content.text.splitlines():
+                if line.strip():
+                    result = json.loads(line)
+                    results[result["custom_id"]] = self.batch_turn(result)
+        return results
+
+    def batch_turn(self, result):
+        response = result.get("response") or {}
+        if result.get("error") or response.get("status_code") != 200:
+            return {"error": str(result.get("error") or response.get("body"))}
+
+        api_response = openai.types.chat.ChatCompletion.model_validate(
+            response["body"]
+        )
+        completion = self.parse_completion(api_response)
+        response_text = completion["response"]
+        if response_text == None:
+            response_text = "error"
+        think = completion["think"] or ""
+        think_tokens = completion["think_tokens"] or 0
+        response_tokens = completion["completion_tokens"] - think_tokens
+        if self.tokenizer != None:
+            think_tokens = self.count_tokens(think)
+            response_tokens = self.count_tokens(response_text)
+        return {
+            "response": response_text,
+            "think": think,
+            "input_tokens": completion["input_tokens"],
+            "think_tokens": think_tokens,
+            "response_tokens": response_tokens,
+            "cached_tokens": completion["cached_tokens"],
         }
 
     async def process_request(self, semaphore, request):
+        queued_at = time.time()
         async with semaphore:
+            started_at = self.metrics.begin_item(queued_at)
             if len(request["role"]) != len(request["input"]):
                 print("Malformed input : length of role and input mismatch")
+            # with native samples the first user turn is sent once with n,
+            # then every choice continues as a conversation of its own
+            samples = [request]
+            branched = not self.native_samples or "sample_idx" in request
             for role, message in zip(request["role"], request["input"]):
-                request["accumulated_conversations"].append(
-                    {"role": role, "content": message}
-                )
+                for sample in samples:
+                    sample["accumulated_conversations"].append(
+                        {"role": role, "content": message}
+                    )
                 if role == "system":
-                    request["response"].append("")
-                    request["think"].append("")
-                    request["input_tokens"].append(0)
-                    request["think_tokens"].append(0)
-                    request["response_tokens"].append(0)
-                    request["elapsed_time"].append(0)
+                    for sample in samples:
+                        self.append_turn(sample)
+                elif not branched:
+                    response = await self.send_fitted(request, {"n": self.num_samples})
+                    sample_turns = response.pop("samples", [{}] * self.num_samples)
+                    samples = []
+                    for sample_idx, sample_turn in enumerate(sample_turns):
+                        sample = self.sample_copy(request, sample_idx)
+                        self.append_response(sample, response | sample_turn)
+                        samples.append(sample)
+                    branched = True
                 else:
-                    completion_request = {
-                        "model": self.model_name,
-                        "messages": request["accumulated_conversations"],
-                    }
-                    completion_request |= self.sampling_params
-                    response = await self.send_request(completion_request)
-
-                    response_text = response["response"]
-                    if response_text == None:
-                        response_text = "error"
-
-                    request["accumulated_conversations"].append(
-                        {"role": "assistant", "content": response_text}
+                    responses = await asyncio.gather(
+                        *[self.send_fitted(sample) for sample in samples]
                     )
-                    request["response"].append(response_text)
-                    request["think"].append(response["think"])
-                    request["input_tokens"].append(response["input_tokens"])
-                    request["think_tokens"].append(response["think_tokens"])
-                    request["response_tokens"].append(response["response_tokens"])
-                    request["elapsed_time"].append(response["elapsed_time"])
-
-            await self.print_count()
-        return request
-
-    async def generate(self, request_list):
-        semaphore = asyncio.Semaphore(self.semaphore_cnt)
-        tasks = [self.process_request(semaphore, request) for request in request_list]
-        responses = await asyncio.gather(*tasks)
-        return responses
+                    for sample, response in zip(samples, responses):
+                        self.append_response(sample, response)
+
+            self.metrics.end_item(started_at)
+        return samples if len(samples) > 1 else request
+
+    async def send_fitted(self, request, params=None):
+        """Send the next turn of ``request`` with its conversation fitted."""
+        fitted = self.fit_context(request)
+        if fitted is None:
+            return self.context_exceeded_turn()
+        messages, truncated_tokens = fitted
+        response = await self.send_request(
+            self.completion_request(request, messages) | (params or {})
+        )
+        response["truncated_tokens"] = truncated_tokens
+        self.observe_context(messages, response)
+        return response
+
+    def append_response(self, request, response):
+        response_text = response["response"]
+        if response_text == None:
+            response_text = "error"
+
+        request["accumulated_conversations"].append(
+            {"role": "assistant", "content": response_text}
+        )
+        response["response"] = response_text
+        self.append_turn(request, response)
+
+    async def start_run(self, total):
+        # clients are bound to the event loop of one inference call
+        self.pool = create_endpoint_pool(
+            self.model_configs, self.create_client, "base_url"
+        )
+        self.metrics.endpoint_pool = self.pool
+        self.metrics.start(total)
+
+    async def finish_run(self):
+        for endpoint in self.pool.endpoints:
+            await endpoint.client.close()
 
     def inference(self, batch):
-        initialized_batch = self.initialize_batch(batch)
-        output = asyncio.run(self.generate(initialized_batch))
+        output = self.run_async(self.inference_async(batch))
         return output
@@ -0,0 +1,184 @@
+import asyncio
+import json
+import sys
+import threading
+import time
+import traceback
+
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+
+_active_profiler = None
+
+
+def get_profiler():
+    return _active_profiler
+
+
+def set_profiler(profiler):
+    global _active_profiler
+    _active_profiler = profiler
+
+
+class Profiler:
+    """
+    Stage-level wall/CPU timer with optional event-loop lag monitoring and a
+    sampling profiler.
+
+    - ``stage(name)`` records wall and CPU time of a block of the pipeline.
+    - ``monitor_loop()`` runs a heartbeat task inside the adaptor's event loop.
+      A watchdog thread reports the stack of the loop thread whenever the
+      heartbeat is late by more than ``lag_threshold`` seconds.
+    - When ``sample_path`` is set, the main thread is sampled every
+      ``sample_interval`` seconds and the stacks are written in the collapsed
+      format understood by flamegraph.pl and speedscope.
+    """
+
+    MAX_BLOCKED_STACKS = 20
+
+    def __init__(self, lag_threshold=0.1, sample_path=None, sample_interval=0.005):
+        self.lag_threshold = lag_threshold
+        self.sample_path = sample_path
+        self.sample_interval = sample_interval
+        self.stages = defaultdict(
+            lambda: {"count": 0, "wall_time": 0.0, "cpu_time": 0.0}
+        )
+        self.lags = []
+        self.blocked = {}
+        self.samples = defaultdict(int)
+        self.main_thread_id = threading.get_ident()
+        self.stop_event = threading.Event()
+        self.sampler = None
+
+    def start(self):
+        set_profiler(self)
+        if self.sample_path:
+            self.sampler = threading.Thread(target=self._sample, daemon=True)
+            self.sampler.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.sampler is not None:
+            self.sampler.join()
+        set_profiler(None)
+
+    @contextmanager
+    def stage(self, name):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages[name]
+            stage["count"] += 1
+            stage["wall_time"] += time.perf_counter() - wall_start
+            stage["cpu_time"] += time.process_time() - cpu_start
+
+    @asynccontextmanager
+    async def monitor_loop(self, interval=0.05):
+        loop = asyncio.get_running_loop()
+        loop_thread_id = threading.get_ident()
+        state = {"last_tick": time.monotonic(), "reported": False}
+        stop = threading.Event()
+
+        async def heartbeat():
+            while True:
+                expected = loop.time() + interval
+                await asyncio.sleep(interval)
+                self.lags.append(max(loop.time() - expected, 0.0))
+                state["last_tick"] = time.monotonic()
+                state["reported"] = False
+
+        def watchdog():
+            while not stop.wait(interval):
+                late = time.monotonic() - state["last_tick"] - interval
+                if late > self.lag_threshold and not state["reported"]:
+                    state["reported"] = True
+                    frame = sys._current_frames().get(loop_thread_id)
+                    if frame is not None:
+                        self._record_blocked(frame)
+
+        heartbeat_task = asyncio.create_task(heartbeat())
+        watchdog_thread = threading.Thread(target=watchdog, daemon=True)
+        watchdog_thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            heartbeat_task.cancel()
+            watchdog_thread.join()
+
+    def _record_blocked(self, frame):
+        stack = "".join(traceback.format_stack(frame))
+        if stack in self.blocked:
+            self.blocked[stack] += 1
+        elif len(self.blocked) < self.MAX_BLOCKED_STACKS:
+            self.blocked[stack] = 1
+
+    def _sample(self):
+        while not self.stop_event.wait(self.sample_interval):
+            frame = sys._current_frames().get(self.main_thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_filename}:{code.co_name}")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def report(self):
+        lags = sorted(self.lags)
+        return {
+            "stages": {
+                name: {
+                    "count": stage["count"],
+                    "wall_time": round(stage["wall_time"], 4),
+                    "cpu_time": round(stage["cpu_time"], 4),
+                }
+                for name, stage in self.stages.items()
+            },
+            "event_loop_lag": {
+                "samples": len(lags),
+                "max": round(lags[-1], 4) if lags else 0.0,
+                "p99": round(lags[int(len(lags) * 0.99)], 4) if lags else 0.0,
+                "blocked_count": sum(1 for lag in lags if lag > self.lag_threshold),
+            },
+            "blocked_stacks": [
+                {"count": count, "stack": stack}
+                for stack, count in sorted(
+                    self.blocked.items(), key=lambda x: x[1], reverse=True
+                )
+            ],
+        }
+
+    def write(self, report_path):
+        report = self.report()
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
+
+        print("Stage profile (wall / cpu seconds):")
+        for name, stage in report["stages"].items():
+            print(f"  {name}: {stage['wall_time']:.3f} / {stage['cpu_time']:.3f}")
+        lag = report["event_loop_lag"]
+        print(
+            f"Event loop lag: max {lag['max']:.3f}s, "
+            f"{lag['blocked_count']} heartbeats later than {self.lag_threshold}s"
+        )
+
+        if self.sample_path:
+            with open(self.sample_path, "w", encoding="utf-8") as f:
+                for stack, count in self.samples.items():
+                    f.write(f"{stack} {count}\n")
+            print(f"Sampling profile is written to {self.sample_path}")
+
+
+@contextmanager
+def profile_stage(name):
+    """Record ``name`` on the active profiler, no-op when profiling is off."""
+    profiler = get_profiler()
+    if profiler is None:
+        yield
+    else:
+        with profiler.stage(name):
+            yield
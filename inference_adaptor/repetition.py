@@ -0,0 +1,44 @@
+class RepetitionDetector:
+    """
+    Online detector of degenerate repetition in streamed text.
+
+    Every ``check_interval`` characters, the last ``ngram_chars`` characters are
+    looked up in the last ``window_chars`` characters. Generation is considered
+    stuck in a loop when they occur at least ``max_repeats`` times. Characters
+    are used instead of words so that languages without spaces are covered.
+    """
+
+    def __init__(
+        self, ngram_chars=32, max_repeats=20, window_chars=8000, check_interval=256
+    ):
+        self.ngram_chars = ngram_chars
+        self.max_repeats = max_repeats
+        self.window_chars = window_chars
+        self.check_interval = check_interval
+        self.tail = ""
+        self.pending = 0
+
+    def feed(self, text):
+        if not text:
+            return False
+        self.tail += text
+        if len(self.tail) > 2 * self.window_chars:
+            self.tail = self.tail[-self.window_chars :]
+        self.pending += len(text)
+        if self.pending < self.check_interval:
+            return False
+        self.pending = 0
+
+        ngram = self.tail[-self.ngram_chars :]
+        if len(ngram) < self.ngram_chars:
+            return False
+        return self.tail[-self.window_chars :].count(ngram) >= self.max_repeats
+
+
+def create_repetition_detector(config):
+    """Build a detector from the ``repetition_abort`` config, None when disabled."""
+    if not config:
+        return None
+    if config is True:
+        return RepetitionDetector()
+    return RepetitionDetector(**config)
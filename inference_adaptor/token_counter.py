@@ -0,0 +1,67 @@
+class TokenCounter:
+    """
+    Count tokens with the tokenizer configured for a model.
+
+    ``tokenizer_path`` (openai adaptor) or ``model_path`` (vllm adaptor) loads a
+    Hugging Face tokenizer, OpenAI serving types fall back to tiktoken and
+    everything else is estimated from the character count.
+    """
+
+    def __init__(self, model_configs, chars_per_token=4.0):
+        self.chars_per_token = chars_per_token
+        self.tokenizer = None
+        self.encoding = None
+
+        tokenizer_path = model_configs.get("tokenizer_path") or model_configs.get(
+            "model_path"
+        )
+        if tokenizer_path:
+            from transformers import AutoTokenizer
+
+            self.tokenizer = AutoTokenizer.from_pretrained(
+                tokenizer_path, trust_remote_code=True
+            )
+        elif model_configs.get("serving_type") in ("azure", "openai"):
+            try:
+                import tiktoken
+
+                self.encoding = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                print(f"tiktoken is not available, estimating token counts : {e}")
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self.tokenizer is not None:
+            return len(self.tokenizer.encode(text, add_special_tokens=False))
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return int(len(text) / self.chars_per_token) + 1
+
+    def count_messages(self, messages):
+        # a few tokens of chat template overhead per message
+        return sum(self.count(message["content"]) + 4 for message in messages)
+
+    def truncate_center(self, text, max_tokens, separator=""):
+        """
+        Keep about ``max_tokens`` tokens of ``text``, cutting out its center and
+        joining the two ends with ``separator``.
+        """
+        if max_tokens <= 0:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+        encoder = self.tokenizer if self.tokenizer is not None else self.encoding
+        if encoder is not None:
+            if self.tokenizer is not None:
+                token_ids = self.tokenizer.encode(text, add_special_tokens=False)
+            else:
+                token_ids = self.encoding.encode(text, disallowed_special=())
+            half = max_tokens // 2
+            return (
+                encoder.decode(token_ids[:half])
+                + separator
+                + encoder.decode(token_ids[len(token_ids) - half :])
+            )
+        half = int((max_tokens - 1) // 2 * self.chars_per_token)
+        return text[:half] + separator + text[len(text) - half :]
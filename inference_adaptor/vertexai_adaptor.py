@@ -1,20 +1,43 @@
 import asyncio
+import json
 import os
 import time
+import uuid
 from google import genai
 from google.genai import types
 
 from inference_adaptor.base_adaptor import BaseAdaptor
+from inference_adaptor.budget import create_spend_budget
+from inference_adaptor.context_guard import create_context_guard
+from inference_adaptor.endpoint_pool import create_endpoint_pool
+from inference_adaptor.hedging import create_hedger
+from inference_adaptor.metrics import RequestMetrics
+from inference_adaptor.repetition import create_repetition_detector
 
 
 class VertexaiAdaptor(BaseAdaptor):
     def __init__(self, model_configs):
-        self.count = 0
-        self.lock = asyncio.Lock()
+        self.model_configs = model_configs
         self.model_name = model_configs["model_name"]
+        self.metrics = RequestMetrics(self.model_name)
         self.project_id = model_configs["project_id"]
         self.location = model_configs.get("location", "global")
         self.semaphore_cnt = model_configs.get("semaphore_max_count", 16)
+        self.num_samples = model_configs.get("num_samples", 1)
+        self.repetition_abort = model_configs.get("repetition_abort", None)
+        self.prompt_cache_ttl = model_configs.get("prompt_cache_ttl", "3600s")
+        self.cached_contents = {}
+        self.stream = model_configs.get("stream", False) or bool(self.repetition_abort)
+        self.hedger = create_hedger(model_configs.get("hedge", None), self.metrics)
+        self.context_guard = create_context_guard(model_configs)
+        self.budget = create_spend_budget(
+            model_configs.get("budget", None), self.metrics
+        )
+        self.metrics.budget = self.budget
+        self.batch_gcs_uri = model_configs.get("batch_gcs_uri", "").rstrip("/")
+        self.batch_poll_interval = model_configs.get("batch_poll_interval", 60)
+        self.batch_max_requests = model_configs.get("batch_max_requests", 50000)
+        self.batch_client = None
         self.sampling_params = self._init_sampling_params(
             model_configs.get("sampling_params", {})
         )
@@ -44,159 +67,494 @@ class VertexaiAdaptor(BaseAdaptor):
             sampling_params["thinking_config"] = thinking_config
         return sampling_params
 
-    def create_context(self, client, system_prompts: list[str]):
-        if system_prompts:
+    def build_history(self, conversations):
+        return [
+            types.Content(
+                role="model" if conv["role"] == "assistant" else "user",
+                parts=[types.Part.from_text(text=conv["content"])],
+            )
+            for conv in conversations
+            if conv["role"] != "system"
+        ]
+
+    def system_cacheable(self, request):
+        cache_breakpoints = request.get("cache_breakpoints")
+        if not cache_breakpoints:
+            return False
+        system_breakpoints = [
+            (breakpoints, message)
+            for role, message, breakpoints in zip(
+                request["role"], request["input"], cache_breakpoints
+            )
+            if role == "system"
+        ]
+        return len(system_breakpoints) > 0 and all(
+            breakpoints and breakpoints[-1] >= len(message)
+            for breakpoints, message in system_breakpoints
+        )
+
+    async def get_cached_content(self, client, system_prompts):
+        """
+        Return the name of a cached content holding ``system_prompts``, creating
+        it on first use. Prompts below the model's minimum cache size fail to
+        be cached, those requests fall back to sending the system instruction.
+        """
+        key = (client, tuple(system_prompts))
+        async with self.cache_lock:
+            if key not in self.cached_contents:
+                try:
+                    cached_content = await client.caches.create(
+                        model=self.model_name,
+                        config=types.CreateCachedContentConfig(
+                            system_instruction=system_prompts,
+                            ttl=self.prompt_cache_ttl,
+                        ),
+                    )
+                    self.cached_contents[key] = cached_content.name
+                except Exception as e:
+                    print(f"Vertex AI context caching is not available : {e}")
+                    self.cached_contents[key] = None
+            return self.cached_contents[key]
+
+    async def delete_cached_contents(self):
+        for (client, _), name in self.cached_contents.items():
+            if name is None:
+                continue
+            try:
+                await client.caches.delete(name=name)
+            except Exception as e:
+                print(f"Failed to delete cached content {name} : {e}")
+        self.cached_contents = {}
+
+    def gemini_schema(self, schema):
+        """
+        Convert a JSON schema to a Gemini ``Schema``: upper-case types, no
+        ``additionalProperties`` and an explicit property order, since Gemini
+        orders properties alphabetically otherwise.
+        """
+        converted = {}
+        for key, value in schema.items():
+            if key == "additionalProperties":
+                continue
+            if key == "type":
+                value = value.upper()
+            elif key == "properties":
+                value = {
+                    name: self.gemini_schema(prop) for name, prop in value.items()
+                }
+            elif key == "items":
+                value = self.gemini_schema(value)
+            converted[key] = value
+        if "properties" in schema:
+            converted["propertyOrdering"] = list(schema["properties"])
+        return converted
+
+    def generation_params(self, response_schema=None):
+        if not response_schema:
+            return self.sampling_params
+        return self.sampling_params | {
+            "response_mime_type": "application/json",
+            "response_schema": self.gemini_schema(response_schema),
+        }
+
+    def create_context(
+        self,
+        client,
+        system_prompts: list[str],
+        history=None,
+        cached_content=None,
+        response_schema=None,
+    ):
+        generation_params = self.generation_params(response_schema)
+        if cached_content:
             generation_config = types.GenerateContentConfig(
-                system_instruction=system_prompts, **self.sampling_params
+                cached_content=cached_content, **generation_params
+            )
+        elif system_prompts:
+            generation_config = types.GenerateContentConfig(
+                system_instruction=system_prompts, **generation_params
             )
         else:
-            generation_config = types.GenerateContentConfig(**self.sampling_params)
+            generation_config = types.GenerateContentConfig(**generation_params)
 
         return client.chats.create(
             model=self.model_name,
             config=generation_config,
+            history=history,
         )
 
-    async def print_count(self):
-        async with self.lock:
-            self.count += 1
-            print(f"{self.count} tasks are done")
+    def usage_tokens(self, api_response):
+        if hasattr(api_response, "usage_metadata") and api_response.usage_metadata:
+            usage = api_response.usage_metadata
+            return {
+                "input_tokens": getattr(usage, "prompt_token_count", 0) or 0,
+                "think_tokens": getattr(usage, "thoughts_token_count", 0) or 0,
+                "response_tokens": getattr(usage, "candidates_token_count", 0) or 0,
+                "cached_tokens": getattr(usage, "cached_content_token_count", 0) or 0,
+            }
+        return {
+            "input_tokens": 0,
+            "think_tokens": 0,
+            "response_tokens": 0,
+            "cached_tokens": 0,
+        }
 
-    def create_fallback_response(self, request, error_message):
-        request["response"].append(error_message)
-        while len(request["response"]) < len(request["input"]):
-            request["response"].append(f"Error on previous turns : {error_message}")
-        request["think"] += [""] * (len(request["input"]) - len(request["think"]))
-        request["input_tokens"] += [0] * (
-            len(request["input"]) - len(request["input_tokens"])
+    async def send_message(self, context, message, start_time):
+        api_response = await context.send_message(message)
+        return {"response": api_response.text} | self.usage_tokens(api_response)
+
+    async def stream_message(self, context, message, start_time):
+        detector = create_repetition_detector(self.repetition_abort)
+        chunks = []
+        first_token_time = -1
+        repetition_aborted = False
+        last_chunk = None
+        async for chunk in await context.send_message_stream(message):
+            last_chunk = chunk
+            text = chunk.text or ""
+            if text and first_token_time < 0:
+                first_token_time = time.time() - start_time
+            chunks.append(text)
+            if detector is not None and detector.feed(text):
+                repetition_aborted = True
+                break
+
+        response_text = "".join(chunks)
+        usage = self.usage_tokens(last_chunk)
+        if repetition_aborted and not usage["response_tokens"]:
+            usage["response_tokens"] = len(response_text) // 4
+        return {
+            "response": response_text,
+            "first_token_time": first_token_time,
+            "repetition_aborted": repetition_aborted,
+        } | usage
+
+    def create_client(self, configs):
+        VERTEXAI_TIMEOUT = (
+            15 * 60 * 1000
+        )  # 15 minutes, maximum 75 minutes when 5 tries all timed out
+        return genai.Client(
+            vertexai=True,
+            project=configs["project_id"],
+            location=configs.get("location", "global"),
+            http_options=types.HttpOptions(timeout=VERTEXAI_TIMEOUT),
+        ).aio
+
+    def enable_batch(self, state_path):
+        if not self.batch_gcs_uri.startswith("gs://"):
+            raise ValueError("please set proper batch_gcs_uri for batch mode")
+        super().enable_batch(state_path)
+
+    def batch_body(self, request):
+        system_prompts = [
+            msg
+            for role, msg in zip(request["role"], request["input"])
+            if role == "system"
+        ]
+        body = {
+            "contents": [
+                content.model_dump(mode="json", exclude_none=True)
+                for content in self.build_history(request["accumulated_conversations"])
+            ]
+        }
+        if system_prompts:
+            body["systemInstruction"] = {
+                "parts": [{"text": prompt} for prompt in system_prompts]
+            }
+        generation_config = {
+            key: value.model_dump(mode="json", exclude_none=True)
+            if hasattr(value, "model_dump")
+            else value
+            for key, value in self.sampling_params.items()
+        }
+        if request.get("response_schema"):
+            generation_config["responseMimeType"] = "application/json"
+            generation_config["responseSchema"] = self.gemini_schema(
+                request["response_schema"]
+            )
+        if generation_config:
+            body["generationConfig"] = generation_config
+        return body
+
+    async def submit_batch(self, entries):
+        from google.cloud import storage
+
+        if self.batch_client is None:
+            self.batch_client = self.create_client(self.model_configs)
+        job_dir = f"{self.batch_gcs_uri}/truebench-{uuid.uuid4().hex[:12]}"
+        lines = [
+            # labels are echoed in the output lines, matching them to requests
+            json.dumps(
+                {"request": body | {"labels": {"custom_id": custom_id}}},
+                ensure_ascii=False,
+            )
+            for custom_id, body in entries.items()
+        ]
+        bucket_name, prefix = job_dir.removeprefix("gs://").split("/", 1)
+        blob = storage.Client(project=self.project_id).bucket(bucket_name).blob(
+            f"{prefix}/input.jsonl"
+        )
+        await asyncio.to_thread(
+            blob.upload_from_string, "\n".join(lines), "application/jsonl"
         )
-        request["think_tokens"] += [0] * (
-            len(request["input"]) - len(request["think_tokens"])
+        batch_job = await self.batch_client.batches.create(
+            model=self.model_name,
+            src=f"{job_dir}/input.jsonl",
+            config=types.CreateBatchJobConfig(dest=f"{job_dir}/output"),
         )
-        request["response_tokens"] += [0] * (
-            len(request["input"]) - len(request["response_tokens"])
+        return batch_job.name
+
+    async def batch_status(self, job_id):
+        if self.batch_client is None:
+            self.batch_client = self.create_client(self.model_configs)
+        batch_job = await self.batch_client.batches.get(name=job_id)
+        state = str(getattr(batch_job.state, "value", batch_job.state))
+        if state in ("JOB_STATE_SUCCEEDED", "JOB_STATE_PARTIALLY_SUCCEEDED"):
+            return "completed"
+        if state in ("JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"):
+            print(f"Batch job {job_id} ended with {state} : {batch_job.error}")
+            return "failed"
+        return "running"
+
+    async def batch_results(self, job_id):
+        from google.cloud import storage
+
+        batch_job = await self.batch_client.batches.get(name=job_id)
+        bucket_name, prefix = batch_job.dest.gcs_uri.removeprefix("gs://").split("/", 1)
+        blobs = storage.Client(project=self.project_id).list_blobs(
+            bucket_name, prefix=prefix
         )
-        request["elapsed_time"] += [-1] * (
-            len(request["input"]) - len(request["elapsed_time"])
+        results = {}
+        for blob in blobs:
+            if not blob.name.endswith(".jsonl"):
+                continue
+            content = await asyncio.to_thread(blob.download_as_text)
+            for line in content.splitlines():
+                if line.strip():
+                    result = json.loads(line)
+                    custom_id = result["request"]["labels"]["custom_id"]
+                    results[custom_id] = self.batch_turn(result)
+        return results
+
+    def batch_turn(self, result):
+        if result.get("status") or not result.get("response"):
+            return {"error": result.get("status") or "empty response"}
+        api_response = types.GenerateContentResponse.model_validate(
+            result["response"]
         )
+        return {"response": api_response.text or ""} | self.usage_tokens(api_response)
 
-        return request
+    def create_fallback_response(self, request, error_message, retries):
+        self.append_turn(
+            request,
+            {"response": error_message, "elapsed_time": -1, "retries": retries},
+        )
+        while len(request["response"]) < len(request["input"]):
+            self.append_turn(
+                request,
+                {
+                    "response": f"Error on previous turns : {error_message}",
+                    "elapsed_time": -1,
+                },
+            )
 
-    def reset_response(self, request):
-        request["response"] = []
-        request["think"] = []
-        request["accumulated_conversations"] = []
-        request["input_tokens"] = []
-        request["think_tokens"] = []
-        request["response_tokens"] = []
-        request["elapsed_time"] = []
         return request
 
-    async def process_request(self, semaphore, request, client):
-        async with semaphore:
-            if len(request["role"]) != len(request["input"]):
-                print("Malformed input : length of role and input mismatch")
+    async def send_hedged(
+        self,
+        client,
+        context,
+        request,
+        conversations,
+        system_prompts,
+        cached_content,
+        start_time,
+    ):
+        message = conversations[-1]["content"]
 
-            system_prompts = [
-                msg
-                for role, msg in zip(request["role"], request["input"])
-                if role == "system"
-            ]
+        async def send(attempt):
+            chat = context
+            if attempt > 0:
+                # a chat records the turns it sends, so the hedge gets its own
+                chat = self.create_context(
+                    client,
+                    system_prompts=system_prompts,
+                    history=self.build_history(conversations[:-1]),
+                    cached_content=cached_content,
+                    response_schema=request.get("response_schema"),
+                )
+            send_message = self.stream_message if self.stream else self.send_message
+            return await send_message(chat, message, start_time), chat
 
-            MAX_RETRY = 5
-            for retry_cnt in range(MAX_RETRY):
-                try:
-                    context = self.create_context(client, system_prompts=system_prompts)
-                    for role, message in zip(request["role"], request["input"]):
-                        request["accumulated_conversations"].append(
-                            {"role": role, "content": message}
-                        )
-                        if role == "system":
-                            request["response"].append("")
-                            request["think"].append("")
-                            request["input_tokens"].append(0)
-                            request["think_tokens"].append(0)
-                            request["response_tokens"].append(0)
-                            request["elapsed_time"].append(0)
-                        else:
-                            start_time = time.time()
-                            SEND_MESSAGE_TIMEOUT = 5 * 60  # 20 minutes
-
-                            api_response = await asyncio.wait_for(
-                                context.send_message(message),
-                                SEND_MESSAGE_TIMEOUT,
-                            )
-
-                            response_text = api_response.text
-                            elapsed_time = time.time() - start_time
-
-                            # Extract usage metadata
-                            if (
-                                hasattr(api_response, "usage_metadata")
-                                and api_response.usage_metadata
-                            ):
-                                usage = api_response.usage_metadata
-                                input_tokens = getattr(usage, "prompt_token_count", 0)
-                                think_tokens = getattr(usage, "thoughts_token_count", 0)
-                                if not think_tokens:
-                                    think_tokens = 0
-                                response_tokens = getattr(
-                                    usage, "candidates_token_count", 0
-                                )
-                                if not response_tokens:
-                                    response_tokens = 0
-                            else:
-                                input_tokens = 0
-                                response_tokens = 0
-                                think_tokens = 0
-
-                            request["accumulated_conversations"].append(
-                                {"role": "assistant", "content": response_text}
-                            )
-                            request["response"].append(response_text)
-                            request["think"].append("")
-                            request["input_tokens"].append(input_tokens)
-                            request["think_tokens"].append(think_tokens)
-                            request["response_tokens"].append(response_tokens)
-                            request["elapsed_time"].append(elapsed_time)
-
-                    break
+        if self.hedger is None:
+            return await send(0)
+        return await self.hedger.run(send)
 
-                except Exception as e:
-                    error_message = f"Exception occured : {e}"
-                    if retry_cnt == MAX_RETRY - 1:
-                        print(f"Max retries reached for Vertex AI request: {e}")
-                        request = self.create_fallback_response(request, error_message)
-                    else:
-                        print(
-                            f"Vertex AI request failed (attempt {retry_cnt + 1}/{MAX_RETRY}): {e}"
-                        )
-                        request = self.reset_response(request)
-
-            await self.print_count()
+    async def send_turn(
+        self, endpoint, context, request, conversations, system_prompts, cached_content
+    ):
+        """
+        Send the last user message of ``conversations``, the fitted
+        conversation of ``request``, retrying only this turn.
+
+        The chat is rebuilt from the accumulated turns before a retry, so the
+        previous turns are not generated again. Returns the turn and the chat
+        to continue with, or ``None`` for the turn when every retry failed.
+        """
+        client = endpoint.client
+        MAX_RETRY = 5
+        for retry_cnt in range(MAX_RETRY):
+            try:
+                start_time = time.time()
+                SEND_MESSAGE_TIMEOUT = 5 * 60  # 20 minutes
+
+                turn, context = await asyncio.wait_for(
+                    self.send_hedged(
+                        client,
+                        context,
+                        request,
+                        conversations,
+                        system_prompts,
+                        cached_content,
+                        start_time,
+                    ),
+                    SEND_MESSAGE_TIMEOUT,
+                )
+                turn["elapsed_time"] = time.time() - start_time
+                turn["retries"] = retry_cnt
+                endpoint.observe_turn(
+                    turn["elapsed_time"],
+                    turn["think_tokens"] + turn["response_tokens"],
+                )
+                return turn, context
+
+            except Exception as e:
+                self.pool.observe_failure(endpoint)
+                error_message = f"Exception occured : {e}"
+                if retry_cnt == MAX_RETRY - 1:
+                    print(f"Max retries reached for Vertex AI request: {e}")
+                    self.create_fallback_response(request, error_message, retry_cnt)
+                    self.metrics.observe_error()
+                    return None, context
+
+                print(
+                    f"Vertex AI request failed (attempt {retry_cnt + 1}/{MAX_RETRY}): {e}"
+                )
+                self.metrics.observe_retry()
+                context = self.create_context(
+                    client,
+                    system_prompts=system_prompts,
+                    history=self.build_history(conversations[:-1]),
+                    cached_content=cached_content,
+                    response_schema=request.get("response_schema"),
+                )
+
+    async def process_request(self, semaphore, request):
+        queued_at = time.time()
+        async with semaphore:
+            started_at = self.metrics.begin_item(queued_at)
+            # a conversation stays on one endpoint with its chat and cached content
+            endpoint = self.pool.acquire()
+            try:
+                await self.run_conversation(endpoint, request)
+            finally:
+                self.pool.release(endpoint)
+            self.metrics.end_item(started_at)
         return request
 
-    async def generate(self, request_list):
-        VERTEXAI_TIMEOUT = (
-            15 * 60 * 1000
-        )  # 15 minutes, maximum 75 minutes when 5 tries all timed out
-        # Initialize Vertex AI client
-        client = genai.Client(
-            vertexai=True,
-            project=self.project_id,
-            location=self.location,
-            http_options=types.HttpOptions(timeout=VERTEXAI_TIMEOUT),
-        ).aio
+    async def run_conversation(self, endpoint, request):
+        client = endpoint.client
+        if len(request["role"]) != len(request["input"]):
+            print("Malformed input : length of role and input mismatch")
 
-        semaphore = asyncio.Semaphore(self.semaphore_cnt)
-        tasks = [
-            self.process_request(semaphore, request, client) for request in request_list
+        system_prompts = [
+            msg
+            for role, msg in zip(request["role"], request["input"])
+            if role == "system"
         ]
-        responses = await asyncio.gather(*tasks)
-        await client.aclose()
-        return responses
+        cached_content = None
+        if self.system_cacheable(request):
+            cached_content = await self.get_cached_content(client, system_prompts)
+
+        context = self.create_context(
+            client,
+            system_prompts=system_prompts,
+            cached_content=cached_content,
+            response_schema=request.get("response_schema"),
+        )
+        for role, message in zip(request["role"], request["input"]):
+            request["accumulated_conversations"].append(
+                {"role": role, "content": message}
+            )
+            if role == "system":
+                self.append_turn(request)
+                continue
+
+            fitted = self.fit_context(request)
+            if fitted is None:
+                turn = self.context_exceeded_turn()
+                self.create_fallback_response(request, turn["response"], 0)
+                break
+            conversations, truncated_tokens = fitted
+            if truncated_tokens:
+                # the chat holds the whole history, a truncated one needs its own
+                context = self.create_context(
+                    client,
+                    system_prompts=system_prompts,
+                    history=self.build_history(conversations[:-1]),
+                    cached_content=cached_content,
+                    response_schema=request.get("response_schema"),
+                )
+
+            turn, context = await self.send_turn(
+                endpoint,
+                context,
+                request,
+                conversations,
+                system_prompts,
+                cached_content,
+            )
+            if turn is None:
+                break
+            turn["truncated_tokens"] = truncated_tokens
+            self.observe_context(conversations, turn)
+
+            request["accumulated_conversations"].append(
+                {"role": "assistant", "content": turn["response"]}
+            )
+            self.append_turn(request, turn)
+            self.metrics.observe_turn(
+                turn["elapsed_time"],
+                turn["input_tokens"],
+                turn["think_tokens"] + turn["response_tokens"],
+                turn["cached_tokens"],
+            )
+            if turn.get("repetition_aborted"):
+                # an aborted stream is not recorded in the chat history
+                context = self.create_context(
+                    client,
+                    system_prompts=system_prompts,
+                    history=self.build_history(request["accumulated_conversations"]),
+                    cached_content=cached_content,
+                    response_schema=request.get("response_schema"),
+                )
+
+    async def start_run(self, total):
+        # Initialize Vertex AI clients, one per endpoint
+        self.pool = create_endpoint_pool(
+            self.model_configs, self.create_client, "location"
+        )
+        self.metrics.endpoint_pool = self.pool
+
+        self.metrics.start(total)
+        self.cached_contents = {}
+        self.cache_lock = asyncio.Lock()
+
+    async def finish_run(self):
+        await self.delete_cached_contents()
+        for endpoint in self.pool.endpoints:
+            await endpoint.client.aclose()
 
     def inference(self, batch):
-        initialized_batch = self.initialize_batch(batch)
-        output = asyncio.run(self.generate(initialized_batch))
+        output = self.run_async(self.inference_async(batch))
         return output
@@ -1,7 +1,14 @@
+import gc
+import time
 import torch
 
 from inference_adaptor.base_adaptor import BaseAdaptor
+from inference_adaptor.metrics import RequestMetrics
 from vllm import LLM, SamplingParams
+from vllm.distributed.parallel_state import (
+    destroy_distributed_environment,
+    destroy_model_parallel,
+)
 
 
 class VllmAdaptor(BaseAdaptor):
@@ -23,13 +30,39 @@ class VllmAdaptor(BaseAdaptor):
         self.llm = LLM(**serving_params)
         self.tokenizer = self.llm.get_tokenizer()
         self.sampling_params = SamplingParams(**model_configs["sampling_params"])
+        self.num_samples = model_configs.get("num_samples", 1)
+        self.native_samples = True
+        # first turns of sampled items share their prefill across the samples
+        self.first_turn_params = SamplingParams(
+            **(model_configs["sampling_params"] | {"n": self.num_samples})
+        )
         self.enable_thinking = model_configs.get("enable_thinking", True)
         self.response_prefix = model_configs.get("response_prefix", "")
+        self.stream_chunk_size = model_configs.get("stream_chunk_size", 1024)
+        self.metrics = RequestMetrics(model_configs["model_name"])
 
     def terminate(self):
+        """
+        Shut the engine down and free its GPU memory, so another model can be
+        loaded in the same process. The adaptor cannot be used afterwards.
+        """
         print("terminate VLLM")
-
-    def inference_turn(self, batch):
+        if self.llm is None:
+            return
+        # the engine is only freed once nothing refers to it any more
+        self.llm = None
+        self.tokenizer = None
+        destroy_model_parallel()
+        destroy_distributed_environment()
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def inference_turn(self, batch, sampling_params=None):
+        """
+        Generate one turn of every conversation of ``batch`` and return, per
+        conversation, the list of its ``n`` sampled responses.
+        """
         prompt_token_ids = [
             self.tokenizer.apply_chat_template(
                 message,
@@ -42,49 +75,107 @@ class VllmAdaptor(BaseAdaptor):
 
         truncated_prompt_token_ids = self._truncate_center(prompt_token_ids)
 
+        start_time = time.time()
         responses = self.llm.generate(
-            truncated_prompt_token_ids, sampling_params=self.sampling_params
+            truncated_prompt_token_ids,
+            sampling_params=sampling_params or self.sampling_params,
         )
+        batch_elapsed_time = time.time() - start_time
         raw_responses = []
         for idx, response in enumerate(responses):
-            response_text = response.outputs[0].text
-            if self.response_prefix and self.response_prefix in response_text:
-                think_text, _, response_text = response_text.partition(
-                    self.response_prefix
+            # per-request timings are only reported when vLLM collects stats;
+            # otherwise every request of the turn shares the batch wall time
+            elapsed_time = batch_elapsed_time
+            first_token_time = -1
+            request_metrics = getattr(response, "metrics", None)
+            if request_metrics is not None and getattr(
+                request_metrics, "finished_time", None
+            ):
+                elapsed_time = (
+                    request_metrics.finished_time - request_metrics.arrival_time
                 )
-                think_text, response_text = think_text.strip(), response_text.strip()
-            else:
-                think_text, response_text = "", response_text.strip()
+                if getattr(request_metrics, "first_token_time", None):
+                    first_token_time = (
+                        request_metrics.first_token_time - request_metrics.arrival_time
+                    )
 
             input_tokens = len(truncated_prompt_token_ids[idx])
-            think_tokens = len(
-                self.tokenizer.encode(think_text, add_special_tokens=False)
-            )
-            response_tokens = len(
-                self.tokenizer.encode(response_text, add_special_tokens=False)
-            )
             raw_responses.append(
-                {
-                    "response": response_text,
-                    "think": think_text,
-                    "elapsed_time": -1,
-                    "input_tokens": input_tokens,
-                    "think_tokens": think_tokens,
-                    "response_tokens": response_tokens,
-                }
+                [
+                    self.parse_output(
+                        output, input_tokens, elapsed_time, first_token_time
+                    )
+                    for output in response.outputs
+                ]
             )
         return raw_responses
 
+    def parse_output(self, output, input_tokens, elapsed_time, first_token_time):
+        response_text = output.text
+        if self.response_prefix and self.response_prefix in response_text:
+            think_text, _, response_text = response_text.partition(
+                self.response_prefix
+            )
+            think_text, response_text = think_text.strip(), response_text.strip()
+        else:
+            think_text, response_text = "", response_text.strip()
+
+        think_tokens = len(self.tokenizer.encode(think_text, add_special_tokens=False))
+        response_tokens = len(
+            self.tokenizer.encode(response_text, add_special_tokens=False)
+        )
+        self.metrics.observe_turn(elapsed_time, input_tokens, len(output.token_ids))
+        return {
+            "response": response_text,
+            "think": think_text,
+            "elapsed_time": elapsed_time,
+            "input_tokens": input_tokens,
+            "think_tokens": think_tokens,
+            "response_tokens": response_tokens,
+            "first_token_time": first_token_time,
+        }
+
     def inference(self, batch):
         queue = self.initialize_batch(batch)
+        self.metrics.start(len(queue))
+        return self.run_queue(queue)
+
+    async def inference_stream(self, requests, total=0):
+        """
+        vLLM generates a whole turn of the queue at once, so ``requests`` are
+        run in chunks of ``stream_chunk_size`` items and the results of each
+        chunk are yielded when it finishes.
+        """
+        self.metrics.start(total)
+        chunk = []
+        for request in requests:
+            chunk.append(request)
+            if len(chunk) < self.stream_chunk_size:
+                continue
+            for output in self.run_queue(self.initialize_batch(chunk)):
+                yield output
+            chunk = []
+        if chunk:
+            for output in self.run_queue(self.initialize_batch(chunk)):
+                yield output
+
+    def run_queue(self, queue):
+        # every item is admitted at once, vLLM schedules them internally
+        queued_at = time.time()
+        started_at = {id(item): self.metrics.begin_item(queued_at) for item in queue}
         outputs = []
         while len(queue) > 0:
             singleturn_batch = []
+            turn_params = []
             items = []
             next_queue = []
             for item in queue:
                 if len(item["input"]) == len(item["response"]):
                     outputs.append(item)
+                    self.write_checkpoint(item)
+                    # the samples of an item finish together and count once
+                    if item.get("sample_idx", 0) == 0:
+                        self.metrics.end_item(started_at[id(item)])
                 else:
                     turn = len(item["response"])
                     item["accumulated_conversations"].append(
@@ -92,31 +183,35 @@ class VllmAdaptor(BaseAdaptor):
                     )
 
                     if item["role"][turn] == "system":
-                        item["response"].append("")
-                        item["think"].append("")
-                        item["input_tokens"].append(0)
-                        item["think_tokens"].append(0)
-                        item["response_tokens"].append(0)
-                        item["elapsed_time"].append(-1)
+                        self.append_turn(item)
                         next_queue.append(item)
 
                     else:
                         items.append(item)
                         singleturn_batch.append(item["accumulated_conversations"])
-
-            response_objs = self.inference_turn(singleturn_batch)
-
-            for response_obj, item in zip(response_objs, items):
-                item["response"].append(response_obj["response"])
-                item["think"].append(response_obj["think"])
-                item["input_tokens"].append(response_obj["input_tokens"])
-                item["think_tokens"].append(response_obj["think_tokens"])
-                item["response_tokens"].append(response_obj["response_tokens"])
-                item["accumulated_conversations"].append(
-                    {"role": "assistant", "content": response_obj["response"]}
-                )
-                item["elapsed_time"].append(response_obj["elapsed_time"])
-                next_queue.append(item)
+                        # the first user turn of an item is sampled n times,
+                        # each sample then continues as its own conversation
+                        if self.num_samples > 1 and "sample_idx" not in item:
+                            turn_params.append(self.first_turn_params)
+                        else:
+                            turn_params.append(self.sampling_params)
+
+            response_objs = self.inference_turn(singleturn_batch, turn_params)
+
+            for sample_objs, item in zip(response_objs, items):
+                samples = [item]
+                if len(sample_objs) > 1:
+                    samples = [
+                        self.sample_copy(item, sample_idx)
+                        for sample_idx in range(len(sample_objs))
+                    ]
+                for response_obj, sample in zip(sample_objs, samples):
+                    started_at[id(sample)] = started_at[id(item)]
+                    self.append_turn(sample, response_obj)
+                    sample["accumulated_conversations"].append(
+                        {"role": "assistant", "content": response_obj["response"]}
+                    )
+                    next_queue.append(sample)
 
             queue = next_queue
         return outputs
@@ -1,28 +1,48 @@
 import json
 import argparse
+import glob
 import os
+import random
+import re
+import sys
 
-import polars as pl
-
+from contextlib import ExitStack
 from pathlib import Path
 from tqdm import tqdm
 
 from prompts.judge_prompt import (
     judge_prompt_system,
+    judge_prompt_system_compact,
     judge_prompt_user,
     judge_prompt_user_multiturn,
+    judge_prompt_user_multiturn_conversations_first,
 )
 from utils import get_model_configs, create_directory_if_not_exists
+from estimator import RunHistory, estimate_run, report_estimate
+from scheduler import SCHEDULES, run_scheduled, report_schedule
+from inference_adaptor.profiler import Profiler, profile_stage
+from inference_adaptor.base_adaptor import TURN_FIELDS
+from inference_adaptor.context_guard import create_context_guard
 from inference_adaptor.openai_adaptor import OpenaiAdaptor
 from inference_adaptor.vertexai_adaptor import VertexaiAdaptor
 from inference_adaptor.anthropic_vertexai_adaptor import AnthropicVertexaiAdaptor
+from inference_adaptor.token_counter import TokenCounter
 
+PARSING_ERROR = "Parsing Error"
+JUDGE_LABELS = ["PASS", "FAIL"]
+CASCADE_REASONS = ["parse_error", "disagreement", "near_threshold", "audit"]
+# marks where a previous response was cut for the prompt budget
+COMPACTION_MARKER = "\n[...]\n"
 
-def load_inference_result(path):
-    if path.suffix == ".jsonl":
-        return pl.read_ndjson(str(path))
-    else:
-        return pl.read_ndjson(str(path) + ".jsonl")
+
+def iter_inference_result(path):
+    """Read the inference results line by line instead of loading the whole file."""
+    if path.suffix != ".jsonl":
+        path = Path(str(path) + ".jsonl")
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
 
 
 def build_criteria(criteria):
@@ -38,34 +58,194 @@ def build_criteria(criteria):
         return ""
 
 
-def build_judge_prompt_singleturn(criteria, instruction, response):
-    criteria = build_criteria(criteria)
+def count_criteria(criteria):
+    """Number of criteria, 0 when a criteria string is not a numbered list."""
+    if isinstance(criteria, list):
+        return len(criteria)
+    if isinstance(criteria, str):
+        return len(re.findall(r"^\s*\d+\.", criteria, re.M))
+    return 0
+
+
+def count_judge_turns(line):
+    """Number of judged turns of ``line``, each needs criteria, input and response."""
+    return min(len(line["criteria"]), len(line["input"]), len(line["response"]))
+
+
+def build_judge_response_schema(criteria_count, compact=False):
+    """
+    JSON schema of the judgement for ``criteria_count`` criteria, following
+    the output format of the judge system prompt: the analysis sections
+    first (left out when ``compact``), then one PASS / FAIL field per
+    criterion.
+    """
+    properties = {}
+    if not compact:
+        properties["instruction_analysis"] = {"type": "string"}
+        properties["criteria_judgement"] = {"type": "string"}
+    for idx in range(criteria_count):
+        properties[f"criteria_{idx + 1}"] = {"type": "string", "enum": JUDGE_LABELS}
     return {
+        "type": "object",
+        "properties": properties,
+        "required": list(properties),
+        "additionalProperties": False,
+    }
+
+
+def judge_system_prompt(compact=False):
+    """The verdict-only system prompt when ``compact``, the full one otherwise."""
+    return judge_prompt_system_compact if compact else judge_prompt_system
+
+
+def build_judge_prompt_singleturn(
+    criteria, instruction, response, prompt_cache=False, compact=False
+):
+    system_prompt = judge_system_prompt(compact)
+    criteria = build_criteria(criteria)
+    prompt = {
         "role": ["system", "user"],
         "input": [
-            judge_prompt_system,
+            system_prompt,
             judge_prompt_user.replace("___CRITERIA___", criteria)
             .replace("___INSTRUCTION___", instruction)
             .replace("___RESPONSE___", response),
         ],
     }
+    if prompt_cache:
+        prompt["cache_breakpoints"] = [[len(system_prompt)], []]
+    return prompt
 
 
-def build_judge_prompt_multiturn(convs, criteria, instruction, response):
+def build_judge_prompt_multiturn(
+    convs, criteria, instruction, response, prompt_cache=False, compact=False
+):
+    """
+    With ``prompt_cache``, the previous conversations are placed before the
+    criteria so that the judge prompts of consecutive turns share a prefix.
+    A cache breakpoint is marked after every previous turn, the judge prompt
+    of the next turn then starts with the cached prefix of this one.
+    """
+    system_prompt = judge_system_prompt(compact)
     pre_convs = ""
+    conv_ends = []
     for _instruction, _response in convs:
         pre_convs += f"User: {_instruction}\nAssistant: {_response}\n"
+        conv_ends.append(len(pre_convs))
     criteria = build_criteria(criteria)
-    return {
+    template = judge_prompt_user_multiturn
+    if prompt_cache:
+        template = judge_prompt_user_multiturn_conversations_first
+    user_prompt = (
+        template.replace("___CONVERSATIONS___", pre_convs)
+        .replace("___CRITERIA___", criteria)
+        .replace("___INSTRUCTION___", instruction)
+        .replace("___RESPONSE___", response)
+    )
+    prompt = {
         "role": ["system", "user"],
-        "input": [
-            judge_prompt_system,
-            judge_prompt_user_multiturn.replace("___CONVERSATIONS___", pre_convs)
-            .replace("___CRITERIA___", criteria)
-            .replace("___INSTRUCTION___", instruction)
-            .replace("___RESPONSE___", response),
-        ],
+        "input": [system_prompt, user_prompt],
     }
+    if prompt_cache:
+        conversations_start = template.index("___CONVERSATIONS___")
+        prompt["cache_breakpoints"] = [
+            [len(system_prompt)],
+            [conversations_start + conv_end for conv_end in conv_ends],
+        ]
+    return prompt
+
+
+class JudgePromptBudget:
+    """
+    Keep judge prompts within ``max_tokens``. When a multi-turn prompt is over
+    the limit, the previous responses are cut at their center to a common
+    length, the longest one the limit allows. The instructions and the judged
+    turn are kept intact. A prompt that does not fit even without the previous
+    responses is left as it is and only counted as over budget.
+
+    The measured size and the tokens removed are recorded in each prompt as
+    ``judge_prompt_tokens`` and ``judge_compacted_tokens``.
+    """
+
+    def __init__(self, counter, max_tokens):
+        self.counter = counter
+        self.max_tokens = max_tokens
+        self.prompts = 0
+        self.compacted = 0
+        self.over_budget = 0
+        self.max_prompt_tokens = 0
+
+    def count(self, prompt):
+        return self.counter.count_messages(
+            [{"content": message} for message in prompt["input"]]
+        )
+
+    def cap_responses(self, convs, cap):
+        return [
+            (
+                instruction,
+                self.counter.truncate_center(response, cap, COMPACTION_MARKER),
+            )
+            for instruction, response in convs
+        ]
+
+    def fit(self, convs, render):
+        """
+        Render the prompt of ``convs`` with ``render(convs)``, compacting the
+        previous responses when it is over the limit.
+        """
+        prompt = render(convs)
+        tokens = self.count(prompt)
+        compacted_tokens = 0
+        if tokens > self.max_tokens and convs:
+            low = 0
+            high = max(self.counter.count(response) for _, response in convs) - 1
+            fitted = None
+            # the longest common response length that fits
+            while low <= high:
+                cap = (low + high + 1) // 2
+                candidate = render(self.cap_responses(convs, cap))
+                if self.count(candidate) <= self.max_tokens:
+                    fitted = candidate
+                    low = cap + 1
+                else:
+                    high = cap - 1
+            # when even empty responses do not fit, the context is kept
+            if fitted is not None:
+                compacted_tokens = tokens - self.count(fitted)
+                prompt = fitted
+                tokens -= compacted_tokens
+                self.compacted += 1
+
+        self.prompts += 1
+        self.over_budget += int(tokens > self.max_tokens)
+        self.max_prompt_tokens = max(self.max_prompt_tokens, tokens)
+        prompt["judge_prompt_tokens"] = tokens
+        prompt["judge_compacted_tokens"] = compacted_tokens
+        return prompt
+
+    def report(self):
+        return {
+            "max_prompt_tokens": self.max_tokens,
+            "prompts": self.prompts,
+            "compacted_prompts": self.compacted,
+            "over_budget_prompts": self.over_budget,
+            "largest_prompt_tokens": self.max_prompt_tokens,
+        }
+
+
+def create_prompt_budget(model_configs, max_prompt_tokens=-1):
+    """
+    Budget of ``max_prompt_tokens`` for the judge prompts. When it is negative
+    the ``context_window`` of the judge config, less the completion tokens, is
+    used instead, and None is returned when it is not set either.
+    """
+    if max_prompt_tokens < 0:
+        guard = create_context_guard(model_configs)
+        if guard is None:
+            return None
+        return JudgePromptBudget(guard.counter, guard.budget)
+    return JudgePromptBudget(TokenCounter(model_configs), max_prompt_tokens)
 
 
 def parse_score(line):
@@ -78,6 +258,39 @@ def parse_score(line):
         return (False, None)
 
 
+def get_structured_score(line, criteria_count):
+    """
+    Validate a structured judgement into labels, falling back to
+    ``get_score`` when the judge answered in free text.
+    """
+    try:
+        data = json.loads(line)
+    except (TypeError, json.JSONDecodeError):
+        parsed = get_score(line)
+        if len(parsed["labels"]) != criteria_count:
+            return {"result": False, "type": PARSING_ERROR, "labels": []}
+        return parsed
+    if not isinstance(data, dict):
+        return {"result": False, "type": PARSING_ERROR, "labels": []}
+    labels = []
+    for idx in range(criteria_count):
+        label = data.get(f"criteria_{idx + 1}")
+        if label not in JUDGE_LABELS:
+            return {"result": False, "type": PARSING_ERROR, "labels": []}
+        labels.append(label == "PASS")
+    if sum(labels) == len(labels):
+        return {"result": True, "type": "Pass", "labels": labels}
+    else:
+        return {"result": False, "type": "Fail", "labels": labels}
+
+
+def parse_judgement(api_response):
+    judge = api_response["response"][-1]
+    if api_response.get("response_schema"):
+        return get_structured_score(judge, api_response["criteria_count"])
+    return get_score(judge)
+
+
 def get_score(line):
     flag, data = parse_score(line)
     if flag:
@@ -88,17 +301,16 @@ def get_score(line):
             elif data[_key].strip().lower() == "fail":
                 labels.append(False)
             else:
-                return {"result": False, "type": "Parsing Error", "labels": []}
+                return {"result": False, "type": PARSING_ERROR, "labels": []}
         if sum(labels) == len(labels):
             return {"result": True, "type": "Pass", "labels": labels}
         else:
             return {"result": False, "type": "Fail", "labels": labels}
     else:
-        return {"result": False, "type": "Parsing Error", "labels": []}
+        return {"result": False, "type": PARSING_ERROR, "labels": []}
 
 
 def vote_judges(judge0_parsed, judge1_parsed, judge2_parsed):
-    PARSING_ERROR = "Parsing Error"
     is_parsing_errors = [
         judge0_parsed["type"] == PARSING_ERROR,
         judge1_parsed["type"] == PARSING_ERROR,
@@ -144,30 +356,584 @@ def vote_judges(judge0_parsed, judge1_parsed, judge2_parsed):
         return False, "Failed Criteria " + fail_nums
 
 
+def iter_judge_prompts(
+    lines, prompt_cache=False, structured_output=False, compact=False, budget=None
+):
+    """
+    Yield ``(line_idx, turn_idx, line, prompt)`` for the judge prompt of every
+    turn of ``lines``, rendering the prompts lazily. With ``compact``, the
+    judge is asked for the verdicts only. A ``budget`` (``JudgePromptBudget``)
+    compacts the previous turns of prompts over its limit.
+    """
+    criteria_warned = False
+    for line_idx, line in enumerate(lines):
+        convs = []
+        for turn_idx, (criteria, instruction, response) in enumerate(
+            zip(line["criteria"], line["input"], line["response"])
+        ):
+            if (
+                isinstance(criteria, str)
+                and criteria[:2] == '["'
+                and criteria[-2:] == '"]'
+                and not criteria_warned
+            ):
+                criteria_warned = True
+                print(
+                    "Warning : Criteria seems to be mix of string and list, handling as string"
+                )
+
+            def render(convs):
+                if len(convs) < 1:
+                    return build_judge_prompt_singleturn(
+                        criteria, instruction, response, prompt_cache, compact
+                    )
+                return build_judge_prompt_multiturn(
+                    convs, criteria, instruction, response, prompt_cache, compact
+                )
+
+            if budget is None:
+                prompt = render(convs)
+            else:
+                prompt = budget.fit(convs, render)
+            prompt["category"] = line.get("category", "")
+            criteria_count = count_criteria(criteria)
+            if structured_output and criteria_count:
+                prompt["criteria_count"] = criteria_count
+                prompt["response_schema"] = build_judge_response_schema(
+                    criteria_count, compact
+                )
+            convs.append((instruction, response))
+            yield line_idx, turn_idx, line, prompt
+
+
+def build_judge_batch(
+    lines, prompt_cache=False, structured_output=False, compact=False, budget=None
+):
+    return [
+        prompt
+        for _, _, _, prompt in iter_judge_prompts(
+            tqdm(lines), prompt_cache, structured_output, compact, budget
+        )
+    ]
+
+
+def create_judge_adaptor(model_configs):
+    if model_configs["serving_type"] == "vertexai":
+        return VertexaiAdaptor(model_configs)
+    elif model_configs["serving_type"] == "anthropic_vertexai":
+        return AnthropicVertexaiAdaptor(model_configs)
+    else:
+        return OpenaiAdaptor(model_configs)
+
+
+def judge_prompt_of(api_response):
+    """The judge prompt ``api_response`` answered, to send it again."""
+    return {
+        key: value
+        for key, value in api_response.items()
+        if key not in TURN_FIELDS
+        and key not in ("accumulated_conversations", "sample_idx")
+    }
+
+
+def cascade_reason(parsed_samples, margin):
+    """
+    Why the cheap judgements of one prompt are uncertain, None when they are
+    not: a parse error, samples disagreeing on a label, or a verdict mixing
+    PASS and at most ``margin`` FAIL labels.
+    """
+    if any(parsed["type"] == PARSING_ERROR for parsed in parsed_samples):
+        return "parse_error"
+    labels = parsed_samples[0]["labels"]
+    if any(parsed["labels"] != labels for parsed in parsed_samples[1:]):
+        return "disagreement"
+    failed = labels.count(False)
+    if 0 < failed <= margin and failed < len(labels):
+        return "near_threshold"
+    return None
+
+
+def run_cascade(cheap_adaptor, adaptor, batch, margin=1, audit_rate=0.0, seed=0):
+    """
+    Judge ``batch`` with ``cheap_adaptor`` first and resend to ``adaptor``
+    only the prompts whose cheap judgements are uncertain (see
+    ``cascade_reason``), plus ``audit_rate`` of the others to measure how
+    often the tiers agree on the judgements that are not escalated.
+
+    ``cheap_adaptor`` is expected to sample every prompt ``num_samples``
+    times. The verdict of ``adaptor`` is final where it was asked. Returns
+    the judgements in the order of ``batch``, each with a ``judge_tier``, and
+    a report of the escalations and tier agreement per category.
+    """
+    samples = cheap_adaptor.num_samples
+    cheap_responses = cheap_adaptor.inference(batch)
+    rng = random.Random(seed)
+
+    api_responses = []
+    escalated = []
+    reasons = []
+    for idx in range(len(cheap_responses) // samples):
+        group = sorted(
+            cheap_responses[idx * samples : (idx + 1) * samples],
+            key=lambda api_response: api_response.get("sample_idx", 0),
+        )
+        reason = cascade_reason([parse_judgement(r) for r in group], margin)
+        if reason is None and rng.random() < audit_rate:
+            reason = "audit"
+        api_response = group[0]
+        api_response.pop("sample_idx", None)
+        api_response["judge_tier"] = "cheap"
+        api_responses.append(api_response)
+        if reason is not None:
+            escalated.append(idx)
+            reasons.append(reason)
+
+    print(f"Escalating {len(escalated)}/{len(api_responses)} judgements")
+    expensive_responses = adaptor.inference(
+        [judge_prompt_of(api_responses[idx]) for idx in escalated]
+    )
+
+    categories = {}
+    for api_response in api_responses:
+        category = categories.setdefault(
+            api_response.get("category", ""),
+            {"judgements": 0, "escalated": 0}
+            | {reason: 0 for reason in CASCADE_REASONS}
+            | {"compared": 0, "agreed": 0, "audit_compared": 0, "audit_agreed": 0},
+        )
+        category["judgements"] += 1
+    for idx, reason, expensive in zip(escalated, reasons, expensive_responses):
+        cheap_parsed = parse_judgement(api_responses[idx])
+        expensive_parsed = parse_judgement(expensive)
+        category = categories[api_responses[idx].get("category", "")]
+        category["escalated"] += 1
+        category[reason] += 1
+        if PARSING_ERROR not in (cheap_parsed["type"], expensive_parsed["type"]):
+            agreed = cheap_parsed["result"] == expensive_parsed["result"]
+            prefix = "audit_" if reason == "audit" else ""
+            category[prefix + "compared"] += 1
+            category[prefix + "agreed"] += int(agreed)
+        expensive["judge_tier"] = "expensive"
+        api_responses[idx] = expensive
+
+    for category in categories.values():
+        category["escalation_rate"] = round(
+            category["escalated"] / max(category["judgements"], 1), 4
+        )
+        for prefix in ("", "audit_"):
+            category[prefix + "agreement_rate"] = round(
+                category[prefix + "agreed"] / max(category[prefix + "compared"], 1), 4
+            )
+
+    def tokens(responses):
+        return sum(
+            r["input_tokens"][-1] + r["think_tokens"][-1] + r["response_tokens"][-1]
+            for r in responses
+        )
+
+    report = {
+        "judgements": len(api_responses),
+        "cheap_samples": samples,
+        "escalated": len(escalated),
+        "escalation_rate": round(len(escalated) / max(len(api_responses), 1), 4),
+        "reasons": {reason: reasons.count(reason) for reason in CASCADE_REASONS},
+        "cheap_tokens": tokens(cheap_responses),
+        "expensive_tokens": tokens(expensive_responses),
+        "categories": categories,
+    }
+    return api_responses, report
+
+
+def retry_malformed(adaptor, api_responses, max_retries):
+    """
+    Resend the judge prompts whose judgement could not be parsed, at most
+    ``max_retries`` times, and return the responses with the retried ones
+    replaced along with the parse error counts of the run.
+    """
+    api_responses = list(api_responses)
+    malformed = [
+        idx
+        for idx, api_response in enumerate(api_responses)
+        if parse_judgement(api_response)["type"] == PARSING_ERROR
+    ]
+    report = {
+        "judgements": len(api_responses),
+        "parse_errors_first_pass": len(malformed),
+        "parse_retries": 0,
+    }
+    for retry_cnt in range(max_retries):
+        if not malformed:
+            break
+        print(
+            f"Retrying {len(malformed)} malformed judgements ({retry_cnt + 1}/{max_retries})"
+        )
+        prompts = [judge_prompt_of(api_responses[idx]) for idx in malformed]
+        report["parse_retries"] += len(prompts)
+        for idx, api_response in zip(malformed, adaptor.inference(prompts)):
+            api_responses[idx] = api_response
+        malformed = [
+            idx
+            for idx in malformed
+            if parse_judgement(api_responses[idx])["type"] == PARSING_ERROR
+        ]
+    report["parse_errors"] = len(malformed)
+    report["parse_error_rate"] = round(len(malformed) / max(len(api_responses), 1), 4)
+    return api_responses, report
+
+
+class EvalResultWriter:
+    """
+    Write eval results to ``fo`` and count the malformed judgements. With
+    ``hold_malformed``, lines with a malformed judgement are held back until
+    ``retry`` resends their malformed judgements.
+    """
+
+    def __init__(self, fo, hold_malformed):
+        self.fo = fo
+        self.hold_malformed = hold_malformed
+        self.held = []
+        self.judgements = 0
+        self.parse_errors_first_pass = 0
+
+    def add(self, line, api_responses):
+        malformed = sum(
+            1
+            for api_response in api_responses
+            if parse_judgement(api_response)["type"] == PARSING_ERROR
+        )
+        self.judgements += len(api_responses)
+        self.parse_errors_first_pass += malformed
+        if malformed and self.hold_malformed:
+            self.held.append((line, api_responses))
+            return
+        self.write(line, api_responses)
+
+    def write(self, line, api_responses):
+        dt = build_eval_result(line, iter(api_responses))
+        json.dump(dt, self.fo, ensure_ascii=False)
+        self.fo.write("\n")
+
+    def retry(self, adaptor, max_retries):
+        """Retry the held lines, write them and return the parse error report."""
+        api_responses, retry_report = retry_malformed(
+            adaptor,
+            [api_response for _, responses in self.held for api_response in responses],
+            max_retries,
+        )
+        api_responses = iter(api_responses)
+        for line, responses in self.held:
+            self.write(line, [next(api_responses) for _ in responses])
+        self.held = []
+        parse_errors = self.parse_errors_first_pass
+        if self.hold_malformed:
+            parse_errors = retry_report["parse_errors"]
+        return {
+            "judgements": self.judgements,
+            "parse_errors_first_pass": self.parse_errors_first_pass,
+            "parse_retries": retry_report["parse_retries"],
+            "parse_errors": parse_errors,
+            "parse_error_rate": round(parse_errors / max(self.judgements, 1), 4),
+        }
+
+
+async def judge_stream(
+    adaptor,
+    lines,
+    writer,
+    prompt_cache=False,
+    structured_output=False,
+    total=0,
+    compact=False,
+    budget=None,
+):
+    """
+    Judge ``lines`` through ``adaptor.inference_stream`` and hand each line to
+    ``writer`` as soon as all of its turns are judged. Only the lines with
+    judge prompts in flight are kept in memory.
+    """
+    await judge_files_stream(
+        adaptor,
+        [(lines, writer)],
+        prompt_cache,
+        structured_output,
+        total,
+        compact,
+        budget,
+    )
+
+
+async def judge_files_stream(
+    adaptor,
+    sources,
+    prompt_cache=False,
+    structured_output=False,
+    total=0,
+    compact=False,
+    budget=None,
+):
+    """
+    ``judge_stream`` over several result files sharing one adaptor.
+    ``sources`` is a list of ``(lines, writer)`` pairs. The next prompt always
+    comes from the file with the fewest prompts in flight, so the files share
+    ``semaphore_max_count`` evenly and a file running out of prompts leaves
+    its share to the others.
+    """
+    pending = {}
+    in_flight = [0] * len(sources)
+
+    def judged_lines(lines, writer):
+        # lines without a single complete turn have no prompt to wait for
+        for line in lines:
+            if count_judge_turns(line) == 0:
+                writer.add(line, [])
+                continue
+            yield line
+
+    prompts = {
+        file_idx: iter_judge_prompts(
+            judged_lines(lines, writer),
+            prompt_cache,
+            structured_output,
+            compact,
+            budget,
+        )
+        for file_idx, (lines, writer) in enumerate(sources)
+    }
+
+    def requests():
+        while prompts:
+            file_idx = min(prompts, key=lambda file_idx: in_flight[file_idx])
+            item = next(prompts[file_idx], None)
+            if item is None:
+                del prompts[file_idx]
+                continue
+            line_idx, turn_idx, line, prompt = item
+            if turn_idx == 0:
+                pending[(file_idx, line_idx)] = {
+                    "line": line,
+                    "api_responses": [None] * count_judge_turns(line),
+                    "remaining": count_judge_turns(line),
+                }
+            prompt["file_idx"] = file_idx
+            prompt["line_idx"] = line_idx
+            prompt["turn_idx"] = turn_idx
+            in_flight[file_idx] += 1
+            yield prompt
+
+    async for api_response in adaptor.inference_stream(requests(), total):
+        file_idx = api_response["file_idx"]
+        in_flight[file_idx] -= 1
+        key = (file_idx, api_response["line_idx"])
+        entry = pending[key]
+        entry["api_responses"][api_response["turn_idx"]] = api_response
+        entry["remaining"] -= 1
+        if entry["remaining"] == 0:
+            del pending[key]
+            sources[file_idx][1].add(entry["line"], entry["api_responses"])
+
+
+def judge_files(
+    adaptor,
+    eval_files,
+    output_path,
+    prompt_cache=False,
+    structured_output=False,
+    compact=False,
+    budget=None,
+    parse_retries=2,
+):
+    """
+    Judge several inference result files in one run of ``adaptor`` and write
+    the ``_eval_result.jsonl`` and ``_judge_metrics.json`` of each file. The
+    run summary of the metrics files covers the whole run.
+    """
+    names = [eval_file.name.removesuffix(".jsonl") for eval_file in eval_files]
+    if len(set(names)) < len(names):
+        raise ValueError("eval files with the same name would share their outputs")
+    total = sum(
+        count_judge_turns(line)
+        for eval_file in eval_files
+        for line in iter_inference_result(eval_file)
+    )
+    with ExitStack() as stack:
+        writers = [
+            EvalResultWriter(
+                stack.enter_context(
+                    open(
+                        os.path.join(output_path, name + "_eval_result.jsonl"),
+                        "a",
+                        encoding="utf-8",
+                    )
+                ),
+                hold_malformed=parse_retries > 0,
+            )
+            for name in names
+        ]
+        adaptor.run_async(
+            judge_files_stream(
+                adaptor,
+                [
+                    (iter_inference_result(eval_file), writer)
+                    for eval_file, writer in zip(eval_files, writers)
+                ],
+                prompt_cache,
+                structured_output,
+                total,
+                compact,
+                budget,
+            )
+        )
+        summary = adaptor.metrics.summary()
+        if budget is not None:
+            summary["prompt_budget"] = budget.report()
+        for name, writer in zip(names, writers):
+            parse_report = writer.retry(adaptor, parse_retries)
+            print(
+                f"{name} parse errors : "
+                f"{parse_report['parse_errors']}/{parse_report['judgements']}"
+                f" (first pass {parse_report['parse_errors_first_pass']})"
+            )
+            with open(
+                os.path.join(output_path, name + "_judge_metrics.json"),
+                "w",
+                encoding="utf-8",
+            ) as f:
+                json.dump(summary | parse_report, f, ensure_ascii=False, indent=4)
+
+
+def build_eval_result(line, api_responses):
+    """Collect the judgements of ``line`` from the ``api_responses`` iterator."""
+    is_passed = True
+    judges = []
+    judge_parseds = []
+    vote_logs = []
+    judge_input_tokens = []
+    judge_think_tokens = []
+    judge_response_tokens = []
+    judge_cached_tokens = []
+    judge_elapsed_time = []
+    judge_tiers = []
+    judge_prompt_tokens = []
+    judge_compacted_tokens = []
+    judge_turns = count_judge_turns(line)
+    if judge_turns < len(line["criteria"]):
+        # a turn without a response cannot pass
+        print(
+            f"index {line['index']}: no response for "
+            f"{len(line['criteria']) - judge_turns}/{len(line['criteria'])} turns,"
+            " marked as failed"
+        )
+        is_passed = False
+    for _ in range(judge_turns):
+        api_response = next(api_responses)
+        if "judge_tier" in api_response:
+            judge_tiers.append(api_response["judge_tier"])
+        if "judge_prompt_tokens" in api_response:
+            judge_prompt_tokens.append(api_response["judge_prompt_tokens"])
+            judge_compacted_tokens.append(api_response["judge_compacted_tokens"])
+        judge = api_response["response"][-1]
+        judge_elapsed_time.append(api_response["elapsed_time"][-1])
+        judge_input_tokens.append(api_response["input_tokens"][-1])
+        judge_think_tokens.append(api_response["think_tokens"][-1])
+        judge_response_tokens.append(api_response["response_tokens"][-1])
+        judge_cached_tokens.append(api_response["cached_tokens"][-1])
+        judge_parsed = parse_judgement(api_response)
+
+        if judge_parsed["result"] is False:
+            is_passed = False
+
+        judges.append(judge)
+        judge_parseds.append(judge_parsed)
+
+    eval_result = {
+        "index": line["index"],
+        "category": line["category"],
+        "language": line["language"],
+        "sub_category": line["sub_category"],
+        "turns": line["turns"],
+        "criteria": line["criteria"],
+        "input": line["input"],
+        "response": line["response"],
+        "think": line["think"],
+        "inference_elapsed_time": line["elapsed_time"],
+        "inference_input_tokens": line.get("input_tokens", []),
+        "inference_think_tokens": line.get("think_tokens", []),
+        "inference_response_tokens": line.get("response_tokens", []),
+        "inference_first_token_time": line.get("first_token_time", []),
+        "inference_repetition_aborted": line.get("repetition_aborted", []),
+        "judge_elapsed_time": judge_elapsed_time,
+        "judge_input_tokens": judge_input_tokens,
+        "judge_think_tokens": judge_think_tokens,
+        "judge_response_tokens": judge_response_tokens,
+        "judge_cached_tokens": judge_cached_tokens,
+        "judge": judges,
+        "judge_parsed": judge_parseds,
+        "vote_logs": vote_logs,
+        "pass": is_passed,
+    }
+    for key in ("sample_weight", "sample_idx"):
+        if key in line:
+            eval_result[key] = line[key]
+    if judge_tiers:
+        eval_result["judge_tiers"] = judge_tiers
+    if judge_prompt_tokens:
+        eval_result["judge_prompt_tokens"] = judge_prompt_tokens
+        eval_result["judge_compacted_tokens"] = judge_compacted_tokens
+    return eval_result
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--config")
-    parser.add_argument("--eval_file", type=str, required=True)
+    parser.add_argument("--eval_file", type=str, nargs="+", required=True)
     parser.add_argument("--output_path", type=str, default="eval_results/")
+    parser.add_argument("--metrics_port", type=int, default=-1)
+    parser.add_argument("--metrics_host", type=str, default="127.0.0.1")
+    parser.add_argument("--metrics_textfile", type=str, default=None)
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--profile_sample_path", type=str, default=None)
+    parser.add_argument("--prompt_cache", action="store_true")
+    parser.add_argument("--dry_run", action="store_true")
+    parser.add_argument("--history", type=str, nargs="*", default=[])
+    parser.add_argument("--batch", action="store_true")
+    parser.add_argument("--schedule", type=str, default=None, choices=SCHEDULES)
+    parser.add_argument("--structured_output", action="store_true")
+    parser.add_argument("--parse_retries", type=int, default=2)
+    parser.add_argument("--compact_prompt", action="store_true")
+    parser.add_argument("--max_prompt_tokens", type=int, default=-1)
+    parser.add_argument("--cascade_config", type=str, default=None)
+    parser.add_argument("--cascade_samples", type=int, default=2)
+    parser.add_argument("--cascade_margin", type=int, default=1)
+    parser.add_argument("--cascade_audit", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
     args = parser.parse_args()
 
+    profiler = None
+    if args.profile:
+        profiler = Profiler(sample_path=args.profile_sample_path)
+        profiler.start()
+
     print(args.eval_file)
-    args.eval_file = args.eval_file.replace("\\", "/")
 
     model_configs = get_model_configs(args.config)
-    if model_configs["serving_type"] == "vertexai":
-        inference_adaptor = VertexaiAdaptor(model_configs)
-    elif model_configs["serving_type"] == "anthropic_vertexai":
-        inference_adaptor = AnthropicVertexaiAdaptor(model_configs)
-    else:
-        inference_adaptor = OpenaiAdaptor(model_configs)
     output_path = args.output_path
 
     script_dir = Path(__file__).resolve().parent
-    eval_file = (script_dir / args.eval_file).resolve()
+    eval_files = [
+        Path(path).resolve()
+        for pattern in args.eval_file
+        for path in sorted(glob.glob(str(script_dir / pattern.replace("\\", "/"))))
+        or [script_dir / pattern.replace("\\", "/")]
+    ]
+    eval_file = eval_files[0]
     output_path = (script_dir / args.output_path).resolve()
-
-    df = load_inference_result(eval_file)
+    if len(eval_files) > 1 and (
+        args.dry_run or args.batch or args.schedule or args.cascade_config
+    ):
+        parser.error(
+            "several eval files are judged in one stream, "
+            "without --dry_run, --batch, --schedule or --cascade_config"
+        )
 
     create_directory_if_not_exists(output_path)
 
@@ -175,83 +941,171 @@ if __name__ == "__main__":
 
     output_file = os.path.join(output_path, eval_filename + "_eval_result.jsonl")
 
-    batch = []
-    criteria_warned = False
-    for line in tqdm(df.iter_rows(named=True)):
-        convs = []
-        for criteria, instruction, response in zip(
-            line["criteria"], line["input"], line["response"]
-        ):
-            if (
-                isinstance(criteria, str)
-                and criteria[:2] == '["'
-                and criteria[-2:] == '"]'
-                and not criteria_warned
-            ):
-                criteria_warned = True
-                print(
-                    "Warning : Criteria seems to be mix of string and list, handling as string"
+    budget = create_prompt_budget(model_configs, args.max_prompt_tokens)
+
+    if args.dry_run:
+        estimate = estimate_run(
+            (
+                prompt
+                for _, _, _, prompt in iter_judge_prompts(
+                    iter_inference_result(eval_file),
+                    args.prompt_cache,
+                    args.structured_output,
+                    args.compact_prompt,
+                    budget,
                 )
-            if len(convs) < 1:
-                prompt = build_judge_prompt_singleturn(criteria, instruction, response)
-            else:
-                prompt = build_judge_prompt_multiturn(
-                    convs, criteria, instruction, response
+            ),
+            model_configs,
+            RunHistory(args.history, prefix="judge_"),
+            TokenCounter(model_configs),
+        )
+        report_estimate(
+            estimate, os.path.join(output_path, eval_filename + "_judge_dry_run.json")
+        )
+        sys.exit(0)
+
+    inference_adaptor = create_judge_adaptor(model_configs)
+    inference_adaptor.metrics.configure(
+        textfile_path=args.metrics_textfile,
+        port=args.metrics_port,
+        host=args.metrics_host,
+    )
+    if len(eval_files) > 1:
+        print(f"{len(eval_files)} eval files judged together")
+        with profile_stage("judge_files"):
+            judge_files(
+                inference_adaptor,
+                eval_files,
+                output_path,
+                args.prompt_cache,
+                args.structured_output,
+                args.compact_prompt,
+                budget,
+                args.parse_retries,
+            )
+        inference_adaptor.terminate()
+        inference_adaptor.metrics.close()
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(os.path.join(output_path, "judge_files_profile.json"))
+        sys.exit(0)
+
+    batch_state_path = os.path.join(
+        output_path, eval_filename + "_judge_batch_state.json"
+    )
+    if args.batch:
+        inference_adaptor.enable_batch(batch_state_path)
+
+    with open(output_file, "a", encoding="utf-8") as fo:
+        writer = EvalResultWriter(fo, hold_malformed=args.parse_retries > 0)
+        if args.batch or args.schedule or args.cascade_config:
+            # batch jobs, schedules and cascades are built from every judge prompt
+            with profile_stage("build_prompts"):
+                lines = list(iter_inference_result(eval_file))
+                batch = build_judge_batch(
+                    lines,
+                    args.prompt_cache,
+                    args.structured_output,
+                    args.compact_prompt,
+                    budget,
                 )
-            convs.append((instruction, response))
-            batch.append(prompt)
 
-    api_responses = inference_adaptor.inference(batch)
-    inference_adaptor.terminate()
+            with profile_stage("judge_inference"):
+                if args.cascade_config:
+                    cheap_adaptor = create_judge_adaptor(
+                        get_model_configs(args.cascade_config)
+                        | {"num_samples": args.cascade_samples}
+                    )
+                    api_responses, cascade_report = run_cascade(
+                        cheap_adaptor,
+                        inference_adaptor,
+                        batch,
+                        args.cascade_margin,
+                        args.cascade_audit,
+                        args.seed,
+                    )
+                    cheap_adaptor.terminate()
+                    cheap_adaptor.metrics.close()
+                    with open(
+                        os.path.join(
+                            output_path, eval_filename + "_judge_cascade.json"
+                        ),
+                        "w",
+                        encoding="utf-8",
+                    ) as f:
+                        json.dump(cascade_report, f, ensure_ascii=False, indent=4)
+                elif args.schedule:
+                    api_responses, schedule_report = run_scheduled(
+                        inference_adaptor,
+                        batch,
+                        model_configs,
+                        RunHistory(args.history, prefix="judge_"),
+                        TokenCounter(model_configs),
+                        args.schedule,
+                    )
+                    report_schedule(
+                        schedule_report,
+                        os.path.join(
+                            output_path, eval_filename + "_judge_schedule.json"
+                        ),
+                    )
+                else:
+                    api_responses = inference_adaptor.inference(batch)
 
-    for line in tqdm(df.iter_rows(named=True)):
-        is_passed = True
-        judges = []
-        judge_parseds = []
-        vote_logs = []
-        judge_input_tokens = []
-        judge_think_tokens = []
-        judge_response_tokens = []
-        judge_elapsed_time = []
-        for criteria in line["criteria"]:
-            api_response = api_responses.pop(0)
-            judge = api_response["response"][-1]
-            judge_elapsed_time.append(api_response["elapsed_time"][-1])
-            judge_input_tokens.append(api_response["input_tokens"][-1])
-            judge_think_tokens.append(api_response["think_tokens"][-1])
-            judge_response_tokens.append(api_response["response_tokens"][-1])
-            judge_parsed = get_score(judge)
-
-            if judge_parsed["result"] is False:
-                is_passed = False
-
-            judges.append(judge)
-            judge_parseds.append(judge_parsed)
-
-        dt = {
-            "index": line["index"],
-            "category": line["category"],
-            "language": line["language"],
-            "sub_category": line["sub_category"],
-            "turns": line["turns"],
-            "criteria": line["criteria"],
-            "input": line["input"],
-            "response": line["response"],
-            "think": line["think"],
-            "inference_elapsed_time": line["elapsed_time"],
-            "inference_input_tokens": line.get("input_tokens", []),
-            "inference_think_tokens": line.get("think_tokens", []),
-            "inference_response_tokens": line.get("response_tokens", []),
-            "judge_elapsed_time": judge_elapsed_time,
-            "judge_input_tokens": judge_input_tokens,
-            "judge_think_tokens": judge_think_tokens,
-            "judge_response_tokens": judge_response_tokens,
-            "judge": judges,
-            "judge_parsed": judge_parseds,
-            "vote_logs": vote_logs,
-            "pass": is_passed,
-        }
+            with profile_stage("write_results"):
+                api_responses = iter(api_responses)
+                for line in tqdm(lines):
+                    writer.add(
+                        line,
+                        [next(api_responses) for _ in range(count_judge_turns(line))],
+                    )
+        else:
+            with profile_stage("load_results"):
+                total = sum(
+                    count_judge_turns(line) for line in iter_inference_result(eval_file)
+                )
+            with profile_stage("judge_stream"):
+                inference_adaptor.run_async(
+                    judge_stream(
+                        inference_adaptor,
+                        iter_inference_result(eval_file),
+                        writer,
+                        args.prompt_cache,
+                        args.structured_output,
+                        total,
+                        args.compact_prompt,
+                        budget,
+                    )
+                )
+        summary = inference_adaptor.metrics.summary()
 
-        with open(output_file, "a", encoding="utf-8") as fo:
-            json.dump(dt, fo, ensure_ascii=False)
-            fo.write("\n")
+        with profile_stage("parse_retries"):
+            # the few malformed judgements are resent online
+            inference_adaptor.batch_runner = None
+            parse_report = writer.retry(inference_adaptor, args.parse_retries)
+    print(
+        f"Parse errors : {parse_report['parse_errors']}/{parse_report['judgements']}"
+        f" (first pass {parse_report['parse_errors_first_pass']})"
+    )
+    if budget is not None:
+        summary["prompt_budget"] = budget.report()
+        print(
+            f"Compacted judge prompts : {budget.compacted}/{budget.prompts}"
+            f" ({budget.over_budget} still over {budget.max_tokens} tokens)"
+        )
+    inference_adaptor.terminate()
+    with open(
+        os.path.join(output_path, eval_filename + "_judge_metrics.json"),
+        "w",
+        encoding="utf-8",
+    ) as f:
+        json.dump(summary | parse_report, f, ensure_ascii=False, indent=4)
+    inference_adaptor.metrics.close()
+    if args.batch:
+        os.remove(batch_state_path)
+
+    if profiler is not None:
+        profiler.stop()
+        profiler.write(
+            os.path.join(output_path, eval_filename + "_judge_profile.json")
+        )
@@ -0,0 +1,622 @@
+import argparse
+import email.parser
+import email.policy
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+FILLER_WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "elit"]
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def messages_text(messages):
+    text = ""
+    for message in messages:
+        content = message.get("content", "")
+        if isinstance(content, list):
+            content = "".join(
+                block.get("text", "") for block in content if isinstance(block, dict)
+            )
+        text += content
+    return text
+
+
+def gemini_text(body):
+    text = ""
+    for content in body.get("contents", []):
+        for part in content.get("parts", []):
+            text += part.get("text", "")
+    return text
+
+
+def schema_instance(schema):
+    """Smallest value matching a JSON schema, the first choice of every enum."""
+    if "enum" in schema:
+        return schema["enum"][0]
+    schema_type = str(schema.get("type", "string")).lower()
+    if schema_type == "object":
+        return {
+            name: schema_instance(prop)
+            for name, prop in schema.get("properties", {}).items()
+        }
+    if schema_type == "array":
+        return [schema_instance(schema.get("items", {}))]
+    if schema_type in ("integer", "number"):
+        return 0
+    if schema_type == "boolean":
+        return True
+    return "mock"
+
+
+def openai_schema(body):
+    response_format = body.get("response_format") or {}
+    return response_format.get("json_schema", {}).get("schema")
+
+
+def chat_completion(body, text):
+    prompt_tokens = estimate_tokens(messages_text(body.get("messages", [])))
+    n = body.get("n", 1)
+    completion_tokens = estimate_tokens(text) * n
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "mock"),
+        "choices": [
+            {
+                "index": idx,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop",
+            }
+            for idx in range(n)
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+class MockBehavior:
+    """Latency, token rate and error injection settings of the mock server."""
+
+    def __init__(
+        self,
+        latency_dist="fixed",
+        latency_mean=0.5,
+        latency_sigma=0.5,
+        tokens_per_sec=0.0,
+        output_tokens=128,
+        rate_429=0.0,
+        rate_5xx=0.0,
+        rate_malformed=0.0,
+        seed=None,
+    ):
+        self.latency_dist = latency_dist
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.tokens_per_sec = tokens_per_sec
+        self.output_tokens = output_tokens
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.rate_malformed = rate_malformed
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def first_token_latency(self):
+        with self.lock:
+            if self.latency_dist == "uniform":
+                return self.random.uniform(0, 2 * self.latency_mean)
+            if self.latency_dist == "lognormal":
+                return self.random.lognormvariate(0, self.latency_sigma) * (
+                    self.latency_mean
+                )
+            return self.latency_mean
+
+    def injected_error(self):
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.rate_429:
+            return 429
+        if draw < self.rate_429 + self.rate_5xx:
+            return 503
+        return None
+
+    def token_interval(self):
+        return 1.0 / self.tokens_per_sec if self.tokens_per_sec > 0 else 0.0
+
+    def malformed(self):
+        with self.lock:
+            return self.random.random() < self.rate_malformed
+
+    def completion(self, prompt, max_tokens=None, schema=None):
+        """
+        Return the list of output chunks (one per token) for ``prompt``, a
+        JSON object following ``schema`` when a structured output is requested.
+        """
+        criteria = re.search(
+            r"<\|Criteria START\|>\n(.*?)\n<\|Criteria END\|>", prompt, re.S
+        )
+        if schema:
+            text = json.dumps(schema_instance(schema))
+        elif criteria:
+            # answer judge prompts with a parsable verdict
+            count = len(re.findall(r"^\d+\. ", criteria.group(1), re.M)) or 1
+            verdict = {f"criterion_{idx + 1}": "PASS" for idx in range(count)}
+            text = "```json\n" + json.dumps(verdict) + "\n```"
+        if schema or criteria:
+            if self.malformed():
+                text = text[: len(text) // 2]
+            return [text[i : i + 4] for i in range(0, len(text), 4)]
+        count = self.output_tokens
+        if max_tokens:
+            count = min(count, max_tokens)
+        return [f"{FILLER_WORDS[i % len(FILLER_WORDS)]} " for i in range(count)]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        data = self.rfile.read(length)
+        path = urlparse(self.path).path
+        behavior = self.server.behavior
+
+        if path.endswith("/files"):
+            self.upload_file(data)
+            return
+        body = json.loads(data or b"{}")
+        if path.endswith("/batches"):
+            self.create_batch(body)
+            return
+
+        status = behavior.injected_error()
+        if status is not None:
+            self.send_json(
+                status, {"error": {"code": status, "message": "injected error"}}
+            )
+            return
+
+        time.sleep(behavior.first_token_latency())
+        if path.endswith("/chat/completions"):
+            self.openai_chat(body)
+        elif path.endswith("/messages") or "publishers/anthropic" in path:
+            self.anthropic_messages(body, path)
+        elif ":generateContent" in path or ":streamGenerateContent" in path:
+            self.gemini_generate(body, path)
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": "not found"}})
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        parts = path.strip("/").split("/")
+        if len(parts) >= 2 and parts[-2] == "batches":
+            batch = self.server.batches.get(parts[-1])
+            if batch is not None:
+                self.send_json(200, batch)
+                return
+        elif len(parts) >= 3 and parts[-3] == "files" and parts[-1] == "content":
+            content = self.server.files.get(parts[-2], {}).get("content")
+            if content is not None:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+                return
+        self.send_json(404, {"error": {"code": 404, "message": "not found"}})
+
+    def upload_file(self, data):
+        header = f"Content-Type: {self.headers.get('Content-Type')}\r\n\r\n"
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            header.encode("utf-8") + data
+        )
+        fields = {
+            part.get_param("name", header="content-disposition"): part
+            for part in message.iter_parts()
+        }
+        file_part = fields["file"]
+        purpose = fields["purpose"].get_payload(decode=True).decode("utf-8")
+        file_object = self.server.add_file(
+            file_part.get_payload(decode=True), file_part.get_filename(), purpose
+        )
+        self.send_json(200, file_object)
+
+    def create_batch(self, body):
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        batch = {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": body["endpoint"],
+            "input_file_id": body["input_file_id"],
+            "completion_window": body["completion_window"],
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "output_file_id": None,
+            "error_file_id": None,
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        self.server.batches[batch_id] = batch
+        threading.Thread(
+            target=self.server.run_batch, args=(batch_id,), daemon=True
+        ).start()
+        self.send_json(200, batch)
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+    def send_event(self, payload, event=None):
+        data = ""
+        if event is not None:
+            data += f"event: {event}\n"
+        if not isinstance(payload, str):
+            payload = json.dumps(payload)
+        data += f"data: {payload}\n\n"
+        self.wfile.write(data.encode("utf-8"))
+        self.wfile.flush()
+
+    def generate_chunks(self, prompt, max_tokens, schema=None):
+        behavior = self.server.behavior
+        interval = behavior.token_interval()
+        for chunk in behavior.completion(prompt, max_tokens, schema):
+            if interval:
+                time.sleep(interval)
+            yield chunk
+
+    def openai_chat(self, body):
+        prompt = messages_text(body.get("messages", []))
+        max_tokens = body.get("max_completion_tokens") or body.get("max_tokens")
+        n = body.get("n", 1)
+        model = body.get("model", "mock")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        prompt_tokens = estimate_tokens(prompt)
+        schema = openai_schema(body)
+
+        if body.get("stream"):
+            self.start_stream()
+            completion_tokens = 0
+            for chunk in self.generate_chunks(prompt, max_tokens, schema):
+                completion_tokens += n
+                choices = [
+                    {"index": idx, "delta": {"content": chunk}, "finish_reason": None}
+                    for idx in range(n)
+                ]
+                self.send_event(
+                    {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": model,
+                        "choices": choices,
+                    }
+                )
+            choices = [
+                {"index": idx, "delta": {}, "finish_reason": "stop"} for idx in range(n)
+            ]
+            self.send_event(
+                {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": choices,
+                }
+            )
+            if body.get("stream_options", {}).get("include_usage"):
+                self.send_event(
+                    {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": model,
+                        "choices": [],
+                        "usage": {
+                            "prompt_tokens": prompt_tokens,
+                            "completion_tokens": completion_tokens,
+                            "total_tokens": prompt_tokens + completion_tokens,
+                        },
+                    }
+                )
+            self.send_event("[DONE]")
+            return
+
+        text = "".join(self.generate_chunks(prompt, max_tokens, schema))
+        self.send_json(200, chat_completion(body, text))
+
+    def anthropic_messages(self, body, path):
+        system = body.get("system", "")
+        if isinstance(system, list):
+            system = messages_text([{"content": system}])
+        prompt = system + messages_text(body.get("messages", []))
+        message_id = f"msg_{uuid.uuid4().hex}"
+        model = body.get("model", "mock")
+        input_tokens = estimate_tokens(prompt)
+        message = {
+            "id": message_id,
+            "type": "message",
+            "role": "assistant",
+            "model": model,
+            "content": [],
+            "stop_reason": None,
+            "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": 0},
+        }
+
+        # a structured output is requested as a call of the only tool
+        tool = (body.get("tools") or [None])[0]
+        schema = tool["input_schema"] if tool else None
+        block = {"type": "text", "text": ""}
+        if tool:
+            block = {
+                "type": "tool_use",
+                "id": f"toolu_{uuid.uuid4().hex}",
+                "name": tool["name"],
+                "input": {},
+            }
+
+        if body.get("stream") or path.endswith(":streamRawPredict"):
+            self.start_stream()
+            self.send_event(
+                {"type": "message_start", "message": message}, "message_start"
+            )
+            self.send_event(
+                {"type": "content_block_start", "index": 0, "content_block": block},
+                "content_block_start",
+            )
+            output_tokens = 0
+            for chunk in self.generate_chunks(prompt, body.get("max_tokens"), schema):
+                output_tokens += 1
+                delta = {"type": "text_delta", "text": chunk}
+                if tool:
+                    delta = {"type": "input_json_delta", "partial_json": chunk}
+                self.send_event(
+                    {"type": "content_block_delta", "index": 0, "delta": delta},
+                    "content_block_delta",
+                )
+            self.send_event(
+                {"type": "content_block_stop", "index": 0}, "content_block_stop"
+            )
+            self.send_event(
+                {
+                    "type": "message_delta",
+                    "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                    "usage": {"output_tokens": output_tokens},
+                },
+                "message_delta",
+            )
+            self.send_event({"type": "message_stop"}, "message_stop")
+            return
+
+        text = "".join(self.generate_chunks(prompt, body.get("max_tokens"), schema))
+        message["content"] = [{"type": "text", "text": text}]
+        if tool:
+            try:
+                message["content"] = [block | {"input": json.loads(text)}]
+            except json.JSONDecodeError:
+                # a truncated verdict stays text
+                pass
+        message["stop_reason"] = "end_turn"
+        message["usage"]["output_tokens"] = estimate_tokens(text)
+        self.send_json(200, message)
+
+    def gemini_generate(self, body, path):
+        system = gemini_text({"contents": [body.get("systemInstruction", {})]})
+        prompt = system + gemini_text(body)
+        max_tokens = body.get("generationConfig", {}).get("maxOutputTokens")
+        schema = body.get("generationConfig", {}).get("responseSchema")
+        prompt_tokens = estimate_tokens(prompt)
+
+        def response(text, candidates_tokens):
+            return {
+                "candidates": [
+                    {
+                        "content": {"role": "model", "parts": [{"text": text}]},
+                        "finishReason": "STOP",
+                    }
+                ],
+                "usageMetadata": {
+                    "promptTokenCount": prompt_tokens,
+                    "candidatesTokenCount": candidates_tokens,
+                    "totalTokenCount": prompt_tokens + candidates_tokens,
+                },
+            }
+
+        if ":streamGenerateContent" in path:
+            self.start_stream()
+            output_tokens = 0
+            for chunk in self.generate_chunks(prompt, max_tokens, schema):
+                output_tokens += 1
+                self.send_event(response(chunk, output_tokens))
+            return
+
+        text = "".join(self.generate_chunks(prompt, max_tokens, schema))
+        self.send_json(200, response(text, estimate_tokens(text)))
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the OpenAI chat completions, files and batches,
+    Anthropic messages and Gemini generateContent endpoints. Responses are
+    filler text, except for judge prompts which get a parsable PASS verdict for
+    every criterion and structured output requests which get an instance of
+    the requested schema. ``rate_malformed`` of these verdicts are truncated.
+
+    Batches are processed in a background thread after one first token
+    latency, injected errors go to the error file of the batch.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host, port, behavior):
+        super().__init__((host, port), MockHandler)
+        self.behavior = behavior
+        self.files = {}
+        self.batches = {}
+
+    def handle_error(self, request, client_address):
+        # clients drop the connections of cancelled requests (hedging, aborts)
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def add_file(self, content, filename, purpose):
+        file_id = f"file-{uuid.uuid4().hex}"
+        file_object = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        self.files[file_id] = file_object | {"content": content}
+        return file_object
+
+    def run_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        time.sleep(self.behavior.first_token_latency())
+        lines = self.files[batch["input_file_id"]]["content"].decode("utf-8")
+        outputs = []
+        errors = []
+        for line in lines.splitlines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            result = {
+                "id": f"batch_req_{uuid.uuid4().hex}",
+                "custom_id": entry["custom_id"],
+            }
+            status = self.behavior.injected_error()
+            if status is not None:
+                errors.append(
+                    result
+                    | {
+                        "response": {
+                            "status_code": status,
+                            "body": {"error": {"message": "injected error"}},
+                        },
+                        "error": None,
+                    }
+                )
+                continue
+            body = entry["body"]
+            prompt = messages_text(body.get("messages", []))
+            max_tokens = body.get("max_completion_tokens") or body.get("max_tokens")
+            text = "".join(
+                self.behavior.completion(prompt, max_tokens, openai_schema(body))
+            )
+            outputs.append(
+                result
+                | {
+                    "response": {
+                        "status_code": 200,
+                        "body": chat_completion(body, text),
+                    },
+                    "error": None,
+                }
+            )
+
+        for key, results in (("output_file_id", outputs), ("error_file_id", errors)):
+            if results:
+                content = "".join(json.dumps(result) + "\n" for result in results)
+                batch[key] = self.add_file(
+                    content.encode("utf-8"), f"{batch_id}.jsonl", "batch_output"
+                )["id"]
+        batch["request_counts"] = {
+            "total": len(outputs) + len(errors),
+            "completed": len(outputs),
+            "failed": len(errors),
+        }
+        batch["status"] = "completed"
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def add_behavior_arguments(parser):
+    parser.add_argument(
+        "--latency_dist",
+        type=str,
+        default="fixed",
+        choices=["fixed", "uniform", "lognormal"],
+    )
+    parser.add_argument("--latency_mean", type=float, default=0.5)
+    parser.add_argument("--latency_sigma", type=float, default=0.5)
+    parser.add_argument("--tokens_per_sec", type=float, default=0.0)
+    parser.add_argument("--output_tokens", type=int, default=128)
+    parser.add_argument("--rate_429", type=float, default=0.0)
+    parser.add_argument("--rate_5xx", type=float, default=0.0)
+    parser.add_argument("--rate_malformed", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def behavior_from_args(args):
+    return MockBehavior(
+        latency_dist=args.latency_dist,
+        latency_mean=args.latency_mean,
+        latency_sigma=args.latency_sigma,
+        tokens_per_sec=args.tokens_per_sec,
+        output_tokens=args.output_tokens,
+        rate_429=args.rate_429,
+        rate_5xx=args.rate_5xx,
+        rate_malformed=args.rate_malformed,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    add_behavior_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockLLMServer(args.host, args.port, behavior_from_args(args))
+    print(f"Mock LLM server listening on {server.url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
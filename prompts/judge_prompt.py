@@ -122,3 +122,48 @@ ___INSTRUCTION___
 <|Assistant Response START|>
 ___RESPONSE___
 <|Assistant Response END|>"""
+
+# Same sections as judge_prompt_user_multiturn with the previous conversations
+# first, so that judge prompts of consecutive turns share a cacheable prefix.
+judge_prompt_user_multiturn_conversations_first = """\
+<|Previous Conversations START|>
+___CONVERSATIONS___
+<|Previous Conversations END|>
+
+<|Criteria START|>
+___CRITERIA___
+<|Criteria END|>
+
+<|User Instruction START|>
+___INSTRUCTION___
+<|User Instruction END|>
+
+<|Assistant Response START|>
+___RESPONSE___
+<|Assistant Response END|>"""
+
+# Verdict-only variant of judge_prompt_system: the same notes, but the judge
+# outputs the per-criterion JSON without the analysis and reasoning sections.
+judge_prompt_system_compact = judge_prompt_system.replace(
+    """\
+  (1) Instruction Analysis: First, analyze the User Instruction to determine what question the User asked and how it should be addressed.
+  (2) Criteria Judgement: Next, evaluate the AI Assistant Response based on the provided evaluation Criteria. For each criterion, first provide the reasoning for why it is Pass or Fail, then determine if it is satisfied (mark as PASS) or not (mark as FAIL).
+  (3) Final Judgement: Then, based on the evaluation results in Criteria Judgement, convert them into JSON format.
+""",
+    """\
+  Evaluate the AI Assistant Response based on the provided evaluation Criteria. For each criterion, determine if it is satisfied (mark as PASS) or not (mark as FAIL), and output only the results in JSON format, without any analysis or reasoning.
+""",
+).replace(
+    """\
+### Instruction Analysis
+{Instruction Analysis}
+
+### Criteria Judgement
+{Evaluation for CRITERIA 1}
+{Evaluation for CRITERIA 2}
+...
+
+### Final Judgement
+""",
+    "",
+)
@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import re
+import sys
+
+import jsonlines
+
+from utils import get_model_configs
+from inference import create_inference_adaptor, write_results
+from inference_adaptor.base_adaptor import TURN_FIELDS
+
+# responses recorded by the adaptors instead of raising
+ERROR_PATTERNS = [
+    r"^Exception occured : ",
+    r"^Error on previous turns : ",
+    r"^Error\s+code:\s+\d{3}\s+-",
+    r"^Request timed out\.?$",
+    r"^Connection error\.?$",
+    r"^error$",
+]
+
+
+def turn_value(line, field, turn_idx, default=None):
+    """Value of ``field`` at ``turn_idx``, ``default`` when the line lacks it."""
+    values = line.get(field, [])
+    return values[turn_idx] if turn_idx < len(values) else default
+
+
+def find_failures(line):
+    """Return the reasons why ``line`` needs to be rerun, empty when it succeeded."""
+    reasons = []
+    for turn_idx, response in enumerate(line.get("response", [])):
+        elapsed_time = turn_value(line, "elapsed_time", turn_idx)
+        think_tokens = turn_value(line, "think_tokens", turn_idx, 0)
+        response_tokens = turn_value(line, "response_tokens", turn_idx, 1)
+        if elapsed_time is None:
+            reasons.append(f"turn {turn_idx + 1}: no elapsed_time")
+        elif elapsed_time == -1:
+            reasons.append(f"turn {turn_idx + 1}: elapsed_time is -1")
+        elif any(re.match(pattern, response or "") for pattern in ERROR_PATTERNS):
+            reasons.append(f"turn {turn_idx + 1}: error response")
+        elif think_tokens == 0 and response_tokens == 0:
+            reasons.append(f"turn {turn_idx + 1}: no output tokens")
+    if len(line.get("response", [])) < len(line["input"]):
+        reasons.append("missing turns")
+    return reasons
+
+
+def result_key(line):
+    """Key of a result line, the samples of one item share its ``index``."""
+    return line["index"], line.get("sample_idx", 0)
+
+
+def load_jsonl(path):
+    with jsonlines.open(path) as in_f:
+        return list(in_f)
+
+
+def write_jsonl(lines, path):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, encoding="utf-8", mode="w") as out_f:
+        for line in lines:
+            out_f.write(json.dumps(line, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+
+
+def rerun_inference(failed, inference_adaptor, model_configs):
+    queue = []
+    for line in failed:
+        item = {
+            key: value
+            for key, value in line.items()
+            if key not in TURN_FIELDS and key != "accumulated_conversations"
+        }
+        item["role"] = ["user" for _ in item["input"]]
+        queue.append(item)
+
+    # failed samples are rerun one by one
+    adaptor = create_inference_adaptor(
+        inference_adaptor, model_configs | {"num_samples": 1}
+    )
+    outputs = adaptor.inference(queue)
+    adaptor.terminate()
+    print(json.dumps(adaptor.metrics.summary(), indent=4))
+    return outputs
+
+
+def rejudge(
+    fixed,
+    eval_result_file,
+    judge_configs,
+    prompt_cache=False,
+    structured_output=False,
+    parse_retries=2,
+    compact_prompt=False,
+    max_prompt_tokens=-1,
+):
+    from judge import (
+        build_judge_batch,
+        create_judge_adaptor,
+        create_prompt_budget,
+        build_eval_result,
+        retry_malformed,
+    )
+
+    batch = build_judge_batch(
+        fixed,
+        prompt_cache,
+        structured_output,
+        compact_prompt,
+        create_prompt_budget(judge_configs, max_prompt_tokens),
+    )
+    adaptor = create_judge_adaptor(judge_configs)
+    api_responses, _ = retry_malformed(
+        adaptor, adaptor.inference(batch), parse_retries
+    )
+    api_responses = iter(api_responses)
+    adaptor.terminate()
+
+    fixed_keys = {result_key(line) for line in fixed}
+    eval_results = [
+        result
+        for result in load_jsonl(eval_result_file)
+        if result_key(result) not in fixed_keys
+    ]
+    eval_results += [build_eval_result(line, api_responses) for line in fixed]
+    write_jsonl(sorted(eval_results, key=result_key), eval_result_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--inference_adaptor", type=str, required=True)
+    parser.add_argument("--results_file", type=str, required=True)
+    parser.add_argument("--eval_result_file", type=str, default=None)
+    parser.add_argument("--judge_config", type=str, default=None)
+    parser.add_argument("--prompt_cache", action="store_true")
+    parser.add_argument("--structured_output", action="store_true")
+    parser.add_argument("--parse_retries", type=int, default=2)
+    parser.add_argument("--compact_prompt", action="store_true")
+    parser.add_argument("--max_prompt_tokens", type=int, default=-1)
+    parser.add_argument("--dry_run", action="store_true")
+    args = parser.parse_args()
+
+    results_file = args.results_file.removesuffix(".jsonl")
+    lines = load_jsonl(results_file + ".jsonl")
+
+    failed = []
+    for line in lines:
+        reasons = find_failures(line)
+        if reasons:
+            print(f"index {line['index']}: {', '.join(reasons)}")
+            failed.append(line)
+    print(f"{len(failed)}/{len(lines)} items failed")
+
+    if args.dry_run or not failed:
+        sys.exit(0)
+
+    if args.eval_result_file and not args.judge_config:
+        raise ValueError("--judge_config is required to re-judge --eval_result_file")
+
+    outputs = rerun_inference(
+        failed, args.inference_adaptor, get_model_configs(args.config)
+    )
+    still_failed = sum(1 for output in outputs if find_failures(output))
+    print(f"{len(outputs) - still_failed}/{len(outputs)} items fixed")
+
+    fixed_keys = {result_key(output) for output in outputs}
+    merged = [line for line in lines if result_key(line) not in fixed_keys]
+    write_results(merged + outputs, results_file)
+
+    if args.eval_result_file:
+        rejudge(
+            outputs,
+            args.eval_result_file,
+            get_model_configs(args.judge_config),
+            args.prompt_cache,
+            args.structured_output,
+            args.parse_retries,
+            args.compact_prompt,
+            args.max_prompt_tokens,
+        )
+
+    print("*" * 50)
+    print("done")
+    print("*" * 50)
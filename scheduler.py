@@ -0,0 +1,64 @@
+import json
+import time
+
+from estimator import concurrency_of, estimate_item, simulate_makespan
+
+SCHEDULES = ["dataset_order", "longest_first"]
+
+
+def schedule_order(item_times, schedule):
+    order = list(range(len(item_times)))
+    if schedule == "longest_first":
+        # start the expensive conversations first so they do not end the run
+        order.sort(key=lambda idx: item_times[idx], reverse=True)
+    return order
+
+
+def run_scheduled(adaptor, items, model_configs, history, counter, schedule):
+    """
+    Run ``items`` through ``adaptor`` in the order of ``schedule`` and return
+    the outputs in the original order with a predicted vs actual makespan report.
+
+    Item times are predicted by ``estimate_item`` from the turn count, the
+    input length and the per-category history.
+    """
+    item_times = [estimate_item(item, history, counter)["time"] for item in items]
+    order = schedule_order(item_times, schedule)
+    concurrency = concurrency_of(model_configs)
+
+    start_time = time.time()
+    outputs = adaptor.inference([items[idx] for idx in order])
+    actual_makespan = time.time() - start_time
+
+    # the samples of an item are returned next to each other
+    samples = len(outputs) // max(len(items), 1)
+    restored = [None] * len(outputs)
+    for position, idx in enumerate(order):
+        restored[idx * samples : (idx + 1) * samples] = outputs[
+            position * samples : (position + 1) * samples
+        ]
+
+    report = {
+        "schedule": schedule,
+        "items": len(items),
+        "concurrency": concurrency,
+        "predicted_makespan": round(
+            simulate_makespan([item_times[idx] for idx in order], concurrency), 3
+        ),
+        "predicted_makespan_dataset_order": round(
+            simulate_makespan(item_times, concurrency), 3
+        ),
+        "predicted_longest_item": round(max(item_times, default=0.0), 3),
+        "actual_makespan": round(actual_makespan, 3),
+    }
+    return restored, report
+
+
+def report_schedule(report, output_file=None):
+    print("*" * 50)
+    for key, value in report.items():
+        print(f"{key}: {value}")
+    print("*" * 50)
+    if output_file:
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=4)
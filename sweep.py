@@ -0,0 +1,162 @@
+import argparse
+import asyncio
+import copy
+import gc
+import json
+import time
+
+from pathlib import Path
+from utils import get_model_configs, create_directory_if_not_exists
+from inference import create_inference_adaptor, load_dataset, write_results
+
+# inference adaptor serving each serving_type of the model configs
+SERVING_TYPE_ADAPTORS = {
+    "azure": "openai",
+    "openai": "openai",
+    "vertexai": "vertexai",
+    "anthropic_vertexai": "anthropic_vertexai",
+    "vllm": "vllm",
+}
+
+
+def failed_report(config, error):
+    print(f"{config} failed : {error}")
+    return {"config": config, "status": f"failed : {error}"}
+
+
+def finish_run(config, adaptor, outputs, output_file, wall_time):
+    adaptor.terminate()
+    write_results(outputs, output_file)
+    adaptor.metrics.write_summary(output_file + "_metrics.json")
+    adaptor.metrics.close()
+    summary = adaptor.metrics.summary()
+    return {
+        "config": config,
+        "status": "done",
+        "wall_time": round(wall_time, 3),
+        "errors": summary["errors"],
+        "output_tokens_per_sec": summary["output_tokens_per_sec"],
+    }
+
+
+async def run_api_config(config, adaptor_name, model_configs, queue, output_file):
+    # built here, so a config failing to load is reported like a failed run
+    adaptor = create_inference_adaptor(adaptor_name, model_configs)
+    start_time = time.time()
+    outputs = await adaptor.inference_async(queue)
+    # writing the results off the loop keeps the other configs running
+    return await asyncio.to_thread(
+        finish_run, config, adaptor, outputs, output_file, time.time() - start_time
+    )
+
+
+async def run_api_configs(runs):
+    results = await asyncio.gather(
+        *[run_api_config(*run) for run in runs], return_exceptions=True
+    )
+    reports = []
+    for run, result in zip(runs, results):
+        if isinstance(result, Exception):
+            result = failed_report(run[0], result)
+        reports.append(result)
+    return reports
+
+
+def run_vllm_config(config, adaptor_name, model_configs, queue, output_file):
+    adaptor = create_inference_adaptor(adaptor_name, model_configs)
+    try:
+        start_time = time.time()
+        outputs = adaptor.inference(queue)
+        return finish_run(
+            config, adaptor, outputs, output_file, time.time() - start_time
+        )
+    except Exception:
+        adaptor.terminate()
+        raise
+    finally:
+        # the next engine only fits on the GPUs once this one is released
+        del adaptor
+        gc.collect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", type=str, nargs="+", required=True)
+    parser.add_argument("--dataset_path", type=str, required=True)
+    parser.add_argument("--sample_cnt", type=int, default=-1)
+    parser.add_argument("--output_path", type=str, default="results/")
+    args = parser.parse_args()
+
+    output_path = args.output_path
+    dataset_path = Path(args.dataset_path)
+    if dataset_path.suffix == ".jsonl":
+        dataset_path = dataset_path.with_suffix("")
+    create_directory_if_not_exists(output_path)
+
+    queue = load_dataset(dataset_path, args.sample_cnt)
+    print(len(queue))
+
+    reports = []
+    api_runs = []
+    vllm_runs = []
+    for config in args.configs:
+        try:
+            model_configs = get_model_configs(config)
+            serving_type = model_configs.get("serving_type")
+            if serving_type not in SERVING_TYPE_ADAPTORS:
+                raise ValueError(f"Unsupported serving_type: {serving_type}")
+        except Exception as e:
+            reports.append(failed_report(config, e))
+            continue
+        adaptor_name = SERVING_TYPE_ADAPTORS[serving_type]
+        output_file = output_path + "/" + config + "_" + dataset_path.name
+        run = (config, adaptor_name, model_configs, output_file)
+        if adaptor_name == "vllm":
+            vllm_runs.append(run)
+        else:
+            api_runs.append(run)
+
+    sweep_start = time.time()
+    # API configs share one event loop, each limited by its own semaphore_max_count
+    reports += asyncio.run(
+        run_api_configs(
+            [
+                (
+                    config,
+                    adaptor_name,
+                    model_configs,
+                    # adaptors extend the items in place, every config gets its own copy
+                    copy.deepcopy(queue),
+                    output_file,
+                )
+                for config, adaptor_name, model_configs, output_file in api_runs
+            ]
+        )
+    )
+
+    # vLLM holds the GPUs, its configs run one after another
+    for config, adaptor_name, model_configs, output_file in vllm_runs:
+        try:
+            reports.append(
+                run_vllm_config(
+                    config,
+                    adaptor_name,
+                    model_configs,
+                    # adaptors extend the items in place, every config gets its own copy
+                    copy.deepcopy(queue),
+                    output_file,
+                )
+            )
+        except Exception as e:
+            reports.append(failed_report(config, e))
+
+    sweep_report = {"wall_time": round(time.time() - sweep_start, 3), "runs": reports}
+    print(json.dumps(sweep_report, indent=4))
+    with open(
+        output_path + "/sweep_" + dataset_path.name + ".json", "w", encoding="utf-8"
+    ) as f:
+        json.dump(sweep_report, f, ensure_ascii=False, indent=4)
+
+    print("*" * 50)
+    print("done")
+    print("*" * 50)